@@ -4,12 +4,13 @@ from authlib.integrations.sqla_oauth2 import (
     create_query_client_func,
     create_save_token_func,
 )
-from flask import Flask, abort, jsonify, request, session, current_app
+from flask import Flask, abort, jsonify, request, session
 from flask_restful import Api
 from marshmallow import ValidationError as MarshmallowValidationError
 
 from apigateway import exceptions, extensions, views
-from apigateway.models import OAuth2Client, OAuth2Token, User
+from apigateway.models import OAuth2Client, OAuth2Token
+from apigateway.utils import record_connection_hold_time, release_db_session
 
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 
@@ -33,6 +34,7 @@ def register_extensions(app: Flask):
     """
 
     extensions.db.init_app(app)
+    extensions.replica_service.init_app(app)
     extensions.ma.init_app(app)
 
     extensions.cors.init_app(
@@ -55,10 +57,11 @@ def register_extensions(app: Flask):
     extensions.security_service.init_app(app)
     extensions.auth_service.init_app(app)
     extensions.proxy_service.init_app(app)
-    extensions.limiter_service.init_app(app)
-    extensions.cache_service.init_app(app)
+    extensions.limiter_service.init_app(app, extensions.redis_service)
+    extensions.cache_service.init_app(app, extensions.redis_service)
     extensions.kakfa_producer_service.init_app(app)
     extensions.storage_service.init_app(app, extensions.redis_service)
+    extensions.maintenance_service.init_app(app)
     extensions.talisman.init_app(app, force_https=False)
     extensions.csrf.init_app(app)
 
@@ -76,7 +79,7 @@ def register_hooks(app: Flask):
 
     @app.login_manager.user_loader
     def load_user(user_id):
-        return User.query.filter_by(fs_uniquifier=user_id).first()
+        return extensions.security_service.load_user(user_id)
 
     @app.login_manager.unauthorized_handler
     def unauthorized():
@@ -88,25 +91,17 @@ def register_hooks(app: Flask):
         
     @app.teardown_request
     def teardown_request(exception=None):
-        """This function will close active transaction, if there is one
-        but only if the session is not dirty - we don't want to do any
-        magic (instead of a developer)
-        
-        use expire_on_commit=False doesn't have the same effect
-        http://docs.sqlalchemy.org/en/latest/orm/session_api.html#sqlalchemy.orm.session.Session.commit
-        
-        The problems we are facing is that a new transaction gets opened
-        when session is committed; consequent access to the ORM objects
-        opens a new transaction (which never gets closed and is rolled back)
+        """Ends the active transaction, if there is one, and reports how long the
+        request held database connections.
+
+        The transaction is only committed if the request wrote something, read-only
+        requests do not pay for a COMMIT round-trip. Sessions with unflushed
+        modifications are rolled back - we don't want to do any magic (instead of a
+        developer)
         """
-        a = current_app
-        if 'sqlalchemy' in a.extensions: # could use self.db but let's be very careful
-            sa = a.extensions['sqlalchemy']
-            if hasattr(sa, 'db') and hasattr(sa.db, 'session') and sa.db.session.is_active:
-                if bool(sa.db.session.dirty):
-                    sa.db.session.close() # db server will do rollback
-                else:
-                    sa.db.session.commit() # normal situation        
+        release_db_session()
+        record_connection_hold_time()
+
     return app
 
 
@@ -145,6 +140,10 @@ def register_error_handlers(app: Flask):
     def on_404(e):
         return jsonify({"message": "Not found"}), 404
 
+    @app.errorhandler(exceptions.ServiceUnavailableError)
+    def on_503(e):
+        return jsonify({"message": e.description}), 503, {"Retry-After": str(e.retry_after)}
+
 
 def register_verbose_exception_logging(app: Flask):
     """Configure logging."""
@@ -192,6 +191,7 @@ def register_views(flask_api: Api):
     flask_api.add_resource(views.LogoutView, "/accounts/user/logout")
     flask_api.add_resource(views.UserManagementView, "/accounts/user")
     flask_api.add_resource(views.UserResolverView, "/accounts/user/<string:id>")
+    flask_api.add_resource(views.UserResolverBatchView, "/accounts/users")
     flask_api.add_resource(views.PersonalTokenView, "/accounts/user/token")
     flask_api.add_resource(views.ChangePasswordView, "/accounts/user/change-password")
     flask_api.add_resource(views.ChangeEmailView, "/accounts/user/change-email")
@@ -206,6 +206,9 @@ def register_views(flask_api: Api):
         "/accounts/user/reset-password/<string:token_or_email>",
     )
     flask_api.add_resource(views.UserInfoView, "/accounts/info/<string:account_data>")
+    flask_api.add_resource(views.UserInfoBatchView, "/accounts/info")
+    flask_api.add_resource(views.IntrospectView, "/accounts/introspect")
+    flask_api.add_resource(views.IntrospectBatchView, "/accounts/introspect/batch")
     flask_api.add_resource(views.ChacheManagementView, "/admin/cache")
     flask_api.add_resource(views.LimiterManagementView, "/admin/limit")
     flask_api.add_resource(views.UserFeedbackView, "/feedback")
@@ -1,13 +1,17 @@
 import datetime
-import time
+import signal
+import threading
 
 import click
 from flask import current_app
 from flask.cli import FlaskGroup
 from sqlalchemy import and_
 
+from apigateway import extensions
 from apigateway.app import create_app
-from apigateway.models import OAuth2Client, OAuth2Token, User
+from apigateway.models import OAuth2Client, OAuth2Token, User, roles_users
+from apigateway.services import MaintenanceService
+from apigateway.utils import count_rows, delete_in_batches, hash_id
 
 
 @click.group(cls=FlaskGroup, create_app=create_app)
@@ -21,9 +25,25 @@ def cleanup():
     pass
 
 
+def batch_options(func):
+    """Adds the options shared by commands that delete rows in batches."""
+    func = click.option("--dry-run", is_flag=True, help="Only count the rows to delete")(func)
+    func = click.option(
+        "--max-rate", nargs=1, default=None, type=float, help="Maximum rows deleted per second"
+    )(func)
+    func = click.option(
+        "--sleep", nargs=1, default=0.0, type=float, help="Seconds to wait between batches"
+    )(func)
+    func = click.option(
+        "--batch-size", nargs=1, default=1000, type=int, help="Rows deleted per transaction"
+    )(func)
+    return func
+
+
 @cleanup.command("users")
 @click.option("--timedelta", nargs=1, default="hours=24")
-def cleanup_users(timedelta):
+@batch_options
+def cleanup_users(timedelta, batch_size, sleep, max_rate, dry_run):
     """
     Deletes stale users from the database. Stale users are defined as users
     that have a registered_at value of `now`-`timedelta` but not confirmed_at
@@ -34,84 +54,73 @@ def cleanup_users(timedelta):
 
     :param timedelta: String representing the datetime.timedelta against which
             to compare user's registered_at ["hours=24"].
+    :param batch_size: Number of users deleted per transaction [1000].
+    :param sleep: Seconds to wait between batches [0].
+    :param max_rate: Maximum number of users deleted per second [unlimited].
+    :param dry_run: Only count the users that would be deleted.
     :return: None
     """
 
     td = parse_timedelta(timedelta)
 
     with current_app.app_context():
-        deletions = 0
-        for user in (
-            current_app.db.session.query(User)
-            .filter(
-                User.registered_at <= datetime.datetime.now() - td,
-                User.confirmed_at == None,  # noqa
-            )
-            .yield_per(100)
-        ):
-            current_app.db.session.delete(user)
-            deletions += 1
-            current_app.logger.info("Deleted unverified user: {}".format(user.email))
-
-        try:
-            current_app.db.session.commit()
-        except Exception as e:
-            current_app.db.session.rollback()
-            current_app.logger.error(
-                "Could not cleanup stale users. " "Database error; rolled back: {0}".format(e)
+        condition = MaintenanceService.stale_users_condition(td)
+        if dry_run:
+            current_app.logger.info(
+                "Would delete {0} stale users".format(count_rows(User.__table__, condition))
             )
+            return
+
+        def log_deleted_users(rows):
+            for _, email in rows:
+                current_app.logger.info("Deleted unverified user: {}".format(email))
+
+        deletions = delete_in_batches(
+            User.__table__,
+            condition,
+            batch_size=batch_size,
+            sleep=sleep,
+            max_rate=max_rate,
+            returning=(User.email,),
+            dependents=(roles_users.c.user_id,),
+            on_batch=log_deleted_users,
+        )
         current_app.logger.info("Deleted {0} stale users".format(deletions))
 
 
 @cleanup.command("tokens")
-def cleanup_tokens():
+@batch_options
+def cleanup_tokens(batch_size, sleep, max_rate, dry_run):
     """
     Cleans expired oauth2tokens from the database defined in
     app.config['SQLALCHEMY_DATABASE_URI']
+
+    :param batch_size: Number of tokens deleted per transaction [1000].
+    :param sleep: Seconds to wait between batches [0].
+    :param max_rate: Maximum number of tokens deleted per second [unlimited].
+    :param dry_run: Only count the tokens that would be deleted.
     :return: None
     """
 
     with current_app.app_context():
-        total = 0
-        deletions = None
-        while deletions != 0:
-            deletions = 0
-            # go through the expired tokens and delete the associated client
-            # every client should have only one token (that's by design)
-            # faster way - not portable though - would be to delete anything
-            # selected by the following query:
-            # select c.user_id, c.client_id from oauth2client AS c LEFT OUTER JOIN oauth2token AS t
-            # ON c.client_id = t.client_id WHERE t.access_token is null
-            for token in (
-                current_app.db.session.query(OAuth2Token)
-                .filter(
-                    OAuth2Token.expires_in != None,  # noqa
-                    (OAuth2Token.issued_at + OAuth2Token.expires_in) < time.time(),
-                )
-                .limit(1000)
-                .yield_per(100)
-            ):
-
-                # for some odd reasons, even though clients-tokens are associated
-                # the deletes didn't cascade on postgres; so let's delete them
-                # explicitly
-                if token.client:
-                    current_app.db.session.delete(token.client)
-                current_app.db.session.delete(token)
-                deletions += 1
-            try:
-                current_app.db.session.commit()
-                total += deletions
-                current_app.logger.info(
-                    "Deleted {0} expired oauth2tokens/oauth2clients".format(deletions)
-                )
-            except Exception as e:
-                current_app.db.session.rollback()
-                current_app.logger.error(
-                    "Could not cleanup expired oauth2tokens. "
-                    "Database error; rolled back: {0}".format(e)
+        condition = MaintenanceService.expired_tokens_condition()
+        if dry_run:
+            current_app.logger.info(
+                "Would delete {0} expired oauth2tokens/oauth2clients".format(
+                    count_rows(OAuth2Token.__table__, condition)
                 )
-                total -= deletions
+            )
+            return
+
+        total = delete_in_batches(
+            OAuth2Token.__table__,
+            condition,
+            batch_size=batch_size,
+            sleep=sleep,
+            max_rate=max_rate,
+            returning=(OAuth2Token.client_id, OAuth2Token.user_id),
+            on_batch=MaintenanceService.delete_token_clients,
+        )
 
         current_app.logger.info(
             "Deleted total of {0} expired oauth2tokens/oauth2clients".format(total)
@@ -122,7 +131,8 @@ def cleanup_tokens():
 @click.option("--timedelta", nargs=1, default="days=90")
 @click.option("--userid", nargs=1, default=None)
 @click.option("--ratelimit", nargs=1, default=1.0)
-def cleanup_clients(timedelta, userid, ratelimit):
+@batch_options
+def cleanup_clients(timedelta, userid, ratelimit, batch_size, sleep, max_rate, dry_run):
     """
     Cleans expired oauth2clients that are older than a specified date in the
     database defined in app.config['SQLALCHEMY_DATABASE_URI']
@@ -139,6 +149,10 @@ def cleanup_clients(timedelta, userid, ratelimit):
             only to clients of that user
     :param ratelimit: int, default=1; ony clients that have limit lower or
             equal to this value will be deleted
+    :param batch_size: Number of clients deleted per transaction [1000].
+    :param sleep: Seconds to wait between batches [0].
+    :param max_rate: Maximum number of clients deleted per second [unlimited].
+    :param dry_run: Only count the clients that would be deleted.
     :return: None
     """
 
@@ -150,49 +164,184 @@ def cleanup_clients(timedelta, userid, ratelimit):
     td = parse_timedelta(timedelta)
 
     with current_app.app_context():
-        deletions = 0
+        condition = and_(
+            OAuth2Client.last_activity <= datetime.datetime.now() - td,
+            OAuth2Client.ratelimit_multiplier <= ratelimit,
+        )
         if userid is not None:
-            for client in (
-                current_app.db.session.query(OAuth2Client)
-                .filter(
-                    and_(
-                        OAuth2Client.last_activity <= datetime.datetime.now() - td,
-                        OAuth2Client.user_id == userid,
-                        OAuth2Client.ratelimit_multiplier <= ratelimit,
-                    )
-                )
-                .yield_per(1000)
-            ):
-
-                current_app.db.session.delete(client)
-                deletions += 1
-        else:
-            for client in (
-                current_app.db.session.query(OAuth2Client)
-                .filter(
-                    OAuth2Client.last_activity <= datetime.datetime.now() - td,
-                    OAuth2Client.ratelimit_multiplier <= ratelimit,
+            condition = and_(condition, OAuth2Client.user_id == userid)
+
+        if dry_run:
+            current_app.logger.info(
+                "Would delete {0} oauth2clients".format(
+                    count_rows(OAuth2Client.__table__, condition)
                 )
-                .yield_per(1000)
-            ):
-
-                current_app.db.session.delete(client)
-                deletions += 1
-        try:
-            current_app.db.session.commit()
-        except Exception as e:
-            current_app.db.session.rollback()
-            current_app.logger.error(
-                "Could not cleanup expired oauth2clients. "
-                "Database error; rolled back: {0}".format(e)
             )
             return
+
+        def invalidate_bootstrap_caches(rows):
+            # The tokens of the clients are deleted with them
+            for user_id in {user_id for _, user_id in rows if user_id is not None}:
+                extensions.auth_service.invalidate_bootstrap_cache(user_id)
+
+        deletions = delete_in_batches(
+            OAuth2Client.__table__,
+            condition,
+            batch_size=batch_size,
+            sleep=sleep,
+            max_rate=max_rate,
+            returning=(OAuth2Client.user_id,),
+            on_batch=invalidate_bootstrap_caches,
+        )
         current_app.logger.info(
             "Deleted {0} oauth2clients whose last_activity was "
             "at least {1} old and userid={2}".format(deletions, timedelta, userid)
         )
 
 
+@cli.group("maintenance", short_help="Maintenance commands")
+def maintenance():
+    """Commands that keep the database tidy"""
+    pass
+
+
+@maintenance.command("run")
+def maintenance_run():
+    """
+    Runs the maintenance worker until it receives SIGINT or SIGTERM. The worker
+    continuously deletes expired tokens and their clients, unverified users and
+    stale password and email change requests in small batches, see the
+    MAINTENANCE_SERVICE_* settings. Only one instance is active at a time,
+    others wait for its Redis lock.
+
+    :return: None
+    """
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+
+    with current_app.app_context():
+        extensions.maintenance_service.run(stop)
+
+
+@maintenance.command("partitions")
+def maintenance_partitions():
+    """
+    Creates the upcoming daily partitions of oauth2token and drops the
+    partitions whose tokens have all expired. The maintenance worker does
+    this every hour, run it once after partitioning the table.
+
+    :return: None
+    """
+    with current_app.app_context():
+        extensions.maintenance_service.manage_partitions()
+
+
+@cli.group("backfill", short_help="Backfill commands")
+def backfill():
+    """Commands that fill in denormalized columns of existing rows"""
+    pass
+
+
+@backfill.command("hashed-ids")
+@click.option("--batch-size", nargs=1, default=1000, type=int)
+def backfill_hashed_ids(batch_size):
+    """
+    Fills in the hashed_id column of users and oauth2clients that do not have
+    one yet. Rows are processed in batches of increasing primary key, every
+    batch is committed separately.
+
+    :param batch_size: Number of rows updated per transaction [1000].
+    :return: None
+    """
+
+    with current_app.app_context():
+        for model, column in ((User, User.fs_uniquifier), (OAuth2Client, OAuth2Client.id)):
+            total = 0
+            last_id = 0
+            while True:
+                rows = (
+                    current_app.db.session.query(model.id, column)
+                    .filter(model.id > last_id, model.hashed_id == None)  # noqa
+                    .order_by(model.id)
+                    .limit(batch_size)
+                    .all()
+                )
+                if not rows:
+                    break
+
+                current_app.db.session.bulk_update_mappings(
+                    model, [{"id": id, "hashed_id": hash_id(value)} for id, value in rows]
+                )
+                try:
+                    current_app.db.session.commit()
+                except Exception as e:
+                    current_app.db.session.rollback()
+                    current_app.logger.error(
+                        "Could not backfill hashed ids. "
+                        "Database error; rolled back: {0}".format(e)
+                    )
+                    return
+
+                total += len(rows)
+                last_id = rows[-1][0]
+
+            current_app.logger.info(
+                "Backfilled hashed ids of {0} {1} rows".format(total, model.__tablename__)
+            )
+
+
+@backfill.command("token-digests")
+@click.option("--batch-size", nargs=1, default=1000, type=int)
+def backfill_token_digests(batch_size):
+    """
+    Fills in the access_token_digest column of oauth2tokens that do not have
+    one yet. On PostgreSQL, a trigger fills in the digests of new tokens since
+    migration e3b9a6f1c274, which also fills in those of existing tokens.
+    Tokens are processed in batches of increasing primary key, every batch is
+    committed separately.
+
+    :param batch_size: Number of rows updated per transaction [1000].
+    :return: None
+    """
+
+    with current_app.app_context():
+        total = 0
+        last_id = 0
+        while True:
+            rows = (
+                current_app.db.session.query(OAuth2Token.id, OAuth2Token.access_token)
+                .filter(OAuth2Token.id > last_id, OAuth2Token.access_token_digest == None)  # noqa
+                .order_by(OAuth2Token.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+
+            current_app.db.session.bulk_update_mappings(
+                OAuth2Token,
+                [
+                    {"id": id, "access_token_digest": OAuth2Token.get_access_token_digest(token)}
+                    for id, token in rows
+                ],
+            )
+            try:
+                current_app.db.session.commit()
+            except Exception as e:
+                current_app.db.session.rollback()
+                current_app.logger.error(
+                    "Could not backfill access token digests. "
+                    "Database error; rolled back: {0}".format(e)
+                )
+                return
+
+            total += len(rows)
+            last_id = rows[-1][0]
+
+        current_app.logger.info("Backfilled access token digests of {0} tokens".format(total))
+
+
 def parse_timedelta(s):
     """
     Helper function which converts a string formatted timedelta into a
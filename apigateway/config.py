@@ -54,6 +54,11 @@ LOG_STDOUT = False
 # Database
 SQLALCHEMY_DATABASE_URI = "postgresql://user:password@db:5432/gateway"
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Read replicas used for read-only account and token lookups, replicas lagging more than
+# MAX_LAG seconds behind the primary are skipped
+REPLICA_SERVICE_URIS = []
+REPLICA_SERVICE_MAX_LAG = 5
+REPLICA_SERVICE_CHECK_INTERVAL = 5
 SECRET_KEY = environ.get("PROXY_SECRET_KEY", "736563726574")
 
 # Auth
@@ -66,7 +71,21 @@ GOOGLE_RECAPTCHA_PRIVATE_KEY = "MY_PRIVATE_KEY"
 PERMANENT_SESSION_LIFETIME = 3600 * 24 * 365.25  # 1 year in seconds
 SESSION_REFRESH_EACH_REQUEST = True
 ANONYMOUS_BOOTSTRAP_USER_EMAIL = "anonymous@ads"
+# Seconds before the memoized identity of the anonymous bootstrap user is looked up again
+ANONYMOUS_BOOTSTRAP_USER_TTL = 300
 BOOTSTRAP_CLIENT_NAME = "BB client"
+# Issue self-contained signed tokens to anonymous bootstrap users instead of
+# storing an OAuth2Client/OAuth2Token pair for every anonymous visitor
+BOOTSTRAP_STATELESS_TOKENS = False
+# Store the tokens of anonymous bootstrap users in daily partitions of oauth2token by
+# their expiry, so that expired tokens are removed by dropping whole partitions. Requires
+# migration 0e6b3f95a1d4 on postgres
+BOOTSTRAP_TOKEN_PARTITIONED = False
+# Seconds a logged-in user's bootstrap response is served from storage; 0 disables it
+BOOTSTRAP_CACHE_TIMEOUT = 3600
+# Seconds token introspection responses are cached by each process and by callers
+AUTH_SERVICE_INTROSPECTION_CACHE_TTL = 30
+AUTH_SERVICE_INTROSPECTION_CACHE_SIZE = 10000
 SESSION_COOKIE_PATH = "/v1"
 
 # Proxy service
@@ -77,6 +96,8 @@ PROXY_SERVICE_ALLOWED_HEADERS = ["Content-Type", "Content-Disposition"]
 # Limiter service
 LIMITER_SERVICE_SCALING_COST_ENABLED = True
 LIMITER_SERVICE_SCALING_COST_THRESHOLD = 100
+# Sentinel (redis+sentinel://host:port,host:port/service) and cluster URLs
+# (redis+cluster://host:port,host:port) are connected to by the limits library
 LIMITER_SERVICE_STORAGE_URI = "redis://redis:6379/0"
 LIMITER_SERVICE_STRATEGY = "fixed-window"
 LIMITER_SERVICE_GROUPS = {
@@ -88,8 +109,48 @@ LIMITER_SERVICE_GROUPS = {
 }
 
 # Redis service
+# Also the URL of the sentinels that monitor a primary,
+# "redis+sentinel://[:password@]host:port[,host:port]/service[/db]", or of nodes of a
+# cluster, "redis+cluster://[:password@]host:port[,host:port]". The same formats can be
+# used for CACHE_SERVICE_REDIS_URI
 REDIS_SERVICE_URL = "redis://redis:6379/0"
-
+# While Redis is unavailable it is pinged in the background, starting after PROBE_MIN_INTERVAL
+# seconds and doubling the interval up to PROBE_MAX_INTERVAL. Storage, limiter and cache
+# fall back or bypass Redis until it responds
+REDIS_SERVICE_PROBE_MIN_INTERVAL = 0.5
+REDIS_SERVICE_PROBE_MAX_INTERVAL = 30
+# Connections of the storage, limiter and cache services. Every process has one pool per
+# database URL and server with at most MAX_CONNECTIONS connections, a request waits up to
+# POOL_TIMEOUT seconds for a free connection to a single server. Idle connections are
+# pinged before use after HEALTH_CHECK_INTERVAL seconds
+REDIS_SERVICE_MAX_CONNECTIONS = 50
+REDIS_SERVICE_POOL_TIMEOUT = 1
+REDIS_SERVICE_SOCKET_TIMEOUT = 5
+REDIS_SERVICE_CONNECT_TIMEOUT = 2
+REDIS_SERVICE_HEALTH_CHECK_INTERVAL = 30
+
+
+# Storage service
+# While Redis is unavailable values are kept in memory, evicting the least recently used
+# entries beyond MAX_ENTRIES entries or MAX_BYTES bytes
+STORAGE_SERVICE_FALLBACK_MAX_ENTRIES = 100000
+STORAGE_SERVICE_FALLBACK_MAX_BYTES = 64 * 1024 * 1024
+STORAGE_SERVICE_FALLBACK_SHARDS = 16
+# When Redis recovers, the fallback storage is transferred in pipelines of this many keys
+STORAGE_SERVICE_RESYNC_BATCH_SIZE = 500
+# Format of stored values, "msgpack" or "pickle". Both formats are always read. During a
+# rolling upgrade from a version that only reads pickle, keep "pickle" until all nodes
+# are upgraded
+STORAGE_SERVICE_CODEC = "msgpack"
+# Keys starting with one of NEAR_CACHE_PREFIXES are kept in process memory for up to
+# NEAR_CACHE_TTL seconds and dropped as soon as any client writes them, which requires
+# Redis 6 or later. The near cache evicts the least recently used keys beyond MAX_ENTRIES
+# entries or MAX_BYTES bytes
+STORAGE_SERVICE_NEAR_CACHE_ENABLED = False
+STORAGE_SERVICE_NEAR_CACHE_PREFIXES = ["AUTH_SERVICE//bootstrap/"]
+STORAGE_SERVICE_NEAR_CACHE_TTL = 300
+STORAGE_SERVICE_NEAR_CACHE_MAX_ENTRIES = 10000
+STORAGE_SERVICE_NEAR_CACHE_MAX_BYTES = 16 * 1024 * 1024
 
 # Cache service
 CACHE_SERVICE_CACHE_TYPE = "RedisCache"
@@ -97,6 +158,9 @@ CACHE_SERVICE_REDIS_URI = (
     # NOTE: Do not use the same redis DB as other services
     "redis://redis:6379/1"
 )
+# Format of cached values, see STORAGE_SERVICE_CODEC. Proxy responses are stored as their
+# status, the PROXY_SERVICE_ALLOWED_HEADERS headers and the raw body
+CACHE_SERVICE_CODEC = "msgpack"
 
 # Security service
 SECURITY_SERVICE_SECRET_KEY = environ.get("ADSWS_SECRET_KEY", "secret")
@@ -107,15 +171,66 @@ SECURITY_SERVICE_VERIFY_PASSWORD_SALT = environ.get(
 SECURITY_SERVICE_VERIFY_EMAIL_SALT = environ.get(
     "ADSWS_VERIFY_EMAIL_SALT", SECURITY_SERVICE_SECRET_KEY
 )
+# Users loaded from the session cookie are cached per process for this many seconds
+SECURITY_SERVICE_USER_CACHE_TTL = 30
+SECURITY_SERVICE_USER_CACHE_SIZE = 10000
+# Password hashing and verification run in this many worker processes, 0 runs them inline.
+# When more operations than MAX_PENDING are queued, requests are rejected with a 503
+SECURITY_SERVICE_PASSWORD_WORKERS = 2
+SECURITY_SERVICE_PASSWORD_MAX_PENDING = 32
+SECURITY_SERVICE_PASSWORD_TIMEOUT = 10
 
 BOOTSTRAP_SCOPES = []
 USER_DEFAULT_SCOPES = ["user", "api"]
 USER_API_DEFAULT_SCOPES = ["api"]
+# Number of threads resolving the identifier groups of a batched /accounts/info request
+USER_INFO_BATCH_WORKERS = 3
+# Store the hashed user and client ids when users and clients are created, so that
+# hashed ids can be resolved back to users. Existing rows are filled in with
+# `apigateway backfill hashed-ids`
+PERSIST_HASHED_IDS = False
+
+# Maintenance service, run with `apigateway maintenance run`
+# Rows are deleted in batches of at most BATCH_SIZE rows and MAX_RATE rows per second per
+# category. Batches shrink down to MIN_BATCH_SIZE while they take longer than
+# TARGET_LATENCY seconds, drained categories are checked again after IDLE_INTERVAL seconds
+MAINTENANCE_SERVICE_BATCH_SIZE = 500
+MAINTENANCE_SERVICE_MIN_BATCH_SIZE = 10
+MAINTENANCE_SERVICE_MAX_RATE = 500
+MAINTENANCE_SERVICE_TARGET_LATENCY = 0.2
+MAINTENANCE_SERVICE_IDLE_INTERVAL = 60
+# Seconds the lock of the active worker lives without renewal, it is renewed at least every
+# LOCK_TIMEOUT / 2 seconds
+MAINTENANCE_SERVICE_LOCK_TIMEOUT = 60
+MAINTENANCE_SERVICE_UNVERIFIED_USER_MAX_AGE = 86400
+MAINTENANCE_SERVICE_CHANGE_REQUEST_MAX_AGE = 86400
+# Days ahead for which daily oauth2token partitions are created, BOOTSTRAP_TOKEN_EXPIRES
+# must not exceed PARTITIONS_AHEAD - 1 days when BOOTSTRAP_TOKEN_PARTITIONED is set
+MAINTENANCE_SERVICE_PARTITIONS_AHEAD = 3
+# Milliseconds a partition DDL statement waits for its locks on oauth2token before it is
+# retried, keep both low so that managing the partitions stays well within the lock TTL
+MAINTENANCE_SERVICE_PARTITION_LOCK_TIMEOUT = 1000
+MAINTENANCE_SERVICE_PARTITION_RETRIES = 3
 
 # Kafka producer service
 KAFKA_PRODUCER_SERVICE_BOOTSTRAP_SERVERS = ["localhost:9092"]
 KAFKA_PRODUCER_SERVICE_REQUEST_TOPIC = "gatewayRequests"
 KAFKA_PRODUCER_SERVICE_REQUEST_TIMEOUT_MS = 500
+# Request events are buffered and sent by a background thread, events are dropped while
+# QUEUE_SIZE events are waiting. The producer batches events for up to LINGER_MS
+# milliseconds or BATCH_SIZE bytes per partition and compresses each batch
+KAFKA_PRODUCER_SERVICE_QUEUE_SIZE = 10000
+KAFKA_PRODUCER_SERVICE_LINGER_MS = 50
+KAFKA_PRODUCER_SERVICE_BATCH_SIZE = 65536
+KAFKA_PRODUCER_SERVICE_COMPRESSION_TYPE = "gzip"
+# Kafka is connected again with exponential backoff starting at RETRY_INTERVAL seconds.
+# Meanwhile, events are appended to the spool of the process in a subdirectory of
+# SPOOL_PATH, in segment files of SPOOL_SEGMENT_SIZE bytes up to SPOOL_MAX_BYTES. Without
+# a SPOOL_PATH, events are dropped once the buffer is full
+KAFKA_PRODUCER_SERVICE_RETRY_INTERVAL = 1
+KAFKA_PRODUCER_SERVICE_SPOOL_PATH = "/tmp/apigateway/kafka-spool"
+KAFKA_PRODUCER_SERVICE_SPOOL_SEGMENT_SIZE = 4 * 1024 * 1024
+KAFKA_PRODUCER_SERVICE_SPOOL_MAX_BYTES = 64 * 1024 * 1024
 
 OTEL_ENABLE_METRICS = False
 ENABLE_OTEL = 'CONSOLE'
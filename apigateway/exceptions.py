@@ -1,4 +1,4 @@
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, ServiceUnavailable
 
 
 class ValidationError(Exception):
@@ -49,6 +49,15 @@ class NotFoundError(Exception):
         return repr(self.value)
 
 
+class ServiceUnavailableError(ServiceUnavailable):
+    """
+    Exception raised when a request is rejected because the gateway is overloaded
+    """
+
+    def __init__(self, description, retry_after=1):
+        super().__init__(description, retry_after=retry_after)
+
+
 class Oauth2HttpError(HTTPException):
     """
     Exception raised when an oauth2 error occurs
@@ -12,14 +12,17 @@ from apigateway.services import (
     CacheService,
     KafkaProducerService,
     LimiterService,
+    MaintenanceService,
     ProxyService,
     RedisService,
+    ReplicaService,
     SecurityService,
     StorageService,
 )
+from apigateway.utils import RoutingSession
 
 # Database
-db = FlaskSQLAlchemy(model_class=base_model)
+db = FlaskSQLAlchemy(model_class=base_model, session_options={"class_": RoutingSession})
 ma = Marshmallow()
 
 # Auth
@@ -40,3 +43,5 @@ limiter_service = LimiterService()
 cache_service = CacheService()
 kakfa_producer_service = KafkaProducerService()
 storage_service = StorageService()
+replica_service = ReplicaService()
+maintenance_service = MaintenanceService()
@@ -1,3 +1,5 @@
+import hashlib
+from datetime import datetime
 from typing import List
 
 import sqlalchemy as sa
@@ -6,10 +8,9 @@ from citext import CIText
 from flask import current_app
 from flask_login import AnonymousUserMixin
 from flask_security import RoleMixin, UserMixin
-from flask_security.utils import hash_password, verify_password
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 from werkzeug.datastructures import ImmutableList
 from werkzeug.security import gen_salt
 
@@ -44,6 +45,8 @@ class User(base_model, UserMixin):
     ratelimit_quota = sa.Column(sa.Float)
     _allowed_scopes = sa.Column(sa.Text)
     fs_uniquifier = sa.Column(sa.String(64), unique=True, nullable=False)
+    # The hashed fs_uniquifier shared with other services, see PERSIST_HASHED_IDS
+    hashed_id = sa.Column(sa.String(64), index=True)
     roles = relationship("Role", secondary=roles_users)
 
     @property
@@ -52,13 +55,23 @@ class User(base_model, UserMixin):
 
     @password.setter
     def password(self, password):
-        self._password = hash_password(password)
+        self._password = current_app.extensions["security_service"].hash_password(password)
 
     password = sa.orm.synonym("_password", descriptor=password)
 
     @hybrid_property
     def is_anonymous_bootstrap_user(self) -> bool:
-        return current_app.config["ANONYMOUS_BOOTSTRAP_USER_EMAIL"] == self.email
+        # The auth service resolves the anonymous user's primary key at most once per
+        # ANONYMOUS_BOOTSTRAP_USER_TTL, also when the user does not exist
+        anonymous_user_id = current_app.extensions["auth_service"].anonymous_user_id
+        if anonymous_user_id is None or self.id is None:
+            return current_app.config["ANONYMOUS_BOOTSTRAP_USER_EMAIL"] == self.email
+
+        return self.id == anonymous_user_id
+
+    @is_anonymous_bootstrap_user.expression
+    def is_anonymous_bootstrap_user(cls):
+        return cls.email == current_app.config["ANONYMOUS_BOOTSTRAP_USER_EMAIL"]
 
     @property
     def allowed_scopes(self) -> List[str]:
@@ -68,7 +81,14 @@ class User(base_model, UserMixin):
             return current_app.config["USER_DEFAULT_SCOPES"]
 
     def validate_password(self, password) -> bool:
-        return verify_password(password, self.password)
+        valid, password_hash = current_app.extensions["security_service"].verify_password(
+            password, self.password
+        )
+        if password_hash:
+            # Rehashed with the configured scheme and cost, stored with the next commit
+            self._password = password_hash
+
+        return valid
 
 
 class AnonymousUser(AnonymousUserMixin):
@@ -102,6 +122,7 @@ class Role(base_model, RoleMixin):
 
 class OAuth2Client(base_model, OAuth2ClientMixin):
     __tablename__ = "oauth2client"
+    __table_args__ = (sa.Index("ix_oauth2client_user_id_client_name", "user_id", "client_name"),)
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     user_id = sa.Column(
@@ -111,8 +132,17 @@ class OAuth2Client(base_model, OAuth2ClientMixin):
     individual_ratelimit_multipliers = sa.Column(sa.JSON)
     last_activity = sa.Column(sa.DateTime, nullable=True)
 
+    # Denormalized from the client metadata so that clients can be queried by name
+    client_name = sa.Column(sa.Text)
+    # The hashed id shared with other services, see PERSIST_HASHED_IDS
+    hashed_id = sa.Column(sa.String(64), index=True)
+
     user = relationship("User")
 
+    def set_client_metadata(self, value):
+        super().set_client_metadata(value)
+        self.client_name = value.get("client_name")
+
     def gen_salt(self):
         self.reset_client_id()
         self.reset_client_secret()
@@ -126,6 +156,14 @@ class OAuth2Client(base_model, OAuth2ClientMixin):
 
 class OAuth2Token(base_model, OAuth2TokenMixin):
     __tablename__ = "oauth2token"
+    __table_args__ = (
+        sa.Index(
+            "ix_oauth2token_access_token_digest",
+            "access_token_digest",
+            "partition_day",
+            unique=True,
+        ),
+    )
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     user_id = sa.Column(
@@ -139,6 +177,24 @@ class OAuth2Token(base_model, OAuth2TokenMixin):
     is_personal = sa.Column(sa.Boolean, default=False, index=True)
     is_internal = sa.Column(sa.Boolean, default=False)
     expires_in = sa.Column(sa.BigInteger, nullable=False, default=0)
+    # Day, counted from the epoch, on which a short-lived token expires. On postgres the
+    # table is partitioned by this column, tokens that are not stored in a daily partition
+    # have 0. The day is also the prefix of the access token, see BOOTSTRAP_TOKEN_PARTITIONED
+    partition_day = sa.Column(sa.Integer, nullable=False, default=0, server_default="0")
+    # Tokens are looked up by the fixed-width digest of their access tokens, the raw
+    # access tokens are not indexed
+    access_token = sa.Column(sa.String(255), nullable=False)
+    access_token_digest = sa.Column(sa.LargeBinary(16))
+
+    # True for tokens decoded from a signed access token instead of loaded from the database
+    is_stateless = False
+    # The public client id of a stateless token, which has no client row to reference
+    stateless_client_id = None
+
+    def get_client_key(self):
+        """Returns what rate limits and request events identify the client of the token by,
+        the primary key of its client or the public client id of a stateless token."""
+        return self.stateless_client_id if self.is_stateless else self.client_id
 
     def expires_at(self):
         if not self.expires_in:
@@ -146,6 +202,45 @@ class OAuth2Token(base_model, OAuth2TokenMixin):
 
         return self.issued_at + self.expires_in
 
+    @validates("access_token")
+    def _set_access_token_digest(self, key, access_token):
+        self.access_token_digest = (
+            self.get_access_token_digest(access_token) if access_token is not None else None
+        )
+        return access_token
+
+    @staticmethod
+    def get_access_token_digest(access_token: str) -> bytes:
+        """Returns the first 16 bytes of the SHA-256 digest of an access token."""
+        return hashlib.sha256(access_token.encode()).digest()[:16]
+
+    @staticmethod
+    def get_partition_day(access_token: str) -> int:
+        """Returns the partition day encoded in an access token, 0 if it has none."""
+        prefix, separator, _ = access_token.partition("-")
+        return int(prefix) if separator and prefix.isdigit() else 0
+
+    @classmethod
+    def access_token_filter(cls, access_tokens):
+        """Filter matching the tokens with the given access tokens.
+
+        Tokens are found through the index on their digests, the access tokens themselves
+        are compared to rule out collisions. The filter includes the partition days of the
+        tokens, so that postgres only looks them up in the partitions they are stored in.
+        """
+        access_tokens = list(access_tokens)
+        return sa.and_(
+            cls.access_token_digest.in_(
+                [cls.get_access_token_digest(token) for token in access_tokens]
+            ),
+            cls.access_token.in_(access_tokens),
+            cls.partition_day.in_({cls.get_partition_day(token) for token in access_tokens}),
+        )
+
+
+# Supports the lookup of expired tokens by `apigateway cleanup tokens`
+sa.Index("ix_oauth2token_expires_at", OAuth2Token.issued_at + OAuth2Token.expires_in)
+
 
 class EmailChangeRequest(base_model):
     __tablename__ = "email_change_request"
@@ -155,6 +250,7 @@ class EmailChangeRequest(base_model):
     user_id = sa.Column(sa.Integer(), sa.ForeignKey("user.id", ondelete="CASCADE"))
     user = relationship("User")
     new_email = sa.Column(sa.Text)
+    created_at = sa.Column(sa.DateTime, default=datetime.now, server_default=sa.func.now())
 
 
 class PasswordChangeRequest(base_model):
@@ -164,3 +260,4 @@ class PasswordChangeRequest(base_model):
     token = sa.Column(sa.String(255), unique=True)
     user_id = sa.Column(sa.Integer(), sa.ForeignKey("user.id", ondelete="CASCADE"))
     user = relationship("User")
+    created_at = sa.Column(sa.DateTime, default=datetime.now, server_default=sa.func.now())
@@ -153,6 +153,23 @@ class ClearLimitRequestSchema:
             )
 
 
+@dataclass
+class BatchIdentifiersRequestSchema:
+    identifiers: List[str] = field(
+        metadata={"validate": marshmallow.validate.Length(min=1, max=1000)}
+    )
+
+
+@dataclass
+class IntrospectRequestSchema:
+    token: str = field()
+
+
+@dataclass
+class IntrospectBatchRequestSchema:
+    tokens: List[str] = field(metadata={"validate": marshmallow.validate.Length(min=1, max=1000)})
+
+
 @dataclass
 class PersonalTokenViewGetResponseSchema:
     access_token: str = field(default=None)
@@ -177,3 +194,6 @@ reset_password_request = marshmallow_dataclass.class_schema(ResetPasswordRequest
 clear_cache_request = marshmallow_dataclass.class_schema(ClearCacheRequestSchema)()
 clear_limit_request = marshmallow_dataclass.class_schema(ClearLimitRequestSchema)()
 personal_token_response = marshmallow_dataclass.class_schema(PersonalTokenViewGetResponseSchema)()
+batch_identifiers_request = marshmallow_dataclass.class_schema(BatchIdentifiersRequestSchema)()
+introspect_request = marshmallow_dataclass.class_schema(IntrospectRequestSchema)()
+introspect_batch_request = marshmallow_dataclass.class_schema(IntrospectBatchRequestSchema)()
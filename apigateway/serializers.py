@@ -0,0 +1,132 @@
+"""Codecs for the values that the gateway stores in Redis."""
+
+import pickle
+import struct
+
+import msgpack
+
+# The first byte of an encoded value identifies its format, so that values written by
+# other versions of the gateway can still be read
+PICKLE = b"!"  # The format of cachelib's RedisSerializer
+MSGPACK = b"\x01"
+RESPONSE = b"\x02"
+
+# Status code and length of the header block that precede the body of a cached response
+_RESPONSE_HEADER = struct.Struct("!HI")
+
+
+class Codec:
+    """Encodes values with msgpack, or with pickle if msgpack cannot represent them.
+
+    Integers are stored as text so that Redis can increment them. Tuples and other types
+    without a msgpack equivalent are pickled, so that they keep their type. Every format
+    can be read, whichever one is written.
+
+    Args:
+        write_format (str, optional): "msgpack" or "pickle". Defaults to "msgpack".
+    """
+
+    def __init__(self, write_format: str = "msgpack"):
+        if write_format not in ("msgpack", "pickle"):
+            raise ValueError("Unknown codec format {0}".format(write_format))
+        self._msgpack = write_format == "msgpack"
+
+    def dumps(self, value: any) -> bytes:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return str(value).encode()
+
+        if self._msgpack:
+            try:
+                return MSGPACK + msgpack.packb(value, use_bin_type=True, strict_types=True)
+            except (TypeError, ValueError, OverflowError):
+                pass
+
+        return PICKLE + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes | None) -> any:
+        if data is None:
+            return None
+
+        prefix = data[:1]
+        if prefix == MSGPACK:
+            return msgpack.unpackb(data[1:], raw=False, strict_map_key=False)
+        if prefix == PICKLE:
+            try:
+                return pickle.loads(data[1:])
+            except pickle.PickleError:
+                return None
+
+        try:
+            return int(data)
+        except ValueError:
+            return data
+
+
+class CacheCodec(Codec):
+    """Encodes cached responses of proxy views in a dedicated layout.
+
+    A response is stored as its status code, the headers that are passed on to clients
+    and the raw bytes of its body, other values are encoded like by `Codec`.
+
+    Args:
+        allowed_headers (list, optional): The response headers to store, see
+            PROXY_SERVICE_ALLOWED_HEADERS. Defaults to None (all headers).
+        write_format (str, optional): "msgpack" or "pickle". Defaults to "msgpack".
+    """
+
+    def __init__(self, allowed_headers: list = None, write_format: str = "msgpack"):
+        super().__init__(write_format)
+        self._allowed_headers = (
+            None if allowed_headers is None else {header.lower() for header in allowed_headers}
+        )
+
+    def dumps(self, value: any) -> bytes:
+        if self._msgpack and self._is_response(value):
+            return self._dumps_response(*value)
+        return super().dumps(value)
+
+    def loads(self, data: bytes | None) -> any:
+        if data is not None and data[:1] == RESPONSE:
+            return self._loads_response(data)
+        return super().loads(data)
+
+    @staticmethod
+    def _is_response(value: any) -> bool:
+        """Whether the value is a (body, status) or (body, status, headers) tuple."""
+        return (
+            isinstance(value, tuple)
+            and len(value) in (2, 3)
+            and isinstance(value[0], bytes)
+            and isinstance(value[1], int)
+            and 0 <= value[1] <= 0xFFFF
+            and (len(value) == 2 or isinstance(value[2], dict))
+        )
+
+    def _dumps_response(self, body: bytes, status: int, headers: dict = None) -> bytes:
+        if headers is None:
+            header_block = b""
+        else:
+            header_block = "".join(
+                "{0}: {1}\r\n".format(name, value)
+                for name, value in headers.items()
+                if self._allowed_headers is None or name.lower() in self._allowed_headers
+            ).encode("latin-1", "replace")
+            # An empty header dict is told apart from a missing one by its length
+            header_block += b"\r\n"
+
+        return RESPONSE + _RESPONSE_HEADER.pack(status, len(header_block)) + header_block + body
+
+    @staticmethod
+    def _loads_response(data: bytes) -> tuple:
+        status, header_length = _RESPONSE_HEADER.unpack_from(data, 1)
+        start = 1 + _RESPONSE_HEADER.size
+        body = data[start + header_length :]
+        if not header_length:
+            return body, status
+
+        headers = {}
+        for line in data[start : start + header_length - 2].decode("latin-1").split("\r\n"):
+            if line:
+                name, _, value = line.partition(": ")
+                headers[name] = value
+        return body, status, headers
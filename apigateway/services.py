@@ -1,21 +1,28 @@
 """Module defining API Gateway services."""
 
+import atexit
+import collections
 import hashlib
+import itertools
 import json
 import logging
 import math
 import os
+import random
 import re
+import threading
 import time
-from datetime import datetime
+import uuid
+import weakref
+from datetime import datetime, timedelta
 from functools import wraps
 from typing import Callable, Tuple
-from urllib.parse import urljoin
+from urllib.parse import unquote, urljoin
 
 import requests
 from authlib.integrations.flask_oauth2 import current_token, token_authenticated
-from authlib.integrations.sqla_oauth2 import create_bearer_token_validator
-from cachelib.serializers import RedisSerializer
+from blinker import Namespace
+from cachelib import RedisCache
 from flask import Flask, current_app, g, request
 from flask.wrappers import Response
 from flask_caching import Cache
@@ -24,18 +31,64 @@ from flask_limiter.extension import LimitDecorator
 from flask_limiter.util import get_remote_address
 from flask_login import current_user
 from flask_security import Security, SQLAlchemyUserDatastore
-from itsdangerous import URLSafeTimedSerializer
+from flask_security.utils import get_hmac, use_double_hash
+from itsdangerous import BadData, URLSafeTimedSerializer
 from kafka import KafkaProducer
-from redis import Redis, StrictRedis
-from redis.exceptions import ConnectionError, TimeoutError
-from sqlalchemy import func
+from opentelemetry import metrics
+from redis import BlockingConnectionPool, ConnectionPool, Redis, StrictRedis
+from redis.cluster import ClusterNode, RedisCluster
+from redis.exceptions import ConnectionError, LockError, RedisError, TimeoutError
+from redis.sentinel import Sentinel
+from sqlalchemy import Sequence, and_, create_engine, event, exists, false, func, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.datastructures import Headers
 from werkzeug.security import gen_salt
 
 from apigateway import extensions
 from apigateway.exceptions import NoClientError, NotFoundError, ValidationError
-from apigateway.models import AnonymousUser, OAuth2Client, OAuth2Token, Role, User
-from apigateway.utils import GatewayResourceProtector, ProxyView
+from apigateway.models import (
+    AnonymousUser,
+    EmailChangeRequest,
+    OAuth2Client,
+    OAuth2Token,
+    PasswordChangeRequest,
+    Role,
+    User,
+    roles_users,
+)
+from apigateway.serializers import CacheCodec, Codec
+from apigateway.utils import (
+    GatewayBearerTokenValidator,
+    GatewayResourceProtector,
+    MemoryStore,
+    NearCache,
+    PasswordHasher,
+    ProxyView,
+    Spool,
+    TTLCache,
+    delete_batch,
+    hash_id,
+    use_primary,
+)
+
+_redis_signals = Namespace()
+# Sent by the RedisService when Redis becomes unavailable and when it is back up
+redis_down = _redis_signals.signal("redis-down")
+redis_up = _redis_signals.signal("redis-up")
+
+# Connection pools must not be shared by forked workers, see RedisService._after_fork
+_redis_services = weakref.WeakSet()
+
+
+def _reinit_redis_services_after_fork():
+    for redis_service in list(_redis_services):
+        redis_service._after_fork()
+
+
+os.register_at_fork(after_in_child=_reinit_redis_services_after_fork)
 
 
 class GatewayService:
@@ -98,11 +151,99 @@ class AuthService(GatewayService):
         Args:
             app (Flask): The Flask app to initialize the AuthService with.
         """
+        self._validate_partition_config(app)
         super().init_app(app)
-        bearer_cls = create_bearer_token_validator(extensions.db.session, OAuth2Token)
-        self.require_oauth.register_token_validator(bearer_cls())
+        self.require_oauth.register_token_validator(
+            GatewayBearerTokenValidator(extensions.db.session, OAuth2Token)
+        )
+        self._stateless_serializer = URLSafeTimedSerializer(
+            app.config.get("SECRET_KEY"), salt="bootstrap-token"
+        )
+        self._anonymous_user = (None, 0)
+        self._introspection_cache = TTLCache(
+            maxsize=self.get_service_config("INTROSPECTION_CACHE_SIZE", 10000),
+            ttl=self.get_service_config("INTROSPECTION_CACHE_TTL", 30),
+        )
         self._register_hooks(app)
 
+    @staticmethod
+    def _validate_partition_config(app: Flask):
+        """Checks that bootstrap tokens fit into the oauth2token partitions that exist.
+
+        The maintenance worker creates the partitions of today and the next PARTITIONS_AHEAD
+        days, the partition of a new day only up to an hour after midnight. Bootstrap tokens
+        thus have to expire within PARTITIONS_AHEAD - 1 days.
+
+        Args:
+            app (Flask): The Flask app whose config is checked.
+
+        Raises:
+            ValueError: If bootstrap tokens expire after the last partition.
+        """
+        if not app.config.get("BOOTSTRAP_TOKEN_PARTITIONED", False):
+            return
+
+        partitions_ahead = app.config.get("MAINTENANCE_SERVICE_PARTITIONS_AHEAD", 3)
+        if app.config.get("BOOTSTRAP_TOKEN_EXPIRES", 3600 * 24) > (partitions_ahead - 1) * 86400:
+            raise ValueError(
+                "BOOTSTRAP_TOKEN_EXPIRES must not exceed MAINTENANCE_SERVICE_PARTITIONS_AHEAD - 1 "
+                "days when BOOTSTRAP_TOKEN_PARTITIONED is set"
+            )
+
+    @property
+    def anonymous_user_identity(self) -> Tuple[int, str] | None:
+        """The primary key and `fs_uniquifier` of the anonymous bootstrap user.
+
+        The identity is looked up once and then revalidated every ANONYMOUS_BOOTSTRAP_USER_TTL
+        seconds. A missing user is memoized as well, so that `User.is_anonymous_bootstrap_user`
+        does not query the database for every user while it does not exist.
+        """
+        identity, expires_at = self._anonymous_user
+        if expires_at > time.monotonic():
+            return identity
+
+        identity = (
+            extensions.db.session.query(User.id, User.fs_uniquifier)
+            .filter(User.email == self._app.config["ANONYMOUS_BOOTSTRAP_USER_EMAIL"])
+            .first()
+        )
+        if identity is not None:
+            identity = tuple(identity)
+
+        self._anonymous_user = (
+            identity,
+            time.monotonic() + self._app.config.get("ANONYMOUS_BOOTSTRAP_USER_TTL", 300),
+        )
+        return identity
+
+    @property
+    def anonymous_user_id(self) -> int | None:
+        """The primary key of the anonymous bootstrap user, or None if it does not exist."""
+        identity = self.anonymous_user_identity
+        return identity[0] if identity else None
+
+    def load_anonymous_user(self) -> User | None:
+        """Loads the anonymous bootstrap user without querying the database on every call.
+
+        Returns:
+            User | None: The anonymous bootstrap user, or None if it does not exist.
+        """
+        identity = self.anonymous_user_identity
+        if identity is None:
+            return None
+
+        user = extensions.security_service.load_user(identity[1])
+        if user is None:
+            # The user was removed or recreated, look it up again next time
+            self._anonymous_user = (None, 0)
+
+        return user
+
+    @property
+    def stateless_tokens_enabled(self) -> bool:
+        """Whether anonymous bootstrap users receive stateless signed tokens."""
+        return self._app.config.get("BOOTSTRAP_STATELESS_TOKENS", False)
+
     def _register_hooks(self, app: Flask):
         """Registers hooks that manipulates the headers of the request.
 
@@ -131,6 +272,41 @@ class AuthService(GatewayService):
 
         token_authenticated.connect(_token_authenticated, weak=False)
 
+        # Mapper events are global, make sure they are only registered once
+        if not event.contains(User, "before_insert", self._set_user_hashed_id):
+            event.listen(User, "before_insert", self._set_user_hashed_id)
+            event.listen(OAuth2Client, "before_insert", self._set_client_hashed_id)
+            event.listen(OAuth2Client, "after_insert", self._update_client_hashed_id)
+
+    @staticmethod
+    def _set_user_hashed_id(mapper, connection, user: User):
+        if current_app.config.get("PERSIST_HASHED_IDS", False):
+            user.hashed_id = hash_id(user.fs_uniquifier)
+
+    @staticmethod
+    def _set_client_hashed_id(mapper, connection, client: OAuth2Client):
+        # Client ids are hashed by primary key, which is reserved from its sequence so that
+        # the hash is written by the INSERT itself
+        if not current_app.config.get("PERSIST_HASHED_IDS", False):
+            return
+
+        if client.id is None and connection.dialect.supports_sequences:
+            client.id = connection.scalar(select(Sequence("oauth2client_id_seq").next_value()))
+        if client.id is not None:
+            client.hashed_id = hash_id(client.id)
+
+    @staticmethod
+    def _update_client_hashed_id(mapper, connection, client: OAuth2Client):
+        # Databases without sequences only assign the primary key on insert
+        if current_app.config.get("PERSIST_HASHED_IDS", False) and client.hashed_id is None:
+            hashed_id = hash_id(client.id)
+            connection.execute(
+                OAuth2Client.__table__.update()
+                .where(OAuth2Client.__table__.c.id == client.id)
+                .values(hashed_id=hashed_id)
+            )
+            set_committed_value(client, "hashed_id", hashed_id)
+
     def load_client(self, client_id: str) -> Tuple[OAuth2Client, OAuth2Token]:
         """Loads the OAuth2Client and OAuth2Token for the given client_id.
 
@@ -187,15 +363,12 @@ class AuthService(GatewayService):
 
         client_name = client_name or self._app.config.get("BOOTSTRAP_CLIENT_NAME", "BB client")
 
-        clients = (
-            OAuth2Client.query.filter_by(user_id=current_user.get_id())
+        client = (
+            OAuth2Client.query.filter_by(user_id=current_user.get_id(), client_name=client_name)
             .order_by(OAuth2Client.client_id_issued_at.desc())
-            .all()
+            .first()
         )
 
-        # Metadata is a computed property so we need to filter after the query
-        client = next((c for c in clients if c.client_name == client_name), None)
-
         if client is None or create_client:
             self._validate_ratelimit(ratelimit_multiplier)
             self._validate_scopes(scope)
@@ -241,9 +414,95 @@ class AuthService(GatewayService):
 
         return client, token
 
-    def bootstrap_anonymous_user(self) -> Tuple[OAuth2Client, OAuth2Token]:
+    def get_cached_bootstrap_response(
+        self, user_id: str, client_name: str
+    ) -> Tuple[dict | None, str | None]:
+        """Returns the cached bootstrap response of a user's client, if any.
+
+        Args:
+            user_id (str): The ID of the user.
+            client_name (str): The name of the client.
+
+        Returns:
+            Tuple[dict | None, str | None]: The serialized bootstrap response, or None on a
+                cache miss, and the user's current cache version, which a new response of
+                the client is to be cached with.
+        """
+        if not self._app.config.get("BOOTSTRAP_CACHE_TIMEOUT", 0):
+            return None, None
+
+        version, entry = extensions.storage_service.get_many(
+            [self._bootstrap_cache_key(user_id), self._bootstrap_cache_key(user_id, client_name)]
+        )
+        if entry is None or entry["version"] != version:
+            return None, version
+
+        return entry["response"], version
+
+    def cache_bootstrap_response(
+        self, user_id: str, client_name: str, response: dict, version: str, expires_at: int = 0
+    ):
+        """Caches the serialized bootstrap response of a user's client.
+
+        Every client's response is stored under a key of its own that never outlives the
+        token it contains. Responses are tagged with the user's cache version read before
+        the response was built, so that a response built while the user's cache was
+        invalidated is stale, see `invalidate_bootstrap_cache`.
+
+        Args:
+            user_id (str): The ID of the user.
+            client_name (str): The name of the client.
+            response (dict): The serialized bootstrap response.
+            version (str): The cache version returned by `get_cached_bootstrap_response`.
+            expires_at (int, optional): The expiration time of the token. Defaults to 0 (never).
+        """
+        timeout = self._app.config.get("BOOTSTRAP_CACHE_TIMEOUT", 0)
+        if expires_at:
+            timeout = min(timeout, int(expires_at - time.time()))
+
+        if timeout <= 0:
+            return
+
+        extensions.storage_service.set(
+            self._bootstrap_cache_key(user_id, client_name),
+            {"version": version, "response": response},
+            timeout=timeout,
+        )
+
+    def invalidate_bootstrap_cache(self, user_id: str):
+        """Makes all cached bootstrap responses of a user stale.
+
+        Must be called whenever one of the user's clients or tokens, or the user
+        details included in the response, change.
+
+        Stores a new cache version for the user instead of deleting the responses one by
+        one. The version lives as long as any response can, so responses cached before
+        the user's first invalidation, which have no version, expire before it does.
+
+        Args:
+            user_id (str): The ID of the user.
+        """
+        timeout = self._app.config.get("BOOTSTRAP_CACHE_TIMEOUT", 0)
+        if timeout > 0:
+            extensions.storage_service.set(
+                self._bootstrap_cache_key(user_id), uuid.uuid4().hex, timeout=timeout
+            )
+
+    def _bootstrap_cache_key(self, user_id: str, client_name: str = None) -> str:
+        # The hash tag keeps the keys of a user in the same Redis Cluster slot
+        key = f"{self._name}//bootstrap/{{{user_id}}}"
+        return key if client_name is None else f"{key}/{client_name}"
+
+    def bootstrap_anonymous_user(self, client_id: str = None) -> Tuple[OAuth2Client, OAuth2Token]:
         """Bootstraps an anonymous user with an OAuth2Client and OAuth2Token.
 
+        When stateless tokens are enabled nothing is written to the database; the client
+        and token are built in memory and the token is a signed, self-contained string.
+
+        Args:
+            client_id (str, optional): The client ID to reuse for a stateless token. A new one
+                is generated if not provided. Ignored when stateless tokens are disabled.
+
         Raises:
             ValidationError: If the current user is not an anonymous bootstrap user.
 
@@ -253,6 +512,9 @@ class AuthService(GatewayService):
         if not current_user.is_anonymous_bootstrap_user:
             raise ValidationError("Only anonymous bootstrap user can create temporary tokens")
 
+        if self.stateless_tokens_enabled:
+            return self._create_stateless_token(client_id)
+
         client = OAuth2Client(
             user_id=current_user.get_id(),
             last_activity=datetime.now(),
@@ -276,6 +538,228 @@ class AuthService(GatewayService):
 
         return client, token
 
+    def load_token(self, access_token: str) -> OAuth2Token | None:
+        """Resolves an access token the same way bearer tokens of requests are resolved.
+
+        Args:
+            access_token (str): The access token.
+
+        Returns:
+            OAuth2Token | None: The token, or None if it does not exist.
+        """
+        return self.require_oauth.get_token_validator("bearer").authenticate_token(access_token)
+
+    def introspect_token(self, access_token: str) -> Tuple[dict, int]:
+        """Describes an access token in the format of an RFC 7662 introspection response.
+
+        Responses are cached per process for AUTH_SERVICE_INTROSPECTION_CACHE_TTL seconds.
+        Tokens that expire sooner than that are not cached.
+
+        Args:
+            access_token (str): The access token.
+
+        Returns:
+            Tuple[dict, int]: The introspection response and the number of seconds it may be cached.
+        """
+        responses, max_age = self.introspect_tokens([access_token])
+        return responses[0], max_age
+
+    def introspect_tokens(self, access_tokens: list) -> Tuple[list, int]:
+        """Describes a list of access tokens, see `introspect_token`.
+
+        Database tokens that are not cached are loaded with a single query. Tokens that the
+        replica does not have yet are looked up on the primary, tokens that are not found
+        at all are neither cached nor may callers cache them.
+
+        Args:
+            access_tokens (list): The access tokens.
+
+        Returns:
+            Tuple[list, int]: The introspection responses in input order and the number of
+                seconds all of them may be cached.
+        """
+        ttl = self.get_service_config("INTROSPECTION_CACHE_TTL", 30)
+        results = {}
+        cached_tokens = set()
+        missing = []
+
+        for access_token in access_tokens:
+            cached = self._introspection_cache.get(access_token)
+            if cached is not None:
+                response, cached_until = cached
+                results[access_token] = response, max(0, int(cached_until - time.time()))
+                cached_tokens.add(access_token)
+                continue
+
+            token = self.load_stateless_token(access_token)
+            if token is not None:
+                results[access_token] = self._introspection(token, ttl)
+            else:
+                missing.append(access_token)
+
+        if missing:
+            self._introspect_database_tokens(missing, results, ttl)
+            missing = [access_token for access_token in missing if access_token not in results]
+        if missing:
+            # Tokens created moments ago may not have reached the replica yet
+            with use_primary():
+                self._introspect_database_tokens(missing, results, ttl)
+            missing = [access_token for access_token in missing if access_token not in results]
+
+        for access_token in missing:
+            results[access_token] = ({"active": False}, 0)
+
+        now = time.time()
+        for access_token, (response, max_age) in results.items():
+            if max_age >= ttl and access_token not in cached_tokens:
+                self._introspection_cache.set(access_token, (response, now + max_age))
+
+        responses = [results[access_token] for access_token in access_tokens]
+        return [response for response, _ in responses], min(max_age for _, max_age in responses)
+
+    def _introspect_database_tokens(self, access_tokens: list, results: dict, ttl: int):
+        tokens = OAuth2Token.query.options(
+            joinedload(OAuth2Token.user), joinedload(OAuth2Token.client)
+        ).filter(OAuth2Token.access_token_filter(access_tokens))
+        for token in tokens:
+            results[token.access_token] = self._introspection(token, ttl)
+
+    def invalidate_introspection(self, access_token: str):
+        """Removes a token from the introspection cache of this process.
+
+        Args:
+            access_token (str): The access token.
+        """
+        self._introspection_cache.pop(access_token)
+
+    def _introspection(self, token: OAuth2Token, ttl: int) -> Tuple[dict, int]:
+        if token.is_revoked() or token.is_expired():
+            return {"active": False}, ttl
+
+        expires_at = token.expires_at()
+        max_age = ttl if not expires_at else max(0, min(ttl, expires_at - int(time.time())))
+
+        return {
+            "active": True,
+            "scope": token.get_scope() or "",
+            "client_id": token.client.client_id if token.client else None,
+            "username": token.user.email if token.user else None,
+            "sub": token.user_id,
+            "token_type": "Bearer",
+            "iat": token.issued_at,
+            "exp": expires_at or None,
+            "anonymous": token.user.is_anonymous_bootstrap_user if token.user else None,
+        }, max_age
+
+    def load_stateless_token(self, access_token: str) -> OAuth2Token | None:
+        """Decodes and verifies a stateless anonymous bootstrap token.
+
+        Tokens are accepted even if stateless tokens have since been disabled, so that
+        switching the mode off does not invalidate tokens that were already handed out.
+
+        Args:
+            access_token (str): The access token to verify.
+
+        Returns:
+            OAuth2Token | None: An in-memory token, or None if the string is not a valid
+                stateless token.
+        """
+        # Database tokens are plain salts and never contain the serializer's separator
+        if not access_token or "." not in access_token:
+            return None
+
+        try:
+            payload, issued_at = self._stateless_serializer.loads(
+                access_token,
+                max_age=self._app.config.get("BOOTSTRAP_TOKEN_EXPIRES", 3600 * 24),
+                return_timestamp=True,
+            )
+        except BadData:
+            return None
+
+        user = extensions.security_service.load_user(payload["uid"])
+
+        return self._build_stateless_token(
+            access_token, payload, int(issued_at.timestamp()), user
+        )
+
+    def _create_stateless_token(self, client_id: str = None) -> Tuple[OAuth2Client, OAuth2Token]:
+        """Creates a stateless client and token for the current anonymous user.
+
+        Args:
+            client_id (str, optional): The client ID to embed in the token. Defaults to a new random ID.
+
+        Returns:
+            Tuple[OAuth2Client, OAuth2Token]: The in-memory client and token.
+        """
+        salt_length = self._app.config.get("OAUTH2_CLIENT_ID_SALT_LEN", 40)
+
+        payload = {
+            "cid": client_id or gen_salt(salt_length),
+            "uid": current_user.get_id(),
+            "scope": " ".join(self._app.config.get("BOOTSTRAP_SCOPES", "")),
+        }
+        access_token = self._stateless_serializer.dumps(payload)
+        _, issued_at = self._stateless_serializer.loads(access_token, return_timestamp=True)
+
+        token = self._build_stateless_token(
+            access_token, payload, int(issued_at.timestamp()), current_user._get_current_object()
+        )
+
+        return token.client, token
+
+    def _build_stateless_token(
+        self, access_token: str, payload: dict, issued_at: int, user: User
+    ) -> OAuth2Token:
+        """Builds the in-memory OAuth2Client and OAuth2Token for a stateless token payload.
+
+        The objects are never added to the database session. The random client ID from the
+        payload is the `client_id` of the client and the `stateless_client_id` of the token,
+        which is what rate limiting and request logging key on. The token's `client_id`
+        stays empty, as there is no client row for it to reference.
+
+        Args:
+            access_token (str): The signed access token.
+            payload (dict): The decoded token payload.
+            issued_at (int): The time the token was signed, in seconds since the epoch.
+            user (User): The anonymous bootstrap user.
+
+        Returns:
+            OAuth2Token: The token, with its client and user attached.
+        """
+        client = OAuth2Client(
+            user_id=payload["uid"],
+            client_id=payload["cid"],
+            client_id_issued_at=issued_at,
+            ratelimit_multiplier=1.0,
+        )
+        client.set_client_metadata(
+            {
+                "client_name": self._app.config.get("BOOTSTRAP_CLIENT_NAME", "BB client"),
+                "description": "Anonymous client",
+                "scope": payload["scope"],
+            }
+        )
+
+        token = OAuth2Token(
+            token_type="bearer",
+            user_id=payload["uid"],
+            access_token=access_token,
+            scope=payload["scope"],
+            issued_at=issued_at,
+            expires_in=self._app.config.get("BOOTSTRAP_TOKEN_EXPIRES", 3600 * 24),
+            access_token_revoked_at=0,
+            refresh_token_revoked_at=0,
+        )
+        token.is_stateless = True
+        token.stateless_client_id = payload["cid"]
+
+        # Attach without history so the objects are never cascaded into the session
+        set_committed_value(token, "client", client)
+        set_committed_value(token, "user", user)
+
+        return token
+
     def _create_user_token(
         self,
         client: OAuth2Client,
@@ -321,15 +805,33 @@ class AuthService(GatewayService):
 
         salt_length = self._app.config.get("OAUTH2_CLIENT_ID_SALT_LEN", 40)
         expires_in: int = self._app.config.get("BOOTSTRAP_TOKEN_EXPIRES", 3600 * 24)
+        issued_at = int(time.time())
+        access_token = gen_salt(salt_length)
+        partition_day = 0
+
+        if self._app.config.get("BOOTSTRAP_TOKEN_PARTITIONED", False):
+            # Stored in the daily partition of its expiry, the day prefixes the token so
+            # that lookups only have to probe that partition. Tokens that expire after the
+            # last partition the maintenance worker surely created are stored permanently
+            last_day = (
+                issued_at // 86400
+                + self._app.config.get("MAINTENANCE_SERVICE_PARTITIONS_AHEAD", 3)
+                - 1
+            )
+            if (issued_at + expires_in) // 86400 <= last_day:
+                partition_day = (issued_at + expires_in) // 86400
+                access_token = "{}-{}".format(partition_day, access_token)
 
         return OAuth2Token(
             token_type="bearer",
             client_id=client.id,
             user_id=client.user_id,
-            access_token=gen_salt(salt_length),
+            access_token=access_token,
             refresh_token=gen_salt(salt_length),
             scope=client.scope,
+            issued_at=issued_at,
             expires_in=expires_in,
+            partition_day=partition_day,
         )
 
     def _validate_ratelimit(self, requested_ratelimit: float):
@@ -385,8 +887,14 @@ class ProxyService(GatewayService):
         self.allowed_headers = self.get_service_config("ALLOWED_HEADERS", [])
 
         services = self.get_service_config("WEBSERVICES", {})
+        resource_documents, errors = self._fetch_resource_documents(list(services))
         for url, deploy_path in services.items():
-            self.register_service(url, deploy_path)
+            if url in errors:
+                self._logger.error(
+                    "Could not fetch resource document for %s: %s", url, errors[url]
+                )
+                continue
+            self.register_service(url, deploy_path, resource_json=resource_documents[url])
 
         self._register_hooks(self._app)
 
@@ -412,21 +920,29 @@ class ProxyService(GatewayService):
 
             return response
 
-    def register_service(self, base_url: str, deploy_path: str, csrf_exempt: bool = True):
+    def register_service(
+        self,
+        base_url: str,
+        deploy_path: str,
+        csrf_exempt: bool = True,
+        resource_json: dict = None,
+    ):
         """Registers a single service with the Flask application
 
         Args:
             base_url (str): The base URL of the service.
             deploy_path (str): The deployment path of the service
             csrf_exempt (bool, optional): Whether to exempt the services from CSRF protection. Defaults to True.
+            resource_json (dict, optional): The resource document of the service, fetched if not given.
         """
         self._logger.info("Registering service %s at %s", base_url, deploy_path)
 
-        try:
-            resource_json = self._fetch_resource_document(base_url)
-        except requests.exceptions.RequestException as ex:
-            self._logger.error("Could not fetch resource document for %s: %s", base_url, ex)
-            return
+        if resource_json is None:
+            try:
+                resource_json = self._fetch_resource_document(base_url)
+            except requests.exceptions.RequestException as ex:
+                self._logger.error("Could not fetch resource document for %s: %s", base_url, ex)
+                return
 
         self._logger.info("Discovered %s endpoints:", deploy_path)
         for remote_path, properties in resource_json.items():
@@ -496,21 +1012,55 @@ class ProxyService(GatewayService):
             A dictionary containing the resource document.
         """
 
-        resource_url = urljoin(base_url, self.get_service_config("RESOURCE_ENDPOINT", "/"))
+        resource_documents, errors = self._fetch_resource_documents([base_url])
+        if base_url in errors:
+            raise errors[base_url]
 
-        try:
-            timeout = self.get_service_config("RESOURCE_TIMEOUT", 5)
-            response = requests.get(resource_url, timeout=timeout)
-            response.raise_for_status()
-
-            extensions.storage_service.set(resource_url, response.json())
-            return response.json()
-        except requests.exceptions.RequestException as ex:
-            if extensions.storage_service.has(resource_url):
-                self._logger.info("Using cached resource document for %s", resource_url)
-                return extensions.storage_service.get(resource_url)
-            else:
-                raise ex
+        return resource_documents[base_url]
+
+    def _fetch_resource_documents(self, base_urls: list) -> Tuple[dict, dict]:
+        """
+        Fetches the resource documents of several services.
+
+        Fetched documents are stored in a single round-trip. The stored documents of services
+        that could not be reached are read in a single round-trip as well.
+
+        Args:
+            base_urls (list): The base URLs of the services.
+
+        Returns:
+            Tuple[dict, dict]: The resource documents and the errors of services without one,
+                both by base URL.
+        """
+        resource_endpoint = self.get_service_config("RESOURCE_ENDPOINT", "/")
+        timeout = self.get_service_config("RESOURCE_TIMEOUT", 5)
+        resource_urls = {base_url: urljoin(base_url, resource_endpoint) for base_url in base_urls}
+
+        resource_documents, errors = {}, {}
+        for base_url, resource_url in resource_urls.items():
+            try:
+                response = requests.get(resource_url, timeout=timeout)
+                response.raise_for_status()
+                resource_documents[base_url] = response.json()
+            except requests.exceptions.RequestException as ex:
+                errors[base_url] = ex
+
+        if resource_documents:
+            extensions.storage_service.set_many(
+                {resource_urls[url]: document for url, document in resource_documents.items()}
+            )
+
+        if errors:
+            cached = extensions.storage_service.get_many([resource_urls[url] for url in errors])
+            for base_url, document in zip(list(errors), cached):
+                if document is not None:
+                    self._logger.info(
+                        "Using cached resource document for %s", resource_urls[base_url]
+                    )
+                    resource_documents[base_url] = document
+                    del errors[base_url]
+
+        return resource_documents, errors
 
 
 class LimiterService(GatewayService, Limiter):
@@ -529,12 +1079,15 @@ class LimiterService(GatewayService, Limiter):
             name (str, optional): The name of the service. Defaults to "LIMITER_SERVICE".
         """
         GatewayService.__init__(self, name)
+        # The Redis deployment of the storage, whose failures are reported to redis_service
+        self._redis_service = None
+        self._storage_url = None
         Limiter.__init__(
             self, key_func=self._key_func, in_memory_fallback_enabled=True, auto_check=False
         )
         self._symbolic_ratelimits = {}
 
-    def init_app(self, app: Flask):
+    def init_app(self, app: Flask, redis_service: "RedisService" = None):
         """Initializes the service with the specified Flask application.
 
         This method initializes the service with the specified Flask application by setting default
@@ -542,10 +1095,25 @@ class LimiterService(GatewayService, Limiter):
 
         Args:
             app (Flask): The Flask application to initialize the service with.
+            redis_service (RedisService, optional): The service whose connection pool a Redis
+                storage uses and whose outages switch to the in-memory fallback. Defaults to
+                None (a pool of its own).
         """
         GatewayService.init_app(self, app)
 
         app.config.setdefault("RATELIMIT_STORAGE_URI", self.get_service_config("STORAGE_URI"))
+        storage_uri = app.config["RATELIMIT_STORAGE_URI"] or ""
+        if redis_service is not None and storage_uri.startswith("redis"):
+            self._redis_service = redis_service
+            self._storage_url = storage_uri
+        if redis_service is not None and storage_uri.startswith(("redis://", "rediss://")):
+            app.config.setdefault(
+                "RATELIMIT_STORAGE_OPTIONS",
+                {"connection_pool": redis_service.get_connection_pool(storage_uri)},
+            )
+        elif redis_service is not None and storage_uri.startswith("redis+"):
+            # The storages of limits connect to sentinels and clusters themselves
+            app.config.setdefault("RATELIMIT_STORAGE_OPTIONS", redis_service.connection_options())
         app.config.setdefault("RATELIMIT_STRATEGY", self.get_service_config("STRATEGY"))
         app.config.setdefault(
             "RATELIMIT_HEADERS_ENABLED", self.get_service_config("HEADERS_ENABLED", True)
@@ -557,6 +1125,32 @@ class LimiterService(GatewayService, Limiter):
 
         self._register_hooks(app)
 
+        # Switch to and from the in-memory fallback together with the other consumers of the
+        # deployment, instead of waiting for a rate limit check to fail or the storage check
+        # to succeed
+        if self._redis_service is not None:
+            redis_down.connect(self._on_redis_down, sender=redis_service, weak=False)
+            redis_up.connect(self._on_redis_up, sender=redis_service, weak=False)
+
+    @property
+    def _storage_dead(self) -> bool:
+        return self._storage_down
+
+    @_storage_dead.setter
+    def _storage_dead(self, dead: bool):
+        # Flask-Limiter marks its storage dead when a rate limit check fails
+        if dead and self._redis_service is not None:
+            self._redis_service.report_failure(url=self._storage_url)
+        self._storage_down = dead
+
+    def _on_redis_down(self, sender, url: str = None, **kwargs):
+        if url == self._storage_url and self._in_memory_fallback_enabled:
+            self._storage_dead = True
+
+    def _on_redis_up(self, sender, url: str = None, **kwargs):
+        if url == self._storage_url:
+            self._storage_dead = False
+
     def _register_hooks(self, app: Flask):
         """Registers hooks for tracking request processing time.
 
@@ -571,7 +1165,10 @@ class LimiterService(GatewayService, Limiter):
             g.request_start_time = time.time()
 
         def _token_authenticated(sender, token=None, **kwargs):
-            client = OAuth2Client.query.filter_by(id=token.client_id).first()
+            if token.is_stateless:
+                client = token.client
+            else:
+                client = OAuth2Client.query.filter_by(id=token.client_id).first()
             level = getattr(client, "ratelimit", 1.0) if client else 0.0
             headers = Headers(request.headers.items())
             headers.add_header("X-Adsws-Ratelimit-Level", str(level))
@@ -659,12 +1256,8 @@ class LimiterService(GatewayService, Limiter):
                 self._logger.info("Clearing limit for key %s", key)
                 self.storage.clear(key)
 
-            extensions.storage_service.delete(
-                f"{self._name}//{self._key_func(request_endpoint)}/time"
-            )
-            extensions.storage_service.delete(
-                f"{self._name}//{self._key_func(request_endpoint)}/count"
-            )
+            key = self._baseline_key(request_endpoint)
+            extensions.storage_service.delete_many([f"{key}/total", f"{key}/requests"])
 
     def _limit_and_check(
         self,
@@ -751,20 +1344,12 @@ class LimiterService(GatewayService, Limiter):
             int: The cost for the rate limit.
         """
 
-        self._calc_new_mean_time()
+        request_count, request_mean_time = self._calc_new_mean_time()
 
         if self.get_service_config("SCALING_COST_ENABLED", False):
 
-            request_count = float(
-                extensions.storage_service.get(f"{self._name}//{self._key_func()}/count") or 0
-            )
-
             if request_count > self.get_service_config("SCALING_COST_THRESHOLD", 100):
 
-                request_mean_time = float(
-                    extensions.storage_service.get(f"{self._name}//{self._key_func()}/time") or 0
-                )
-
                 request_time = getattr(g, "processing_time", 0)
 
                 if request_time <= request_mean_time:
@@ -783,21 +1368,33 @@ class LimiterService(GatewayService, Limiter):
 
         return 1
 
-    def _calc_new_mean_time(self):
-        processing_time: float = max(0.0, time.time() - g.request_start_time)
+    def _calc_new_mean_time(self) -> Tuple[int, float]:
+        """Adds the processing time of the request to the mean processing time of its key.
 
-        key_time: str = f"{self._name}//{self._key_func()}/time"
-        key_count: str = f"{self._name}//{self._key_func()}/count"
+        The total processing time and the number of requests are incremented in a single
+        round-trip, so that concurrent requests never overwrite each other's times.
 
-        existing_time: float = float(extensions.storage_service.get(key_time) or 0)
-        request_count: int = int(extensions.storage_service.get(key_count) or 0)
+        Returns:
+            Tuple[int, float]: The number of requests and their mean processing time.
+        """
+        processing_time: float = max(0.0, time.time() - g.request_start_time)
 
-        new_mean_time = ((existing_time * request_count) + processing_time) / (request_count + 1)
+        key_total: str = f"{self._baseline_key()}/total"
+        key_count: str = f"{self._baseline_key()}/requests"
 
-        extensions.storage_service.set(key_time, new_mean_time)
-        extensions.storage_service.set(key_count, request_count + 1)
+        total_time, request_count = extensions.storage_service.incr_many(
+            {key_total: processing_time, key_count: 1}
+        )
 
         g.processing_time = processing_time
+        return int(request_count), float(total_time) / int(request_count)
+
+    def _baseline_key(self, request_endpoint=None) -> str:
+        """Returns the prefix of the keys of the mean processing time of a rate limit.
+
+        The hash tag keeps the keys of a rate limit in the same Redis Cluster slot.
+        """
+        return f"{self._name}//{{{self._key_func(request_endpoint)}}}"
 
     def _key_func(self, request_endpoint=None) -> str:
         """Returns the key for the rate limit.
@@ -828,7 +1425,7 @@ class LimiterService(GatewayService, Limiter):
         """
         if current_token:
             return "{email}:{client}".format(
-                email=current_token.user.email, client=current_token.client_id
+                email=current_token.user.email, client=current_token.get_client_key()
             )
 
         elif current_user.is_authenticated and not current_user.is_anonymous_bootstrap_user:
@@ -841,6 +1438,18 @@ class LimiterService(GatewayService, Limiter):
 class RedisService(GatewayService):
     """A service class for interacting with a Redis database.
 
+    The service owns the availability of every Redis deployment that its consumers use.
+    Consumers report failed operations on a deployment with `report_failure` and check
+    `is_available` before using it, a background prober per deployment pings it with
+    exponential backoff and jitter until it responds again. Changes are sent as the
+    `redis_down` and `redis_up` signals, with the URL of the deployment.
+
+    The service also owns the connections of every Redis consumer, the limiter and cache
+    storages included. Each Redis deployment, a logical database of a server, a primary
+    monitored by sentinels or a cluster, has one client per process, with at most
+    MAX_CONNECTIONS connections per server and the configured timeouts and health checks.
+    Forked workers drop the pools that they inherit and open their own connections.
+
     Args:
         name (str): The name of the service.
         strict (bool): Whether to use strict Redis or not.
@@ -850,112 +1459,756 @@ class RedisService(GatewayService):
 
     def __init__(self, name: str = "REDIS_SERVICE", strict: bool = True, **kwargs):
         super().__init__(name)
+        self.url = None
         self._redis_client = None
         self._provider_class = StrictRedis if strict else Redis
         self._provider_kwargs = kwargs
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        _redis_services.add(self)
+        # The time of the first failure of every deployment that is down, by URL
+        self._down_since = {}
+        self._probers = {}
+        self._state_lock = threading.Lock()
+
+        meter = metrics.get_meter(__name__)
+        self._state_changes = meter.create_counter(
+            "gateway.redis.state_changes",
+            description="Transitions of Redis between available and unavailable",
+        )
+        self._probes = meter.create_counter(
+            "gateway.redis.probes", description="Pings sent by the Redis health prober"
+        )
+        self._outage_duration = meter.create_histogram(
+            "gateway.redis.outage_duration",
+            unit="s",
+            description="Time from the first failure until Redis responded again",
+        )
 
     def init_app(self, app: Flask):
         super().init_app(app)
 
-        redis_url = self.get_service_config("URL", "redis://redis:6379/0")
-        self._redis_client = self._provider_class.from_url(redis_url, **self._provider_kwargs)
+        self.url = self.get_service_config("URL", "redis://redis:6379/0")
+        self._redis_client = self.get_client()
+        self._probe_min_interval = self.get_service_config("PROBE_MIN_INTERVAL", 0.5)
+        self._probe_max_interval = self.get_service_config("PROBE_MAX_INTERVAL", 30)
+
+    @property
+    def available(self) -> bool:
+        """Whether the deployment of URL is considered available."""
+        return self.is_available()
 
-    def alive(self) -> bool:
-        """Checks if the Redis database is alive.
+    def is_available(self, url: str = None) -> bool:
+        """Checks whether a Redis deployment is considered available, without contacting it.
+
+        Args:
+            url (str, optional): The URL of the deployment. Defaults to URL.
 
         Returns:
-            bool: True if the Redis database is alive, False otherwise.
+            bool: False from a reported failure until the deployment responds again.
         """
-        try:
-            return self._redis_client.ping()
-        except:  # noqa
-            return False
+        return (url or self.url) not in self._down_since
 
-    def get_connection_pool(self):
-        if self._redis_client:
-            return self._redis_client.connection_pool
-        else:
-            return None
+    def report_failure(self, ex: Exception = None, url: str = None):
+        """Marks a Redis deployment as unavailable and starts its health prober.
 
-    def __getattr__(self, name):
-        return getattr(self._redis_client, name, None)
+        Args:
+            ex (Exception, optional): The error that the failed operation raised.
+            url (str, optional): The URL of the deployment. Defaults to URL.
+        """
+        url = url or self.url
+        with self._state_lock:
+            if url in self._down_since:
+                return
+
+            self._down_since[url] = time.monotonic()
+            self._start_prober(url)
+
+        self._logger.warning("Redis %s is down: %s", self._location(url), ex)
+        self._state_changes.add(1, {"state": "down"})
+        redis_down.send(self, exception=ex, url=url)
+
+    def _start_prober(self, url: str):
+        # Started on demand, so that forked workers start their own prober
+        self._probers[url] = threading.Thread(
+            target=self._probe, args=(url,), name="redis-health-prober", daemon=True
+        )
+        self._probers[url].start()
 
-    def __getitem__(self, name):
-        return self._redis_client[name]
+    @staticmethod
+    def _location(url: str) -> str:
+        # The hosts of a deployment, without its credentials
+        return url.rpartition("@")[2]
 
-    def __setitem__(self, name, value):
-        self._redis_client[name] = value
+    def _after_fork(self):
+        """Resets the connection pools and the probers in a forked worker.
 
-    def __delitem__(self, name):
-        del self._redis_client[name]
+        The connections of the parent are left open for the parent, the locks may have been
+        held by threads that do not exist in the worker.
+        """
+        self._clients_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        for client in self._clients.values():
+            if isinstance(client, RedisCluster):
+                for node in client.get_nodes():
+                    if node.redis_connection is not None:
+                        node.redis_connection.connection_pool.reset()
+            else:
+                client.connection_pool.reset()
 
+        for url in list(self._down_since):
+            self._start_prober(url)
 
-class StorageService(GatewayService):
-    """A service class for interacting with storage.
+    def connection_options(self) -> dict:
+        """Returns the timeouts and health checks of the connections to Redis."""
+        return {
+            "socket_timeout": self.get_service_config("SOCKET_TIMEOUT", 5),
+            "socket_connect_timeout": self.get_service_config("CONNECT_TIMEOUT", 2),
+            "health_check_interval": self.get_service_config("HEALTH_CHECK_INTERVAL", 30),
+            **self._provider_kwargs,
+        }
 
-    This class provides methods for setting, getting, deleting, and incrementing values in storage.
-    It supports both Redis storage and fallbacks to memory storage in case Redis is down.
-    """
+    def get_client(self, url: str = None) -> Redis | RedisCluster:
+        """Returns the client of a Redis deployment, creating it on first use.
 
-    def __init__(self, name: str = "STORAGE_SERVICE"):
-        super().__init__(name)
-        self._fallback_storage: dict = {}
+        Besides the redis:// URLs of a single server, the URL can name the sentinels that
+        monitor a primary, redis+sentinel://[:password@]host:port[,host:port]/service/db,
+        or nodes of a cluster, redis+cluster://[:password@]host:port[,host:port].
 
-    def init_app(self, app: Flask, redis_service: RedisService):
-        super().init_app(app)
-        self._redis_service = redis_service
-        self._redis_down = False
-        self._serializer = RedisSerializer()
+        Args:
+            url (str, optional): The URL of the deployment. Defaults to URL.
 
-    def _serialize(self, value: any) -> str | bytes:
-        """Serializes the given value.
+        Returns:
+            Redis | RedisCluster: The client, which is shared by all callers.
+        """
+        url = url or self.url
+        with self._clients_lock:
+            client = self._clients.get(url)
+            if client is None:
+                client = self._clients[url] = self._create_client(url)
+        return client
+
+    def _create_client(self, url: str) -> Redis | RedisCluster:
+        options = self.connection_options()
+        max_connections = self.get_service_config("MAX_CONNECTIONS", 50)
+        scheme, _, location = url.partition("://")
+        credentials, _, location = location.rpartition("@")
+        password = unquote(credentials.partition(":")[2]) or None
+        hosts, _, path = location.partition("/")
+        nodes = []
+        for node in hosts.split(","):
+            host, _, port = node.rpartition(":")
+            nodes.append((host, int(port)))
+
+        if scheme == "redis+sentinel":
+            service_name, _, db = path.partition("/")
+            sentinel = Sentinel(
+                nodes,
+                sentinel_kwargs={
+                    "socket_timeout": options["socket_timeout"],
+                    "socket_connect_timeout": options["socket_connect_timeout"],
+                    "password": password,
+                },
+                password=password,
+                db=int(db or 0),
+                max_connections=max_connections,
+                **options,
+            )
+            return sentinel.master_for(service_name, redis_class=self._provider_class)
+
+        if scheme == "redis+cluster":
+            # Replies of cluster nodes are not health checked by redis-py
+            options.pop("health_check_interval")
+            return RedisCluster(
+                startup_nodes=[ClusterNode(host, port) for host, port in nodes],
+                password=password,
+                max_connections=max_connections,
+                **options,
+            )
+
+        pool = BlockingConnectionPool.from_url(
+            url,
+            max_connections=max_connections,
+            timeout=self.get_service_config("POOL_TIMEOUT", 1),
+            **options,
+        )
+        return self._provider_class(connection_pool=pool)
+
+    def get_connection_pool(self, url: str = None) -> ConnectionPool | None:
+        """Returns the connection pool of a Redis deployment.
 
         Args:
-            value (any): The value to serialize.
+            url (str, optional): The URL of the deployment. Defaults to URL.
 
         Returns:
-            str | bytes: The serialized value.
+            ConnectionPool | None: The pool, None for a cluster, which has a pool per node.
         """
-        if isinstance(value, (int, float, str)):
-            return str(value)
-        else:
-            return self._serializer.dumps(value)
+        return getattr(self.get_client(url), "connection_pool", None)
 
-    def _transfer_to_redis(self):
-        """
-        Transfers the data from the fallback storage to Redis.
+    @property
+    def is_cluster(self) -> bool:
+        return isinstance(self._redis_client, RedisCluster)
 
-        This method iterates over the items in the fallback storage and transfers them to Redis.
-        After the transfer is complete, the fallback storage is cleared.
+    def _probe(self, url: str):
+        """Pings a deployment until it responds, waiting exponentially longer between pings.
+
+        Args:
+            url (str): The URL of the deployment.
         """
-        for key, value in self._fallback_storage.items():
-            if isinstance(value, dict):
-                value = json.dumps(value)
-            self._redis_service.set(key, self._serialize(value))
-        self._fallback_storage.clear()
+        for attempt in itertools.count():
+            delay = min(self._probe_max_interval, self._probe_min_interval * 2**attempt)
+            # Randomized so that the workers of all nodes do not ping in lockstep
+            time.sleep(random.uniform(delay / 2, delay))
 
-    def handle_redis_exception(func):
-        def wrapper(self, *args, **kwargs):
-            if self._redis_down and self._redis_service.alive():
-                self._redis_down = False
-                self._logger.info("Redis is back up, transferring data from fallback storage")
-                self._transfer_to_redis()
+            if self.alive(url):
+                self._probes.add(1, {"result": "success"})
+                break
 
-            try:
-                return func(self, *args, **kwargs)
-            except (ConnectionError, TimeoutError):
-                self._redis_down = True
-                self._logger.warning("Redis is down, falling back to local storage")
-                return func(self, *args, **kwargs)
-            except Exception as ex:
-                self._logger.error("Failed to handle Redis exception", ex)
-                raise
+            self._probes.add(1, {"result": "failure"})
 
-        return wrapper
+        with self._state_lock:
+            outage_duration = time.monotonic() - self._down_since.pop(url)
 
-    @handle_redis_exception
+        self._logger.info(
+            "Redis %s is back up after %.1f seconds", self._location(url), outage_duration
+        )
+        self._state_changes.add(1, {"state": "up"})
+        self._outage_duration.record(outage_duration)
+        redis_up.send(self, outage_duration=outage_duration, url=url)
+
+    def alive(self, url: str = None) -> bool:
+        """Checks if a Redis deployment is alive.
+
+        Args:
+            url (str, optional): The URL of the deployment. Defaults to URL.
+
+        Returns:
+            bool: True if the Redis deployment is alive, False otherwise.
+        """
+        try:
+            client = self._redis_client if (url or self.url) == self.url else self.get_client(url)
+            return client.ping()
+        except:  # noqa
+            return False
+
+    def __getattr__(self, name):
+        return getattr(self._redis_client, name, None)
+
+    def __getitem__(self, name):
+        return self._redis_client[name]
+
+    def __setitem__(self, name, value):
+        self._redis_client[name] = value
+
+    def __delitem__(self, name):
+        del self._redis_client[name]
+
+
+class StoragePipeline:
+    """Operations on the storage that are sent to Redis in a single round-trip.
+
+    Operations are queued and executed when the block of `StorageService.pipeline` ends, or
+    with `execute`. Their results are then available in `results`, in the order in which
+    the operations were queued. While Redis is down the operations use the fallback storage.
+
+    Args:
+        storage_service (StorageService): The storage service.
+        transaction (bool): Whether Redis executes the operations atomically.
+    """
+
+    def __init__(self, storage_service: "StorageService", transaction: bool = False):
+        self._storage_service = storage_service
+        self._transaction = transaction
+        self._operations = []
+        self.results = []
+
+    def get(self, key: str) -> "StoragePipeline":
+        self._operations.append(("get", key, ()))
+        return self
+
+    def set(self, key: str, value: str, timeout: int = None) -> "StoragePipeline":
+        self._operations.append(("set", key, (value, timeout)))
+        return self
+
+    def delete(self, key: str) -> "StoragePipeline":
+        self._operations.append(("delete", key, ()))
+        return self
+
+    def incr(self, key: str) -> "StoragePipeline":
+        return self.incrby(key, 1)
+
+    def incrby(self, key: str, increment: int) -> "StoragePipeline":
+        self._operations.append(("incrby", key, (increment,)))
+        return self
+
+    def incrbyfloat(self, key: str, increment: float) -> "StoragePipeline":
+        self._operations.append(("incrbyfloat", key, (increment,)))
+        return self
+
+    def has(self, key: str) -> "StoragePipeline":
+        self._operations.append(("has", key, ()))
+        return self
+
+    def __enter__(self) -> "StoragePipeline":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def execute(self) -> list:
+        """Executes the queued operations.
+
+        Returns:
+            list: The results of the operations.
+        """
+        operations, self._operations = self._operations, []
+        self.results = self._storage_service._execute(operations, self._transaction)
+        return self.results
+
+
+class StorageService(GatewayService):
+    """A service class for interacting with storage.
+
+    This class provides methods for setting, getting, deleting, and incrementing values in storage.
+    It supports both Redis storage and fallbacks to memory storage in case Redis is down. The
+    memory storage holds at most FALLBACK_MAX_ENTRIES entries and FALLBACK_MAX_BYTES bytes and
+    evicts the least recently used entries beyond that.
+
+    Keys starting with one of NEAR_CACHE_PREFIXES can be served from a near cache in process
+    memory. Redis reports every write to those keys through client-side caching in broadcast
+    mode (CLIENT TRACKING ... BCAST), and the written keys are dropped from the near cache.
+    The near cache is only used while the invalidations are received.
+    """
+
+    # The channel on which Redis sends the keys that were written
+    INVALIDATION_CHANNEL = "__redis__:invalidate"
+
+    def __init__(self, name: str = "STORAGE_SERVICE"):
+        super().__init__(name)
+        self._fallback_storage = MemoryStore()
+        # The fallback storage that is being transferred to Redis
+        self._resync_storage = None
+        self._near_cache = None
+        self._near_cache_listener = None
+        self._near_cache_pid = None
+        self._near_cache_ready = threading.Event()
+        self._near_cache_stop = threading.Event()
+        self._near_cache_lock = threading.Lock()
+
+        meter = metrics.get_meter(__name__)
+        self._near_cache_requests = meter.create_counter(
+            "gateway.storage.near_cache.requests",
+            description="Reads of near-cached keys, by whether the near cache held the key",
+        )
+        self._near_cache_invalidations = meter.create_counter(
+            "gateway.storage.near_cache.invalidations",
+            description="Keys dropped from the near cache because they were written",
+        )
+
+    def init_app(self, app: Flask, redis_service: RedisService):
+        super().init_app(app)
+        self._redis_service = redis_service
+        self._serializer = Codec(self.get_service_config("CODEC", "msgpack"))
+        self._fallback_storage = self._create_fallback_storage()
+
+        if self.get_service_config("NEAR_CACHE_ENABLED", False) and redis_service.is_cluster:
+            # The invalidations of a cluster would have to be received from every primary
+            self._logger.warning("The near cache is not supported with Redis Cluster")
+        elif self.get_service_config("NEAR_CACHE_ENABLED", False):
+            self._near_cache = NearCache(
+                ttl=self.get_service_config("NEAR_CACHE_TTL", 300),
+                max_entries=self.get_service_config("NEAR_CACHE_MAX_ENTRIES", 10000),
+                max_bytes=self.get_service_config("NEAR_CACHE_MAX_BYTES", 16 * 1024 * 1024),
+            )
+            self._near_cache_prefixes = tuple(self.get_service_config("NEAR_CACHE_PREFIXES", []))
+
+        redis_up.connect(self._on_redis_up, sender=redis_service, weak=False)
+
+    @property
+    def _redis_down(self) -> bool:
+        return not self._redis_service.available
+
+    def _create_fallback_storage(self) -> MemoryStore:
+        return MemoryStore(
+            max_entries=self.get_service_config("FALLBACK_MAX_ENTRIES", 100000),
+            max_bytes=self.get_service_config("FALLBACK_MAX_BYTES", 64 * 1024 * 1024),
+            shards=self.get_service_config("FALLBACK_SHARDS", 16),
+        )
+
+    def _on_redis_up(self, sender: RedisService, url: str = None, **kwargs):
+        if url != sender.url:
+            return
+
+        self._logger.info("Redis is back up, transferring data from fallback storage")
+        threading.Thread(
+            target=self._transfer_to_redis, name="storage-resync", daemon=True
+        ).start()
+
+    def _serialize(self, value: any) -> str | bytes:
+        """Serializes the given value.
+
+        Args:
+            value (any): The value to serialize.
+
+        Returns:
+            str | bytes: The serialized value.
+        """
+        if isinstance(value, (int, float, str)):
+            return str(value)
+        else:
+            return self._serializer.dumps(value)
+
+    def _transfer_to_redis(self):
+        """
+        Transfers the data from the fallback storage to Redis.
+
+        The fallback storage is replaced with an empty one and its entries are written to Redis
+        in pipelined batches of RESYNC_BATCH_SIZE keys, with their remaining time to live.
+        Counters that were only incremented while Redis was down are added to the counters in
+        Redis. Other values overwrite the values in Redis, unless they were written again since
+        Redis recovered. Until the transfer is complete, keys missing from Redis are read from
+        the fallback storage.
+        """
+        fallback_storage = self._fallback_storage
+        self._resync_storage = fallback_storage
+        self._fallback_storage = self._create_fallback_storage()
+        self._logger.info("Fallback storage statistics: %s", fallback_storage.stats())
+
+        entries = fallback_storage.items()
+        batch_size = self.get_service_config("RESYNC_BATCH_SIZE", 500)
+        start = 0
+        try:
+            for start in range(0, len(entries), batch_size):
+                pipeline = self._redis_service.pipeline(transaction=False)
+                for key, value, ttl, incremented in entries[start : start + batch_size]:
+                    ttl_ms = None if ttl is None else max(1, int(ttl * 1000))
+                    if incremented:
+                        if isinstance(value, float):
+                            pipeline.incrbyfloat(key, value)
+                        else:
+                            pipeline.incrby(key, value)
+                        if ttl_ms is not None:
+                            pipeline.pexpire(key, ttl_ms)
+                    elif fallback_storage.has(key):
+                        pipeline.set(key, self._serialize(value), px=ttl_ms)
+                pipeline.execute()
+            self._logger.info("Transferred %d keys from fallback storage to Redis", len(entries))
+        except (ConnectionError, TimeoutError) as ex:
+            self._logger.warning("Could not transfer fallback storage to Redis: %s", ex)
+            self._redis_service.report_failure(ex)
+            self._restore(entries[start:])
+        finally:
+            self._resync_storage = None
+
+    def _restore(self, entries: list):
+        """Merges entries that could not be transferred into the current fallback storage.
+
+        Args:
+            entries (list): Entries as returned by `MemoryStore.items`.
+        """
+        for key, value, ttl, incremented in entries:
+            if incremented and isinstance(value, float):
+                self._fallback_storage.incrbyfloat(key, value)
+            elif incremented:
+                self._fallback_storage.incrby(key, value)
+            elif not self._fallback_storage.has(key):
+                self._fallback_storage.set(key, value, ttl)
+
+    def _forget_resync(self, key: str):
+        """Keeps a key written since Redis recovered from being overwritten by the transfer."""
+        resync_storage = self._resync_storage
+        if resync_storage is not None:
+            resync_storage.delete(key)
+
+    def _near_cached(self, key: str) -> bool:
+        """Whether a key is read through the near cache.
+
+        Starts the invalidation listener of the process if it is not running, keys are only
+        read through the near cache once the listener receives invalidations.
+        """
+        if self._near_cache is None or not key.startswith(self._near_cache_prefixes):
+            return False
+
+        if self._near_cache_pid != os.getpid() or not self._near_cache_listener.is_alive():
+            self._start_near_cache_listener()
+
+        return self._near_cache_ready.is_set()
+
+    def _start_near_cache_listener(self):
+        with self._near_cache_lock:
+            pid = os.getpid()
+            if self._near_cache_pid == pid and self._near_cache_listener.is_alive():
+                return
+
+            # A forked worker neither inherits the listener nor the invalidations it missed
+            self._near_cache_ready.clear()
+            self._near_cache.clear()
+            self._near_cache_pid = pid
+            self._near_cache_listener = threading.Thread(
+                target=self._listen_for_invalidations, name="storage-near-cache", daemon=True
+            )
+            self._near_cache_listener.start()
+
+    def _listen_for_invalidations(self):
+        """Receives the keys that Redis reports as written and drops them from the near cache.
+
+        Redis only sends the invalidations of RESP2 clients to a subscribed connection. A
+        second connection enables the tracking of the near-cached prefixes and redirects its
+        invalidations there, it is pinged while no invalidations arrive, since tracking ends
+        with it. The near cache is cleared whenever the connections are lost and they are
+        opened again with exponential backoff.
+        """
+        pool = self._redis_service.get_connection_pool()
+        prefixes = [arg for prefix in self._near_cache_prefixes for arg in ("PREFIX", prefix)]
+        retry_interval = self.get_service_config("NEAR_CACHE_RETRY_INTERVAL", 1)
+        delay = retry_interval
+
+        while not self._near_cache_stop.is_set():
+            listener = pool.connection_class(**pool.connection_kwargs)
+            tracker = pool.connection_class(**pool.connection_kwargs)
+            try:
+                listener.send_command("CLIENT", "ID")
+                client_id = listener.read_response()
+                tracker.send_command(
+                    "CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST", *prefixes
+                )
+                tracker.read_response()
+                listener.send_command("SUBSCRIBE", self.INVALIDATION_CHANNEL)
+                listener.read_response()
+
+                self._near_cache_ready.set()
+                self._logger.info("Near cache is receiving invalidations")
+                delay = retry_interval
+
+                while not self._near_cache_stop.is_set():
+                    if listener.can_read(timeout=1):
+                        self._on_invalidation(listener.read_response())
+                    else:
+                        tracker.send_command("PING")
+                        tracker.read_response()
+            except RedisError as ex:
+                self._logger.warning("Near cache is not receiving invalidations: %s", ex)
+                delay = min(delay * 2, 30)
+            finally:
+                self._near_cache_ready.clear()
+                self._near_cache.clear()
+                listener.disconnect()
+                tracker.disconnect()
+
+            self._near_cache_stop.wait(random.uniform(delay / 2, delay))
+
+    def _on_invalidation(self, message: list):
+        """Handles a message of the invalidation channel."""
+        kind, _, keys = message
+        if kind not in (b"message", "message"):
+            return
+
+        # Redis sends no keys when the database was flushed
+        if keys is None:
+            self._near_cache.clear()
+            return
+
+        for key in keys:
+            self._near_cache.invalidate(key.decode() if isinstance(key, bytes) else key)
+        self._near_cache_invalidations.add(len(keys))
+
+    def _near_cache_lookup(self, key: str) -> bytes | None:
+        """Returns the near-cached copy of a key, None if it is not near-cached."""
+        value = self._near_cache.get(key)
+        self._near_cache_requests.add(1, {"result": "miss" if value is None else "hit"})
+        return value
+
+    def _invalidate_near_cache(self, key: str):
+        if self._near_cache is not None:
+            self._near_cache.invalidate(key)
+
+    def near_cache_stats(self) -> dict | None:
+        """Returns the statistics of the near cache, None if it is disabled.
+
+        Returns:
+            dict | None: The statistics of `MemoryStore.stats` and the hit rate.
+        """
+        if self._near_cache is None:
+            return None
+
+        stats = self._near_cache.stats()
+        requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / requests if requests else 0.0
+        return stats
+
+    def handle_redis_exception(func):
+        def wrapper(self, *args, **kwargs):
+            try:
+                return func(self, *args, **kwargs)
+            except (ConnectionError, TimeoutError) as ex:
+                self._redis_service.report_failure(ex)
+                self._logger.warning("Redis is down, falling back to local storage")
+                return func(self, *args, **kwargs)
+            except Exception as ex:
+                self._logger.error("Failed to handle Redis exception", ex)
+                raise
+
+        return wrapper
+
+    @handle_redis_exception
+    def _execute(self, operations: list, transaction: bool = False) -> list:
+        """Executes (operation, key, arguments) tuples in a single round-trip.
+
+        The operations are named after the methods of the fallback storage, they are
+        executed on the fallback storage while Redis is down.
+
+        Args:
+            operations (list): The operations.
+            transaction (bool, optional): Whether Redis executes the operations atomically.
+
+        Returns:
+            list: The results of the operations.
+        """
+        if not operations:
+            return []
+
+        if self._redis_down:
+            return [
+                getattr(self._fallback_storage, operation)(key, *args)
+                for operation, key, args in operations
+            ]
+
+        generations = {}
+        pipeline = self._redis_service.pipeline(transaction=transaction)
+        for operation, key, args in operations:
+            if operation == "get":
+                if self._near_cached(key):
+                    generations[key] = self._near_cache.generation(key)
+                pipeline.get(key)
+            elif operation == "has":
+                pipeline.exists(key)
+            elif operation == "set":
+                self._forget_resync(key)
+                self._invalidate_near_cache(key)
+                value, timeout = args
+                if timeout is None:
+                    pipeline.set(key, self._serialize(value))
+                else:
+                    pipeline.setex(key, timeout, self._serialize(value))
+            elif operation == "delete":
+                self._forget_resync(key)
+                self._invalidate_near_cache(key)
+                pipeline.delete(key)
+            else:
+                self._invalidate_near_cache(key)
+                getattr(pipeline, operation)(key, *args)
+
+        return [
+            self._read_result(operation, key, result, generations.get(key))
+            for (operation, key, _), result in zip(operations, pipeline.execute())
+        ]
+
+    def _read_result(self, operation: str, key: str, result: any, generation: int = None) -> any:
+        """Converts the Redis reply of a pipelined operation to the result of the operation.
+
+        The reply of a get is stored in the near cache if the generation of the key was
+        read before the operation was sent.
+        """
+        resync_storage = self._resync_storage
+        if operation == "get":
+            if result is not None:
+                if generation is not None:
+                    self._near_cache.fill(key, result, generation)
+                return self._serializer.loads(result)
+            return resync_storage.get(key) if resync_storage is not None else None
+        elif operation == "has":
+            return bool(result) or (resync_storage is not None and resync_storage.has(key))
+        elif operation in ("set", "delete"):
+            return bool(result)
+        return result
+
+    def pipeline(self, transaction: bool = False) -> StoragePipeline:
+        """Returns a pipeline, whose operations are executed when its block ends.
+
+        With Redis Cluster, the keys of a pipeline may be in different slots, but its
+        operations can not be executed as a transaction.
+
+        Example:
+            with storage_service.pipeline() as pipeline:
+                pipeline.incr("counter").get("value")
+            count, value = pipeline.results
+
+        Args:
+            transaction (bool, optional): Whether Redis executes the operations atomically.
+                Defaults to False.
+
+        Returns:
+            StoragePipeline: The pipeline.
+        """
+        return StoragePipeline(self, transaction)
+
+    def get_many(self, keys: list) -> list:
+        """Gets the values of several keys in a single round-trip.
+
+        Args:
+            keys (list): The keys.
+
+        Returns:
+            list: The values, None for missing keys.
+        """
+        near_cached = {}
+        if not self._redis_down:
+            for key in keys:
+                if self._near_cached(key):
+                    value = self._near_cache_lookup(key)
+                    if value is not None:
+                        near_cached[key] = self._serializer.loads(value)
+
+        missing = [key for key in keys if key not in near_cached]
+        values = dict(zip(missing, self._execute([("get", key, ()) for key in missing])))
+        return [near_cached[key] if key in near_cached else values[key] for key in keys]
+
+    def set_many(self, mapping: dict, timeout: int = None) -> bool:
+        """Sets several keys in a single round-trip.
+
+        Args:
+            mapping (dict): The values by key.
+            timeout (int, optional): The time to live of the keys in seconds. Defaults to None.
+
+        Returns:
+            bool: True if all keys were set.
+        """
+        operations = [("set", key, (value, timeout)) for key, value in mapping.items()]
+        return all(self._execute(operations))
+
+    def incr_many(self, increments: dict) -> list:
+        """Increments several counters in a single round-trip.
+
+        Args:
+            increments (dict): The increments by key, float increments use INCRBYFLOAT.
+
+        Returns:
+            list: The new values of the counters.
+        """
+        return self._execute(
+            [
+                ("incrbyfloat" if isinstance(increment, float) else "incrby", key, (increment,))
+                for key, increment in increments.items()
+            ]
+        )
+
+    def delete_many(self, keys: list) -> int:
+        """Deletes several keys in a single round-trip.
+
+        Args:
+            keys (list): The keys.
+
+        Returns:
+            int: The number of deleted keys.
+        """
+        return sum(self._execute([("delete", key, ()) for key in keys]))
+
+    @handle_redis_exception
     def set(self, key: str, value: str, timeout: int = None) -> bool:
         if not self._redis_down:
+            self._forget_resync(key)
+            self._invalidate_near_cache(key)
             value = self._serialize(value)
 
             if timeout is None:
@@ -963,16 +2216,27 @@ class StorageService(GatewayService):
             else:
                 return bool(self._redis_service.setex(key, timeout, value))
         else:
-            self._fallback_storage[key] = value
+            self._fallback_storage.set(key, value, timeout)
             return True
 
     @handle_redis_exception
     def get(self, key: str) -> str:
         if not self._redis_down:
+            generation = None
+            if self._near_cached(key):
+                value = self._near_cache_lookup(key)
+                if value is not None:
+                    return self._serializer.loads(value)
+                generation = self._near_cache.generation(key)
+
             value = self._redis_service.get(key)
 
             if value is not None:
+                if generation is not None:
+                    self._near_cache.fill(key, value, generation)
                 value = self._serializer.loads(value)
+            elif self._resync_storage is not None:
+                value = self._resync_storage.get(key)
 
             return value
         else:
@@ -981,40 +2245,78 @@ class StorageService(GatewayService):
     @handle_redis_exception
     def delete(self, key: str) -> bool:
         if not self._redis_down:
+            self._forget_resync(key)
+            self._invalidate_near_cache(key)
             return bool(self._redis_service.delete(key))
         else:
-            return bool(self._fallback_storage.pop(key, None))
+            return self._fallback_storage.delete(key)
 
     @handle_redis_exception
     def incr(self, key: str) -> int:
         if not self._redis_down:
+            self._invalidate_near_cache(key)
             return self._redis_service.incr(key)
         else:
-            self._fallback_storage[key] = self._fallback_storage.get(key, 0) + 1
-            return self._fallback_storage[key]
+            return self._fallback_storage.incrby(key, 1)
 
     @handle_redis_exception
     def incrby(self, key: str, increment: int) -> int:
         if not self._redis_down:
+            self._invalidate_near_cache(key)
             return self._redis_service.incrby(key, increment)
         else:
-            self._fallback_storage[key] = self._fallback_storage.get(key, 0) + increment
-            return self._fallback_storage[key]
+            return self._fallback_storage.incrby(key, increment)
 
     @handle_redis_exception
     def incrbyfloat(self, key: str, increment: float) -> float:
         if not self._redis_down:
+            self._invalidate_near_cache(key)
             return self._redis_service.incrbyfloat(key, increment)
         else:
-            self._fallback_storage[key] = self._fallback_storage.get(key, 0.0) + increment
-            return self._fallback_storage[key]
+            return self._fallback_storage.incrbyfloat(key, increment)
 
     @handle_redis_exception
     def has(self, key: str) -> bool:
         if not self._redis_down:
-            return bool(self._redis_service.exists(key))
+            resync_storage = self._resync_storage
+            return bool(self._redis_service.exists(key)) or (
+                resync_storage is not None and resync_storage.has(key)
+            )
         else:
-            return key in self._fallback_storage
+            return self._fallback_storage.has(key)
+
+
+class FailureReportingCache:
+    """A cache backend that reports the connection errors of its Redis deployment.
+
+    Flask-Caching logs and swallows the errors of its backend, so the errors are reported
+    to the RedisService before they reach Flask-Caching.
+
+    Args:
+        backend (RedisCache): The cache backend.
+        redis_service (RedisService): The service that tracks the deployment.
+        url (str): The URL of the deployment.
+    """
+
+    def __init__(self, backend: RedisCache, redis_service: RedisService, url: str):
+        self._backend = backend
+        self._redis_service = redis_service
+        self._url = url
+
+    def __getattr__(self, name):
+        attribute = getattr(self._backend, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        @wraps(attribute)
+        def wrapper(*args, **kwargs):
+            try:
+                return attribute(*args, **kwargs)
+            except (ConnectionError, TimeoutError) as ex:
+                self._redis_service.report_failure(ex, self._url)
+                raise
+
+        return wrapper
 
 
 class CacheService(GatewayService, Cache):
@@ -1023,15 +2325,46 @@ class CacheService(GatewayService, Cache):
     def __init__(self, name: str = "CACHE_SERVICE"):
         GatewayService.__init__(self, name)
         Cache.__init__(self)
+        self._redis_service = None
 
-    def init_app(self, app: Flask):
+    def init_app(self, app: Flask, redis_service: RedisService = None):
         GatewayService.init_app(self, app)
 
-        app.config.setdefault("CACHE_REDIS_URL", self.get_service_config("REDIS_URI"))
         app.config.setdefault("CACHE_TYPE", self.get_service_config("CACHE_TYPE", "RedisCache"))
+        if redis_service is not None and app.config["CACHE_TYPE"] == "RedisCache":
+            # Flask-Caching uses a client given as the host instead of connecting itself
+            app.config.setdefault(
+                "CACHE_REDIS_HOST", redis_service.get_client(self.get_service_config("REDIS_URI"))
+            )
+        else:
+            app.config.setdefault("CACHE_REDIS_URL", self.get_service_config("REDIS_URI"))
 
         Cache.init_app(self, app)
 
+        backend = app.extensions["cache"][self]
+        if isinstance(backend, RedisCache):
+            # Only the headers that the proxy passes on to clients are cached
+            backend.serializer = CacheCodec(
+                allowed_headers=app.config.get("PROXY_SERVICE_ALLOWED_HEADERS", []),
+                write_format=self.get_service_config("CODEC", "msgpack"),
+            )
+            if redis_service is not None and app.config["CACHE_TYPE"] == "RedisCache":
+                self._redis_service = redis_service
+                self._redis_url = self.get_service_config("REDIS_URI")
+                app.extensions["cache"][self] = FailureReportingCache(
+                    backend, redis_service, self._redis_url
+                )
+
+    def clear(self) -> bool:
+        client = getattr(self.cache, "_write_client", None)
+        if not isinstance(client, RedisCluster):
+            return super().clear()
+
+        # KEYS, which the Redis backend uses, only reaches one node of a cluster
+        pattern = self.cache.key_prefix + "*"
+        keys = list(client.scan_iter(match=pattern, target_nodes=RedisCluster.PRIMARIES))
+        return not keys or bool(client.delete(*keys))
+
     def clear_cache(self, request_path: str, parameters: dict) -> bool:
         """Clears the cache for the specified request path and parameters.
 
@@ -1074,10 +2407,19 @@ class CacheService(GatewayService, Cache):
         Returns:
             Callable: The decorated function/method.
         """
+
+        def _unless(f, *args, **kwargs) -> bool:
+            # Requests are proxied without the cache while its Redis deployment is unavailable
+            if self._redis_service is not None and not self._redis_service.is_available(
+                self._redis_url
+            ):
+                return True
+            return self._bypass_cache(unless, f, *args, **kwargs)
+
         return Cache.cached(
             self,
             timeout=timeout,
-            unless=unless,
+            unless=_unless,
             forced_update=forced_update,
             response_filter=response_filter,
             make_cache_key=lambda *args, **kwargs: self._make_cache_key_from_request(
@@ -1122,7 +2464,8 @@ class CacheService(GatewayService, Cache):
         Returns:
             str: The generated cache key.
         """
-        cache_key = "view/%s" % request_path
+        # The hash tag keeps all cached responses of a path in the same Redis Cluster slot
+        cache_key = "view/{%s}" % request_path
 
         if request_params:
             args_as_bytes = str(request_params).encode()
@@ -1167,6 +2510,106 @@ class SecurityService(GatewayService, Security):
 
         self._token_serializer = URLSafeTimedSerializer(self.get_service_config("SECRET_KEY"))
 
+        if getattr(self, "_password_hasher", None) is not None:
+            self._password_hasher.shutdown()
+        self._password_hasher = PasswordHasher(
+            self.pwd_context,
+            max_workers=self.get_service_config("PASSWORD_WORKERS", 2),
+            max_pending=self.get_service_config("PASSWORD_MAX_PENDING", 32),
+            timeout=self.get_service_config("PASSWORD_TIMEOUT", 10),
+        )
+
+        self._user_cache = TTLCache(
+            maxsize=self.get_service_config("USER_CACHE_SIZE", 10000),
+            ttl=self.get_service_config("USER_CACHE_TTL", 30),
+        )
+
+    def load_user(self, fs_uniquifier: str) -> User | None:
+        """Loads the user with the given `fs_uniquifier`, e.g. for session cookie authentication.
+
+        Users are cached per process for a short time together with their roles. The cached
+        instance is detached and never handed out; every call merges it into the current
+        session without emitting any SQL, so changes made during a request stay local to it.
+        The cache is filled from the primary, as a lagging replica could put a user back
+        into it right after a change invalidated it.
+
+        Args:
+            fs_uniquifier (str): The unique identifier of the user.
+
+        Returns:
+            User | None: The user, or None if no user has that identifier.
+        """
+        user = self._user_cache.get(fs_uniquifier)
+
+        if user is None:
+            with use_primary():
+                user = (
+                    User.query.options(joinedload(User.roles))
+                    .filter_by(fs_uniquifier=fs_uniquifier)
+                    .first()
+                )
+            if user is None:
+                return None
+
+            extensions.db.session.expunge(user)
+            self._user_cache.set(fs_uniquifier, user)
+
+        return extensions.db.session.merge(user, load=False)
+
+    def hash_password(self, password: str) -> str:
+        """Hashes a password with the configured scheme in the password worker pool.
+
+        Args:
+            password (str): The plaintext password.
+
+        Raises:
+            ServiceUnavailableError: If too many password operations are pending.
+
+        Returns:
+            str: The password hash.
+        """
+        if use_double_hash():
+            password = get_hmac(password).decode("ascii")
+
+        return self._password_hasher.hash(password, **self._password_hash_options())
+
+    def verify_password(self, password: str, password_hash: str) -> Tuple[bool, str]:
+        """Verifies a password in the password worker pool.
+
+        Args:
+            password (str): The plaintext password.
+            password_hash (str): The stored password hash.
+
+        Raises:
+            ServiceUnavailableError: If too many password operations are pending.
+
+        Returns:
+            Tuple[bool, str]: Whether the password matches and, if the hash was created with
+                a different scheme or cost than the configured one, a new hash.
+        """
+        if use_double_hash(password_hash):
+            password = get_hmac(password).decode("ascii")
+
+        return self._password_hasher.verify_and_update(
+            password, password_hash, **self._password_hash_options()
+        )
+
+    def _password_hash_options(self) -> dict:
+        return self._app.config.get("SECURITY_PASSWORD_HASH_OPTIONS", {}).get(
+            self._app.config["SECURITY_PASSWORD_HASH"], {}
+        )
+
+    def invalidate_user(self, fs_uniquifier: str):
+        """Removes a user from the user cache.
+
+        Must be called after changing any user attribute or role. Other processes pick
+        up the change once their cached copy expires.
+
+        Args:
+            fs_uniquifier (str): The unique identifier of the user.
+        """
+        self._user_cache.pop(fs_uniquifier)
+
     def create_user(self, email: str, password: str, **kwargs) -> User:
         """Creates a new user with the specified email and password.
 
@@ -1222,6 +2665,7 @@ class SecurityService(GatewayService, Security):
         """
         if self.datastore.add_role_to_user(user, role):
             self.datastore.commit()
+            self.invalidate_user(user.fs_uniquifier)
             return True
         else:
             return False
@@ -1248,6 +2692,7 @@ class SecurityService(GatewayService, Security):
         user = self.datastore.db.session.merge(user)
         user.password = password
         self.datastore.commit()
+        self.invalidate_user(user.fs_uniquifier)
 
         return user
 
@@ -1284,6 +2729,10 @@ class SecurityService(GatewayService, Security):
         user = self.datastore.db.session.merge(user)
         user.email = email
         self.datastore.commit()
+        self.invalidate_user(user.fs_uniquifier)
+
+        # The email is part of the bootstrap response
+        extensions.auth_service.invalidate_bootstrap_cache(user.get_id())
 
         return user
 
@@ -1381,13 +2830,472 @@ class SecurityService(GatewayService, Security):
         return user
 
 
+class ReplicaService(GatewayService):
+    """A service that provides healthy read replicas of the database.
+
+    Replicas whose replication lag exceeds REPLICA_SERVICE_MAX_LAG seconds, or that cannot
+    be reached, are skipped until their next check. Every replica is checked at most once
+    every REPLICA_SERVICE_CHECK_INTERVAL seconds.
+    """
+
+    # Seconds since the last replayed transaction, 0 if the replica has replayed all it received
+    DEFAULT_LAG_QUERY = """SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END"""
+
+    def __init__(self, name: str = "REPLICA_SERVICE"):
+        super().__init__(name)
+
+    def init_app(self, app: Flask):
+        super().init_app(app)
+        self._engines = [
+            create_engine(uri, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+            for uri in self.get_service_config("URIS", [])
+        ]
+        self._health = {}
+        self._counter = itertools.count()
+
+    def get_engine(self) -> Engine | None:
+        """Returns the engine of a healthy replica, alternating between replicas.
+
+        Returns:
+            Engine | None: The engine, or None if no replica is configured or healthy.
+        """
+        healthy = [engine for engine in self._engines if self._is_healthy(engine)]
+        if not healthy:
+            return None
+
+        return healthy[next(self._counter) % len(healthy)]
+
+    def _is_healthy(self, engine: Engine) -> bool:
+        healthy, checked_at = self._health.get(engine, (False, 0))
+        now = time.monotonic()
+        if now - checked_at < self.get_service_config("CHECK_INTERVAL", 5):
+            return healthy
+
+        # Concurrent requests keep using the previous result while this one checks
+        self._health[engine] = (healthy, now)
+        try:
+            with engine.connect() as connection:
+                lag = connection.execute(
+                    text(self.get_service_config("LAG_QUERY", self.DEFAULT_LAG_QUERY))
+                ).scalar()
+            healthy = lag is None or lag <= self.get_service_config("MAX_LAG", 5)
+        except SQLAlchemyError as ex:
+            self._logger.warning("Could not check replica %s: %s", engine.url, ex)
+            healthy = False
+
+        if not healthy:
+            self._logger.info("Replica %s is lagging or unavailable, using primary", engine.url)
+
+        self._health[engine] = (healthy, now)
+        return healthy
+
+
+class MaintenanceService(GatewayService):
+    """A service that continuously deletes expired and stale rows in small batches.
+
+    Every category of rows is drained one batch at a time, at most MAX_RATE rows per
+    second. The batch size shrinks while batches take longer than TARGET_LATENCY seconds
+    and grows back while the database keeps up. A drained category is checked again
+    after IDLE_INTERVAL seconds. Only the instance holding a Redis lock does any work.
+
+    When oauth2token is partitioned, the worker also creates the daily partitions of the
+    next PARTITIONS_AHEAD days and drops the partitions of days that are over.
+    """
+
+    LOCK_NAME = "maintenance_service:lock"
+    PARTITION_CHECK_INTERVAL = 3600
+    PARTITION_PREFIX = "oauth2token_d"
+
+    def __init__(self, name: str = "MAINTENANCE_SERVICE"):
+        super().__init__(name)
+
+        meter = metrics.get_meter(__name__)
+        self._deleted_rows = meter.create_counter(
+            "gateway.maintenance.deleted_rows",
+            unit="rows",
+            description="Rows deleted by the maintenance worker",
+        )
+        self._deletion_rate = meter.create_histogram(
+            "gateway.maintenance.deletion_rate",
+            unit="rows/s",
+            description="Rows deleted per second by each batch of the maintenance worker",
+        )
+
+    def init_app(self, app: Flask):
+        super().init_app(app)
+        self._tasks = {
+            "expired_tokens": {
+                "table": OAuth2Token.__table__,
+                "condition": self.expired_tokens_condition,
+                "returning": (OAuth2Token.client_id, OAuth2Token.user_id),
+                "on_batch": self.delete_token_clients,
+            },
+            "unverified_users": {
+                "table": User.__table__,
+                "condition": lambda: self.stale_users_condition(
+                    timedelta(seconds=self.get_service_config("UNVERIFIED_USER_MAX_AGE", 86400))
+                ),
+                "dependents": (roles_users.c.user_id,),
+            },
+            "password_change_requests": {
+                "table": PasswordChangeRequest.__table__,
+                "condition": lambda: PasswordChangeRequest.created_at
+                <= datetime.now() - self._change_request_max_age,
+            },
+            "email_change_requests": {
+                "table": EmailChangeRequest.__table__,
+                "condition": lambda: EmailChangeRequest.created_at
+                <= datetime.now() - self._change_request_max_age,
+            },
+            "anonymous_clients": {
+                "table": OAuth2Client.__table__,
+                "condition": self.orphaned_anonymous_clients_condition,
+            },
+        }
+        self._partitions_due = 0
+        self._state = {
+            name: {
+                "last_id": 0,
+                "batch_size": self.get_service_config("BATCH_SIZE", 500),
+                "due": 0,
+            }
+            for name in self._tasks
+        }
+
+    @property
+    def _change_request_max_age(self) -> timedelta:
+        return timedelta(seconds=self.get_service_config("CHANGE_REQUEST_MAX_AGE", 86400))
+
+    @staticmethod
+    def stale_users_condition(td: timedelta):
+        """Filter matching users that registered at least `td` ago but never verified
+        their account.
+
+        Args:
+            td (timedelta): The minimum age of the registration.
+        """
+        return and_(
+            User.registered_at <= datetime.now() - td,
+            User.confirmed_at == None,  # noqa
+        )
+
+    @staticmethod
+    def expired_tokens_condition():
+        """Filter matching expired tokens, uses the ix_oauth2token_expires_at index.
+
+        The current time is compared as an integer, postgres would otherwise compare the
+        integer expression as numeric, which the index does not cover.
+        """
+        return and_(
+            OAuth2Token.expires_in != None,  # noqa
+            (OAuth2Token.issued_at + OAuth2Token.expires_in) < int(time.time()),
+            # Tokens in daily partitions are removed by dropping the partition
+            OAuth2Token.partition_day == 0,
+        )
+
+    def orphaned_anonymous_clients_condition(self):
+        """Filter matching clients of the anonymous bootstrap user that have outlived their
+        token, which happens when the partition of the token is dropped."""
+        identity = extensions.auth_service.anonymous_user_identity
+        if identity is None:
+            return false()
+
+        return and_(
+            OAuth2Client.user_id == identity[1],
+            OAuth2Client.last_activity
+            < datetime.now()
+            - timedelta(seconds=self._app.config.get("BOOTSTRAP_TOKEN_EXPIRES", 3600 * 24)),
+            ~exists().where(OAuth2Token.client_id == OAuth2Client.id),
+        )
+
+    @staticmethod
+    def delete_token_clients(rows: list):
+        """Deletes the clients of deleted tokens, every client should have only one token,
+        and invalidates the cached bootstrap responses of their users.
+
+        For some odd reasons, even though clients-tokens are associated the deletes didn't
+        cascade on postgres; so they are deleted explicitly.
+
+        Args:
+            rows (list): The (id, client_id, user_id) rows of the deleted tokens.
+        """
+        client_ids = [client_id for _, client_id, _ in rows if client_id is not None]
+        if client_ids:
+            extensions.db.session.execute(
+                OAuth2Client.__table__.delete().where(OAuth2Client.id.in_(client_ids))
+            )
+
+        for user_id in {user_id for _, _, user_id in rows if user_id is not None}:
+            extensions.auth_service.invalidate_bootstrap_cache(user_id)
+
+    def run(self, stop: threading.Event = None):
+        """Runs the maintenance worker until `stop` is set.
+
+        Args:
+            stop (threading.Event, optional): Event that stops the worker.
+        """
+        stop = stop or threading.Event()
+        lock_timeout = self.get_service_config("LOCK_TIMEOUT", 60)
+
+        while not stop.is_set():
+            lock = extensions.redis_service.lock(self.LOCK_NAME, timeout=lock_timeout)
+            try:
+                acquired = lock.acquire(blocking=False)
+            except RedisError as ex:
+                self._logger.warning("Could not acquire the maintenance lock: %s", ex)
+                acquired = False
+
+            if not acquired:
+                stop.wait(lock_timeout / 2)
+                continue
+
+            self._logger.info("Acquired the maintenance lock")
+            try:
+                while not stop.is_set():
+                    # Renew the lock before doing more work, stop if another instance took it
+                    lock.reacquire()
+                    next_due = self.run_once()
+                    # Wake up in time to renew the lock even if nothing is due before it expires
+                    stop.wait(min(lock_timeout / 2, max(0, next_due - time.monotonic())))
+            except (LockError, RedisError) as ex:
+                self._logger.warning("Lost the maintenance lock: %s", ex)
+            finally:
+                try:
+                    lock.release()
+                except (LockError, RedisError):
+                    pass
+
+    def run_once(self) -> float:
+        """Deletes one batch of every category that is due.
+
+        Returns:
+            float: The `time.monotonic()` time at which the next category is due.
+        """
+        if self._partitions_due <= time.monotonic():
+            self._partitions_due = time.monotonic() + self.PARTITION_CHECK_INTERVAL
+            try:
+                self.manage_partitions()
+            except SQLAlchemyError as ex:
+                extensions.db.session.rollback()
+                self._logger.error("Could not manage oauth2token partitions: %s", ex)
+
+        for name, task in self._tasks.items():
+            if self._state[name]["due"] <= time.monotonic():
+                self._run_task(name, task)
+
+        return min(self._partitions_due, *(state["due"] for state in self._state.values()))
+
+    def manage_partitions(self):
+        """Creates the daily oauth2token partitions of today and the next PARTITIONS_AHEAD
+        days, and drops the partitions of the days that are over.
+
+        Partitions are created as standalone tables and then attached, and detached
+        concurrently before they are dropped, so that requests on oauth2token are never
+        queued behind an exclusive lock. Every statement waits at most PARTITION_LOCK_TIMEOUT
+        milliseconds for its locks and is retried up to PARTITION_RETRIES times.
+
+        Does nothing unless oauth2token is a partitioned postgres table.
+        """
+        engine = extensions.db.session.get_bind()
+        if engine.dialect.name != "postgresql":
+            return
+
+        # DETACH PARTITION ... CONCURRENTLY cannot run inside a transaction block
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            partitioned = connection.execute(
+                text("SELECT relkind = 'p' FROM pg_class WHERE oid = 'oauth2token'::regclass")
+            ).scalar()
+            if not partitioned:
+                return
+
+            connection.execute(
+                text(
+                    "SET lock_timeout = {0}".format(
+                        int(self.get_service_config("PARTITION_LOCK_TIMEOUT", 1000))
+                    )
+                )
+            )
+
+            # Tables left behind by an interrupted run are either not attached yet, still
+            # detaching, or detached but not dropped
+            tables = connection.execute(
+                text(
+                    """SELECT c.relname, i.inhrelid IS NOT NULL,
+                    COALESCE(i.inhdetachpending, false) FROM pg_class c LEFT JOIN pg_inherits i
+                    ON i.inhrelid = c.oid AND i.inhparent = 'oauth2token'::regclass
+                    WHERE c.relkind = 'r' AND pg_table_is_visible(c.oid)
+                    AND c.relname LIKE :pattern"""
+                ),
+                {"pattern": self.PARTITION_PREFIX.replace("_", "\\_") + "%"},
+            )
+            partitions = {}
+            for name, attached, detach_pending in tables:
+                suffix = name[len(self.PARTITION_PREFIX) :]
+                if suffix.isdigit():
+                    partitions[int(suffix)] = (attached, detach_pending)
+            today = int(time.time()) // 86400
+
+            for day in range(today, today + self.get_service_config("PARTITIONS_AHEAD", 3) + 1):
+                attached, _ = partitions.get(day, (False, False))
+                if attached:
+                    continue
+                table = "{0}{1}".format(self.PARTITION_PREFIX, day)
+                self._execute_ddl(
+                    connection,
+                    "CREATE TABLE IF NOT EXISTS {0} "
+                    "(LIKE oauth2token INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(table),
+                )
+                self._execute_ddl(
+                    connection,
+                    "ALTER TABLE oauth2token ATTACH PARTITION {0} "
+                    "FOR VALUES FROM ({1}) TO ({2})".format(table, day, day + 1),
+                )
+                self._logger.info("Created oauth2token partition of day %d", day)
+
+            for day, (attached, detach_pending) in sorted(partitions.items()):
+                if day >= today:
+                    continue
+                # All tokens of the partition have expired
+                table = "{0}{1}".format(self.PARTITION_PREFIX, day)
+                if detach_pending:
+                    self._execute_ddl(
+                        connection,
+                        "ALTER TABLE oauth2token DETACH PARTITION {0} FINALIZE".format(table),
+                    )
+                elif attached:
+                    self._execute_ddl(
+                        connection,
+                        "ALTER TABLE oauth2token DETACH PARTITION {0} CONCURRENTLY".format(table),
+                    )
+                self._execute_ddl(connection, "DROP TABLE {0}".format(table))
+                self._logger.info("Dropped oauth2token partition of day %d", day)
+
+    def _execute_ddl(self, connection, statement: str):
+        """Executes a DDL statement, retrying it while it times out waiting for its locks.
+
+        Args:
+            connection: The autocommit connection to execute the statement on.
+            statement (str): The statement to execute.
+
+        Raises:
+            OperationalError: If the statement still times out after PARTITION_RETRIES retries.
+        """
+        retries = self.get_service_config("PARTITION_RETRIES", 3)
+        for attempt in range(retries + 1):
+            try:
+                connection.execute(text(statement))
+                return
+            except OperationalError as ex:
+                # 55P03 is lock_not_available, raised when lock_timeout expires
+                if getattr(ex.orig, "pgcode", None) != "55P03" or attempt == retries:
+                    raise
+                self._logger.info("Retrying after lock timeout: %s", statement)
+                time.sleep(random.uniform(0.1, 0.5))
+
+    def _run_task(self, name: str, task: dict):
+        state = self._state[name]
+        max_batch_size = self.get_service_config("BATCH_SIZE", 500)
+        min_batch_size = min(self.get_service_config("MIN_BATCH_SIZE", 10), max_batch_size)
+        target_latency = self.get_service_config("TARGET_LATENCY", 0.2)
+        idle_interval = self.get_service_config("IDLE_INTERVAL", 60)
+
+        start = time.monotonic()
+        try:
+            rows = delete_batch(
+                task["table"],
+                task["condition"](),
+                state["last_id"],
+                state["batch_size"],
+                task.get("returning", ()),
+                task.get("dependents", ()),
+            )
+            if rows and "on_batch" in task:
+                task["on_batch"](rows)
+            extensions.db.session.commit()
+        except SQLAlchemyError as ex:
+            extensions.db.session.rollback()
+            self._logger.error("Could not delete %s. Database error; rolled back: %s", name, ex)
+            state.update(batch_size=min_batch_size, due=time.monotonic() + idle_interval)
+            return
+        finally:
+            extensions.db.session.close()
+
+        duration = time.monotonic() - start
+        if rows:
+            self._deleted_rows.add(len(rows), {"category": name})
+            self._deletion_rate.record(len(rows) / max(duration, 1e-6), {"category": name})
+            self._logger.debug("Deleted %d %s in %.3f seconds", len(rows), name, duration)
+
+        if len(rows) < state["batch_size"]:
+            # Drained, start over from the beginning after a while
+            state.update(last_id=0, due=time.monotonic() + idle_interval)
+            return
+
+        state["last_id"] = max(row[0] for row in rows)
+
+        # Shrink batches quickly when the database slows down and grow them back slowly
+        if duration > target_latency:
+            state["batch_size"] = max(min_batch_size, state["batch_size"] // 2)
+        elif duration < target_latency / 2:
+            state["batch_size"] = min(
+                max_batch_size, state["batch_size"] + max(1, max_batch_size // 10)
+            )
+
+        # Stay below the maximum rate, and give the database at least as much time to
+        # recover as a slow batch took
+        pause = len(rows) / self.get_service_config("MAX_RATE", 500) - duration
+        if duration > target_latency:
+            pause = max(pause, duration)
+        state["due"] = time.monotonic() + max(0, pause)
+
+
 class KafkaProducerService(GatewayService):
+    """Publishes an event to Kafka for every request that the gateway handles.
+
+    The request thread only appends the fields of the event to a bounded buffer. A sender
+    thread of each process connects the producer and serializes the events and hands them to
+    it, the producer batches them for up to LINGER_MS milliseconds and compresses each batch.
+    While the buffer is full, events are dropped and counted, requests never wait for Kafka.
+
+    Whenever Kafka cannot be reached, the sender connects again with exponential backoff and
+    writes the events to a spool in SPOOL_PATH, which keeps them across restarts. Once Kafka
+    is reached, the spooled events are sent in order, before newer events.
+    """
+
+    # Spooled events sent per iteration of the sender, between which new events are spooled
+    REPLAY_BATCH_SIZE = 1000
+
     def __init__(self, name: str = "KAFKA_PRODUCER_SERVICE"):
         GatewayService.__init__(self, name)
+        self._producer = None
+        # Set when the producer could not send an event, it is replaced by the sender
+        self._producer_failed = False
+        self._spool = None
+        # Appending to and popping from a deque are atomic, the request threads do not lock
+        self._events = collections.deque()
+        self._sender = None
+        self._sender_pid = None
+        self._sender_lock = threading.Lock()
+        self._sender_stop = threading.Event()
+        self._send_lock = threading.Lock()
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+
+        meter = metrics.get_meter(__name__)
+        self._dropped_events = meter.create_counter(
+            "gateway.kafka.dropped_events",
+            description="Request events that were dropped, by whether the buffer or the spool "
+            "was full or Kafka could not be reached without a spool",
+        )
 
     def init_app(self, app: Flask):
         super().init_app(app)
-        self._producer = self._init_producer()
+        self._topic = self.get_service_config("REQUEST_TOPIC")
+        self._max_queued = self.get_service_config("QUEUE_SIZE", 10000)
+        self._idle_interval = self.get_service_config("LINGER_MS", 50) / 1000
         self._register_hooks(app)
 
     def _init_producer(self) -> KafkaProducer | None:
@@ -1396,41 +3304,279 @@ class KafkaProducerService(GatewayService):
                 bootstrap_servers=",".join(
                     self.get_service_config("BOOTSTRAP_SERVERS", ["localhost:9092"])
                 ),
-                value_serializer=lambda v: json.dumps(v).encode("utf-8"),
                 request_timeout_ms=self.get_service_config("REQUEST_TIMEOUT_MS", 500),
+                # Only the sender thread waits for metadata or buffer space
+                max_block_ms=self.get_service_config("REQUEST_TIMEOUT_MS", 500),
+                linger_ms=self.get_service_config("LINGER_MS", 50),
+                batch_size=self.get_service_config("BATCH_SIZE", 65536),
+                compression_type=self.get_service_config("COMPRESSION_TYPE", "gzip"),
                 acks=0,  # Fire and forget. We don't want issues with the broker to affect the Gateway.
             )
         except Exception as ex:
             self._logger.error("Could not connect to Kafka: %s", ex)
             return None
 
+    def _open_spool(self) -> Spool | None:
+        """Opens the first spool in SPOOL_PATH that is not used by another process.
+
+        A process that starts takes over the spool of a process that stopped, including the
+        events that were not sent yet.
+        """
+        path = self.get_service_config("SPOOL_PATH")
+        if not path:
+            return None
+
+        for slot in itertools.count():
+            try:
+                return Spool(
+                    os.path.join(path, str(slot)),
+                    segment_size=self.get_service_config("SPOOL_SEGMENT_SIZE", 4 * 1024 * 1024),
+                    max_bytes=self.get_service_config("SPOOL_MAX_BYTES", 64 * 1024 * 1024),
+                )
+            except BlockingIOError:
+                continue
+            except OSError as ex:
+                self._logger.error("Could not open the spool of request events: %s", ex)
+                return None
+
     def _register_hooks(self, app: Flask):
         @app.after_request
         def _after_request_hook(response: Response):
-            if self._producer is not None:
-                try:
-                    real_user = current_user._get_current_object()
-                except RuntimeError:
-                    current_app.logger.exception("Unable to collect real user. Most likely due to unbound session.")
-                    return response
-                self._producer.send(
-                    self.get_service_config("REQUEST_TOPIC"),
-                    {
-                        "user_id": real_user.get_id(),
-                        "client_id": (
-                            current_token.client_id
-                            if current_token and hasattr(current_token, "client")
-                            else ""
-                        ),
-                        "endpoint": request.endpoint,
-                        "method": request.method,
-                        "timestamp": datetime.now().isoformat(),
-                        "status_code": response.status_code,
-                    },
+            try:
+                real_user = current_user._get_current_object()
+            except RuntimeError:
+                current_app.logger.exception("Unable to collect real user. Most likely due to unbound session.")
+                return response
+            self.enqueue(
+                (
+                    real_user.get_id(),
+                    (
+                        current_token.get_client_key()
+                        if current_token and hasattr(current_token, "client")
+                        else ""
+                    ),
+                    request.endpoint,
+                    request.method,
+                    time.time(),
+                    response.status_code,
                 )
+            )
 
             return response
 
+    @property
+    def connected(self) -> bool:
+        """Whether the producer of this process is connected and sending events."""
+        return self._producer is not None and not self._producer_failed
+
+    @property
+    def dropped_events(self) -> int:
+        """The number of events of this process that were dropped."""
+        return self._dropped
+
+    def enqueue(self, event: tuple) -> bool:
+        """Adds the event of a request to the buffer of the sender thread.
+
+        Args:
+            event (tuple): The user id, client id, endpoint, method, timestamp and status code
+                of the request.
+
+        Returns:
+            bool: False if the buffer was full and the event was dropped.
+        """
+        if self._sender_pid != os.getpid():
+            self._start_sender()
+
+        # The length may be exceeded by the events of concurrent requests, which is harmless
+        if len(self._events) >= self._max_queued:
+            self._drop("queue_full")
+            return False
+
+        self._events.append(event)
+        return True
+
+    def flush(self, timeout: float = None):
+        """Sends the buffered events and waits until the producer sent them.
+
+        The events are spooled instead while Kafka cannot be reached or spooled events are
+        waiting, those are sent by the sender thread.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the producer. Defaults to None (no
+                limit).
+        """
+        self._send_events(replay=False)
+        producer = self._producer
+        if producer is not None and not self._producer_failed:
+            producer.flush(timeout)
+
+    def close(self, timeout: float = None):
+        """Stops the sender, sends or spools the buffered events and closes the producer.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the producer. Defaults to None (no
+                limit).
+        """
+        self._sender_stop.set()
+        self.flush(timeout)
+        with self._send_lock:
+            if self._producer is not None:
+                self._producer.close(timeout)
+                self._producer = None
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+
+    def _start_sender(self):
+        with self._sender_lock:
+            pid = os.getpid()
+            if self._sender_pid == pid:
+                return
+
+            # A forked worker inherits neither the sender nor the producer and the spool of
+            # its parent, nor should it send the events that were buffered by its parent
+            self._events.clear()
+            self._producer = None
+            self._producer_failed = False
+            self._spool = self._open_spool()
+            self._sender_pid = pid
+            self._sender_stop.clear()
+            self._sender = threading.Thread(
+                target=self._run_sender, name="kafka-request-events", daemon=True
+            )
+            self._sender.start()
+            self._register_exit_handler()
+
+    def _register_exit_handler(self):
+        # Exit handlers are called in reverse order, the producer closes itself in a handler
+        # that it registers when it is created
+        atexit.unregister(self.close)
+        atexit.register(self.close, self.get_service_config("REQUEST_TIMEOUT_MS", 500) / 1000)
+
+    def _run_sender(self):
+        """Connects the producer and sends the buffered and spooled events.
+
+        Checks for new events every LINGER_MS while idle. The producer is replaced with
+        exponential backoff while Kafka cannot be reached.
+        """
+        retry_interval = self.get_service_config("RETRY_INTERVAL", 1)
+        delay = retry_interval
+        connect_at = 0
+
+        while not self._sender_stop.is_set():
+            if not self.connected and time.monotonic() >= connect_at:
+                if self._connect():
+                    delay = retry_interval
+                else:
+                    connect_at = time.monotonic() + random.uniform(delay / 2, delay)
+                    delay = min(delay * 2, 30)
+
+            # Without a spool, the events wait in the buffer until Kafka is reached
+            spool = self._spool
+            if (self._events and (self.connected or spool is not None)) or (
+                self.connected and spool
+            ):
+                self._send_events()
+            else:
+                self._sender_stop.wait(self._idle_interval)
+
+    def _connect(self) -> bool:
+        """Replaces the producer, returns whether Kafka could be reached."""
+        with self._send_lock:
+            if self._producer is not None:
+                try:
+                    # Batches that were not sent fail and are spooled
+                    self._producer.close(0)
+                except Exception:
+                    self._logger.debug("Could not close the Kafka producer", exc_info=True)
+                self._producer = None
+
+        producer = self._init_producer()
+        with self._send_lock:
+            self._producer_failed = False
+            self._producer = producer
+
+        if producer is None:
+            return False
+
+        self._logger.info("Connected to Kafka, %d spooled events", len(self._spool or ()))
+        self._register_exit_handler()
+        return True
+
+    def _send_events(self, replay: bool = True):
+        """Sends the buffered events, or spools them while Kafka cannot be reached.
+
+        New events are spooled while spooled events are waiting, so that all events are sent
+        in order.
+
+        Args:
+            replay (bool, optional): Whether to send a batch of spooled events first. Defaults
+                to True.
+        """
+        with self._send_lock:
+            spool = self._spool
+            if spool is not None and (spool or not self.connected):
+                while self._events:
+                    self._spool_event(self._serialize(self._events.popleft()))
+
+            producer = self._producer
+            if producer is None or self._producer_failed:
+                return
+
+            if spool is not None and replay:
+                for _ in range(self.REPLAY_BATCH_SIZE):
+                    value = spool.pop()
+                    if value is None:
+                        break
+                    self._send(producer, value)
+                    if self._producer_failed:
+                        return
+
+            while self._events and not self._producer_failed:
+                self._send(producer, self._serialize(self._events.popleft()))
+
+    @staticmethod
+    def _serialize(event: tuple) -> bytes:
+        user_id, client_id, endpoint, method, timestamp, status_code = event
+        return json.dumps(
+            {
+                "user_id": user_id,
+                "client_id": client_id,
+                "endpoint": endpoint,
+                "method": method,
+                "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
+                "status_code": status_code,
+            }
+        ).encode("utf-8")
+
+    def _send(self, producer: KafkaProducer, value: bytes):
+        try:
+            producer.send(self._topic, value).add_errback(self._on_send_failed, producer, value)
+        except Exception as ex:
+            self._on_send_failed(producer, value, ex)
+
+    def _on_send_failed(self, producer: KafkaProducer, value: bytes, exception: Exception):
+        """Spools an event that the producer could not send and has the producer replaced.
+
+        Called by the producer's own thread for the events of batches that failed.
+        """
+        if producer is self._producer and not self._producer_failed:
+            self._logger.warning("Could not send request events to Kafka: %s", exception)
+            self._producer_failed = True
+        self._spool_event(value)
+
+    def _spool_event(self, value: bytes):
+        spool = self._spool
+        if spool is None:
+            self._drop("not_sent")
+        elif not spool.append(value):
+            self._drop("spool_full")
+
+    def _drop(self, reason: str):
+        with self._dropped_lock:
+            self._dropped += 1
+        self._dropped_events.add(1, {"reason": reason})
+
     def __getattr__(self, name):
         return getattr(self._producer, name, None)
 
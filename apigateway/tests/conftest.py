@@ -22,6 +22,7 @@ def app(request):
             "BOOTSTRAP_TOKEN_EXPIRES": 3600,
             "PROXY_SERVICE_ALLOWED_HEADERS": ["test_allowed_header"],
             "LIMITER_SERVICE_SCALING_COST_ENABLED": False,
+            "KAFKA_PRODUCER_SERVICE_SPOOL_PATH": None,
         },
         name=request.node.name,
     )
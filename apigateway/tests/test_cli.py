@@ -0,0 +1,141 @@
+import datetime
+import time
+
+from apigateway.cli import (
+    backfill_token_digests,
+    cleanup_clients,
+    cleanup_tokens,
+    cleanup_users,
+)
+from apigateway.models import OAuth2Client, OAuth2Token, Role, User
+
+
+class TestCleanup:
+    def _add_token(self, app, access_token: str, expires_in: int):
+        client = OAuth2Client(user_id="test_user", client_id=access_token)
+        app.db.session.add(client)
+        app.db.session.flush()
+        app.db.session.add(
+            OAuth2Token(
+                client_id=client.id,
+                access_token=access_token,
+                issued_at=int(time.time()) - 3600,
+                expires_in=expires_in,
+            )
+        )
+
+    def test_cleanup_tokens(self, app):
+        # Arrange
+        self._add_token(app, "expired_1", 60)
+        self._add_token(app, "expired_2", 60)
+        self._add_token(app, "valid", 7200)
+        app.db.session.commit()
+
+        # Act
+        result = app.test_cli_runner().invoke(cleanup_tokens, ["--batch-size", "1"])
+
+        # Assert
+        assert result.exit_code == 0
+        assert [token.access_token for token in OAuth2Token.query.all()] == ["valid"]
+        assert [client.client_id for client in OAuth2Client.query.all()] == ["valid"]
+
+    def test_cleanup_tokens_dry_run(self, app):
+        # Arrange
+        self._add_token(app, "expired", 60)
+        app.db.session.commit()
+
+        # Act
+        result = app.test_cli_runner().invoke(cleanup_tokens, ["--dry-run"])
+
+        # Assert
+        assert result.exit_code == 0
+        assert OAuth2Token.query.count() == 1
+        assert OAuth2Client.query.count() == 1
+
+    def test_cleanup_users(self, app):
+        # Arrange
+        registered_at = datetime.datetime.now() - datetime.timedelta(days=2)
+        stale_user = User(
+            email="stale@gmail.com", fs_uniquifier="stale_user", registered_at=registered_at
+        )
+        stale_user.roles.append(Role(name="test_role"))
+        app.db.session.add(stale_user)
+        app.db.session.add(
+            User(
+                email="verified@gmail.com",
+                fs_uniquifier="verified_user",
+                registered_at=registered_at,
+                confirmed_at=registered_at,
+            )
+        )
+        app.db.session.commit()
+
+        # Act
+        result = app.test_cli_runner().invoke(cleanup_users, ["--batch-size", "1"])
+        app.db.session.expire_all()
+
+        # Assert
+        assert result.exit_code == 0
+        assert [user.email for user in User.query.all()] == ["verified@gmail.com"]
+        assert Role.query.one().name == "test_role"
+
+    def test_cleanup_clients(self, app):
+        # Arrange
+        last_activity = datetime.datetime.now() - datetime.timedelta(days=100)
+        app.db.session.add(
+            OAuth2Client(user_id="test_user", client_id="inactive", last_activity=last_activity)
+        )
+        app.db.session.add(
+            OAuth2Client(
+                user_id="test_user", client_id="active", last_activity=datetime.datetime.now()
+            )
+        )
+        app.db.session.commit()
+
+        # Act
+        result = app.test_cli_runner().invoke(cleanup_clients, ["--sleep", "0"])
+
+        # Assert
+        assert result.exit_code == 0
+        assert [client.client_id for client in OAuth2Client.query.all()] == ["active"]
+
+    def test_cleanup_clients_invalidates_bootstrap_cache(self, app):
+        # Arrange
+        last_activity = datetime.datetime.now() - datetime.timedelta(days=100)
+        app.db.session.add(
+            OAuth2Client(user_id="test_user", client_id="inactive", last_activity=last_activity)
+        )
+        app.db.session.commit()
+        _, version = app.auth_service.get_cached_bootstrap_response("test_user", "BB client")
+        app.auth_service.cache_bootstrap_response("test_user", "BB client", {"a": 1}, version)
+
+        # Act
+        result = app.test_cli_runner().invoke(cleanup_clients, ["--sleep", "0"])
+
+        # Assert
+        assert result.exit_code == 0
+        assert app.auth_service.get_cached_bootstrap_response("test_user", "BB client")[0] is None
+
+
+class TestBackfill:
+    def test_backfill_token_digests(self, app):
+        # Arrange
+        for access_token in ("token_1", "token_2"):
+            client = OAuth2Client(user_id="test_user", client_id=access_token)
+            app.db.session.add(client)
+            app.db.session.flush()
+            app.db.session.add(OAuth2Token(client_id=client.id, access_token=access_token))
+        app.db.session.commit()
+        OAuth2Token.query.update({"access_token_digest": None})
+        app.db.session.commit()
+
+        # Act
+        result = app.test_cli_runner().invoke(backfill_token_digests, ["--batch-size", "1"])
+        app.db.session.expire_all()
+
+        # Assert
+        assert result.exit_code == 0
+        for token in OAuth2Token.query.all():
+            assert token.access_token_digest == OAuth2Token.get_access_token_digest(
+                token.access_token
+            )
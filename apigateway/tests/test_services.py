@@ -1,11 +1,63 @@
+import json
+import os
+import pickle
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock, call
 
 import pytest
-from flask import request
-
-from apigateway.exceptions import ValidationError
-from apigateway.models import OAuth2Client, OAuth2Token, User
-from apigateway.services import GatewayService
+from flask import Flask, g, request
+from kafka.errors import KafkaTimeoutError, NoBrokersAvailable
+from redis import Redis
+from redis.cluster import RedisCluster
+from redis.crc import key_slot
+from redis.exceptions import ConnectionError
+from redis.sentinel import SentinelConnectionPool
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from apigateway import extensions, utils
+from apigateway.exceptions import ServiceUnavailableError, ValidationError
+from apigateway.serializers import PICKLE, CacheCodec, Codec
+from apigateway.models import (
+    EmailChangeRequest,
+    OAuth2Client,
+    OAuth2Token,
+    PasswordChangeRequest,
+    User,
+    base_model,
+)
+from apigateway.services import (
+    AuthService,
+    CacheService,
+    FailureReportingCache,
+    GatewayService,
+    KafkaProducerService,
+    LimiterService,
+    MaintenanceService,
+    RedisService,
+    ReplicaService,
+    StorageService,
+    redis_down,
+    redis_up,
+)
+from apigateway.utils import (
+    GatewayBearerTokenValidator,
+    MemoryStore,
+    NearCache,
+    PasswordHasher,
+    Spool,
+    hash_id,
+    record_connection_hold_time,
+    release_db_session,
+    use_replica,
+)
 
 
 class TestGatewayService:
@@ -69,6 +121,331 @@ class TestAuthService:
         assert token.user_id == mock_anon_user.get_id()
         assert token.expires_in == app.config.get("BOOTSTRAP_TOKEN_EXPIRES")
 
+    def test_bootstrap_anon_user_partitioned(self, app, mock_anon_user, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "BOOTSTRAP_TOKEN_PARTITIONED", True)
+
+        # Act
+        _, token = app.auth_service.bootstrap_user()
+
+        # Assert
+        assert token.partition_day == (token.issued_at + token.expires_in) // 86400
+        assert token.access_token.startswith("{}-".format(token.partition_day))
+        assert OAuth2Token.get_partition_day(token.access_token) == token.partition_day
+        assert app.auth_service.load_token(token.access_token) == token
+
+    def test_bootstrap_anon_user_partitioned_beyond_last_partition(
+        self, app, mock_anon_user, monkeypatch
+    ):
+        # Arrange
+        monkeypatch.setitem(app.config, "BOOTSTRAP_TOKEN_PARTITIONED", True)
+        monkeypatch.setitem(app.config, "BOOTSTRAP_TOKEN_EXPIRES", 86400 * 7)
+
+        # Act
+        _, token = app.auth_service.bootstrap_user()
+
+        # Assert
+        assert token.partition_day == 0
+        assert OAuth2Token.get_partition_day(token.access_token) == 0
+        assert app.auth_service.load_token(token.access_token) == token
+
+    def test_validate_partition_config(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "BOOTSTRAP_TOKEN_PARTITIONED", True)
+        monkeypatch.setitem(app.config, "MAINTENANCE_SERVICE_PARTITIONS_AHEAD", 3)
+        monkeypatch.setitem(app.config, "BOOTSTRAP_TOKEN_EXPIRES", 86400 * 3)
+
+        # Act & Assert
+        with pytest.raises(ValueError):
+            AuthService().init_app(app)
+
+    def test_bootstrap_cache_per_client(self, app):
+        # Arrange
+        app.auth_service.invalidate_bootstrap_cache("test_user")
+        expires_at = int(time.time()) + 3600
+        _, version = app.auth_service.get_cached_bootstrap_response("test_user", "client_1")
+        app.auth_service.cache_bootstrap_response(
+            "test_user", "client_1", {"a": 1}, version, expires_at
+        )
+        app.auth_service.cache_bootstrap_response(
+            "test_user", "client_2", {"b": 2}, version, expires_at
+        )
+        cached = [
+            app.auth_service.get_cached_bootstrap_response("test_user", "client_1")[0],
+            app.auth_service.get_cached_bootstrap_response("test_user", "client_2")[0],
+        ]
+
+        # Act
+        app.auth_service.invalidate_bootstrap_cache("test_user")
+
+        # Assert
+        assert cached == [{"a": 1}, {"b": 2}]
+        assert app.auth_service.get_cached_bootstrap_response("test_user", "client_1")[0] is None
+        assert app.auth_service.get_cached_bootstrap_response("test_user", "client_2")[0] is None
+
+    def test_bootstrap_cache_invalidated_while_building(self, app):
+        # Arrange
+        _, version = app.auth_service.get_cached_bootstrap_response("test_user", "client_1")
+
+        # Act
+        app.auth_service.invalidate_bootstrap_cache("test_user")
+        app.auth_service.cache_bootstrap_response("test_user", "client_1", {"a": 1}, version)
+
+        # Assert
+        assert app.auth_service.get_cached_bootstrap_response("test_user", "client_1")[0] is None
+
+    def test_load_token_partition_day(self, app, mock_anon_user):
+        # Arrange
+        _, token = app.auth_service.bootstrap_user()
+
+        # Act
+        loaded = app.auth_service.load_token("1-" + token.access_token)
+
+        # Assert
+        assert token.partition_day == 0
+        assert app.auth_service.load_token(token.access_token) == token
+        assert loaded is None
+
+    def test_load_token_by_digest(self, app, mock_anon_user):
+        # Arrange
+        _, token = app.auth_service.bootstrap_user()
+        old_digest = token.access_token_digest
+        token.access_token = "new_access_token"
+        app.db.session.commit()
+
+        # Act
+        loaded = app.auth_service.load_token("new_access_token")
+
+        # Assert
+        assert token.access_token_digest == OAuth2Token.get_access_token_digest("new_access_token")
+        assert token.access_token_digest != old_digest
+        assert loaded == token
+
+    def test_bootstrap_anon_user_stateless(self, app, mock_anon_user, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "BOOTSTRAP_STATELESS_TOKENS", True)
+
+        # Act
+        client, token = app.auth_service.bootstrap_user()
+
+        # Assert
+        assert token.is_stateless
+        assert token.client_id is None
+        assert token.get_client_key() == client.client_id
+        assert token.expires_in == app.config.get("BOOTSTRAP_TOKEN_EXPIRES")
+        assert OAuth2Client.query.count() == 0
+        assert OAuth2Token.query.count() == 0
+
+    def test_bootstrap_anon_user_stateless_reuses_client_id(
+        self, app, mock_anon_user, monkeypatch
+    ):
+        monkeypatch.setitem(app.config, "BOOTSTRAP_STATELESS_TOKENS", True)
+
+        client, _ = app.auth_service.bootstrap_anonymous_user("test_client")
+
+        assert client.client_id == "test_client"
+
+    def test_load_stateless_token(self, app, mock_anon_user, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "BOOTSTRAP_STATELESS_TOKENS", True)
+        client, token = app.auth_service.bootstrap_user()
+
+        # Act
+        loaded_token = app.auth_service.load_stateless_token(token.access_token)
+
+        # Assert
+        assert loaded_token.client.client_id == client.client_id
+        assert loaded_token.user_id == mock_anon_user.get_id()
+        assert loaded_token.issued_at == token.issued_at
+        assert not loaded_token.is_expired()
+
+    def test_load_stateless_token_invalid(self, app, mock_anon_user, monkeypatch):
+        monkeypatch.setitem(app.config, "BOOTSTRAP_STATELESS_TOKENS", True)
+        _, token = app.auth_service.bootstrap_user()
+
+        assert app.auth_service.load_stateless_token(token.access_token + "x") is None
+        assert app.auth_service.load_stateless_token("plain_database_token") is None
+
+    def test_anonymous_user_identity(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(app.auth_service, "_anonymous_user", (None, 0))
+        user = User(
+            email=app.config["ANONYMOUS_BOOTSTRAP_USER_EMAIL"], fs_uniquifier="test_anon_user"
+        )
+        app.db.session.add(user)
+        app.db.session.commit()
+        user_id = user.id
+
+        # Act
+        identity = app.auth_service.anonymous_user_identity
+        User.query.filter_by(id=user_id).delete()
+        app.db.session.commit()
+
+        # Assert
+        assert identity == (user_id, "test_anon_user")
+        assert app.auth_service.anonymous_user_identity == identity
+
+    def test_anonymous_user_identity_missing(self, app, monkeypatch):
+        monkeypatch.setattr(app.auth_service, "_anonymous_user", (None, 0))
+
+        assert app.auth_service.anonymous_user_identity is None
+        assert app.auth_service.load_anonymous_user() is None
+
+    def test_anonymous_user_identity_missing_memoized(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(app.auth_service, "_anonymous_user", (None, 0))
+        user = User(email="test@gmail.com", fs_uniquifier="test_user")
+        app.db.session.add(user)
+        app.db.session.commit()
+        app.db.session.refresh(user)
+        statements = []
+        listener = lambda *args: statements.append(args[2])  # noqa: E731
+        event.listen(app.db.engine, "before_cursor_execute", listener)
+
+        # Act
+        try:
+            checks = [user.is_anonymous_bootstrap_user for _ in range(3)]
+        finally:
+            event.remove(app.db.engine, "before_cursor_execute", listener)
+
+        # Assert
+        assert checks == [False, False, False]
+        assert len(statements) == 1
+
+    def test_load_anonymous_user(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(app.auth_service, "_anonymous_user", (None, 0))
+        app.db.session.add(
+            User(email=app.config["ANONYMOUS_BOOTSTRAP_USER_EMAIL"], fs_uniquifier="test_anon_user")
+        )
+        app.db.session.add(User(email="test@gmail.com", fs_uniquifier="test_user"))
+        app.db.session.commit()
+
+        # Act
+        user = app.auth_service.load_anonymous_user()
+
+        # Assert
+        assert user.fs_uniquifier == "test_anon_user"
+        assert user.is_anonymous_bootstrap_user
+        assert not User.query.filter_by(fs_uniquifier="test_user").first().is_anonymous_bootstrap_user
+
+    def test_persist_hashed_ids(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "PERSIST_HASHED_IDS", True)
+        user = User(email="test@gmail.com", fs_uniquifier="test_user")
+        client = OAuth2Client(user_id="test_user", client_id="test_client")
+
+        # Act
+        app.db.session.add_all([user, client])
+        app.db.session.commit()
+
+        # Assert
+        assert user.hashed_id == hash_id("test_user")
+        assert client.hashed_id == hash_id(client.id)
+        assert OAuth2Client.query.filter_by(hashed_id=hash_id(client.id)).first() == client
+
+    def test_persist_hashed_ids_in_insert(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "PERSIST_HASHED_IDS", True)
+        client = OAuth2Client(id=42, user_id="test_user", client_id="test_client")
+        statements = []
+        listener = lambda *args: statements.append(args[2])  # noqa: E731
+        event.listen(app.db.engine, "before_cursor_execute", listener)
+
+        # Act
+        try:
+            app.db.session.add(client)
+            app.db.session.flush()
+        finally:
+            event.remove(app.db.engine, "before_cursor_execute", listener)
+
+        # Assert
+        assert client.hashed_id == hash_id(42)
+        assert [statement.split()[0] for statement in statements] == ["INSERT"]
+
+    def test_persist_hashed_ids_disabled(self, app):
+        user = User(email="test@gmail.com", fs_uniquifier="test_user")
+        app.db.session.add(user)
+        app.db.session.commit()
+
+        assert user.hashed_id is None
+
+    @pytest.fixture
+    def introspected_token(self, app):
+        app.auth_service._introspection_cache.clear()
+        user = User(email="test@gmail.com", fs_uniquifier="test_user")
+        client = OAuth2Client(user_id="test_user", client_id="test_client")
+        app.db.session.add_all([user, client])
+        app.db.session.flush()
+        token = OAuth2Token(
+            user_id="test_user",
+            client_id=client.id,
+            access_token="test_token",
+            scope="api",
+            issued_at=int(time.time()),
+            expires_in=3600,
+        )
+        app.db.session.add(token)
+        app.db.session.commit()
+        return token
+
+    def test_introspect_token(self, app, introspected_token):
+        # Act
+        response, max_age = app.auth_service.introspect_token("test_token")
+
+        # Assert
+        assert response["active"] is True
+        assert response["scope"] == "api"
+        assert response["client_id"] == "test_client"
+        assert response["username"] == "test@gmail.com"
+        assert response["sub"] == "test_user"
+        assert response["anonymous"] is False
+        assert response["exp"] == introspected_token.issued_at + 3600
+        assert max_age == app.config["AUTH_SERVICE_INTROSPECTION_CACHE_TTL"]
+
+    def test_introspect_token_cached(self, app, introspected_token):
+        # Arrange
+        app.auth_service.introspect_token("test_token")
+        OAuth2Token.query.filter_by(access_token="test_token").delete()
+        app.db.session.commit()
+
+        # Act
+        response, _ = app.auth_service.introspect_token("test_token")
+        app.auth_service.invalidate_introspection("test_token")
+        invalidated_response, _ = app.auth_service.introspect_token("test_token")
+
+        # Assert
+        assert response["active"] is True
+        assert invalidated_response == {"active": False}
+
+    def test_introspect_tokens(self, app, introspected_token, mock_anon_user, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "BOOTSTRAP_STATELESS_TOKENS", True)
+        _, stateless_token = app.auth_service.bootstrap_user()
+
+        # Act
+        responses, _ = app.auth_service.introspect_tokens(
+            ["unknown", "test_token", stateless_token.access_token]
+        )
+
+        # Assert
+        assert responses[0] == {"active": False}
+        assert responses[1]["client_id"] == "test_client"
+        assert responses[2]["active"] is True
+        assert responses[2]["client_id"] == stateless_token.client.client_id
+
+    def test_introspect_unknown_token(self, app):
+        # Arrange
+        app.auth_service._introspection_cache.clear()
+
+        # Act
+        response, max_age = app.auth_service.introspect_token("unknown")
+
+        # Assert
+        assert response == {"active": False}
+        assert max_age == 0
+        assert app.auth_service._introspection_cache.get("unknown") is None
+
     def test_bootstrap_user(self, app, mock_regular_user):
         # Act
         client, token = app.auth_service.bootstrap_user()
@@ -77,6 +454,19 @@ class TestAuthService:
         assert client.user_id == mock_regular_user.get_id()
         assert token.user_id == mock_regular_user.get_id()
 
+    def test_bootstrap_user_existing_client(self, app, mock_regular_user):
+        # Arrange
+        client, _ = app.auth_service.bootstrap_user(client_name="test_client")
+        other_client, _ = app.auth_service.bootstrap_user(client_name="other_client")
+
+        # Act
+        existing_client, _ = app.auth_service.bootstrap_user(client_name="test_client")
+
+        # Assert
+        assert existing_client.id == client.id
+        assert existing_client.id != other_client.id
+        assert existing_client.client_name == "test_client"
+
     def test_bootstrap_user_no_capacity(self, app, mock_regular_user):
         with pytest.raises(ValidationError):
             _, _ = app.auth_service.bootstrap_user(ratelimit_multiplier=100)
@@ -157,11 +547,12 @@ class TestProxyService:
 
         app.proxy_service.register_services()
 
-        calls = [
-            call("http://test.com/resources", mock_response.json.return_value),
-            call("http://test2.com/resources", mock_response.json.return_value),
-        ]
-        mock_storage_service.set.assert_has_calls(calls, any_order=True)
+        mock_storage_service.set_many.assert_called_once_with(
+            {
+                "http://test.com/resources": mock_response.json.return_value,
+                "http://test2.com/resources": mock_response.json.return_value,
+            }
+        )
 
         calls = [
             call("/test/example", "/test", "http://test.com"),
@@ -252,106 +643,524 @@ class TestProxyService:
         mock_limiter_service.shared_limit.assert_called_once_with(counts=300, per_second=86400)
 
 
-class TestLimiterService:
-    def test_group_endpoint(self, app):
+class TestReplicaService:
+    @pytest.fixture
+    def replica_service(self, app, monkeypatch, tmp_path):
+        monkeypatch.setitem(app.config, "REPLICA_SERVICE_URIS", [f"sqlite:///{tmp_path}/replica.db"])
+        monkeypatch.setitem(app.config, "REPLICA_SERVICE_LAG_QUERY", "SELECT 0")
+        replica_service = ReplicaService()
+        replica_service.init_app(app)
+        monkeypatch.setattr(extensions, "replica_service", replica_service)
+
+        replica_engine = replica_service.get_engine()
+        base_model.metadata.create_all(bind=replica_engine)
+        with replica_engine.begin() as connection:
+            connection.execute(
+                User.__table__.insert().values(email="replica@gmail.com", fs_uniquifier="replica")
+            )
+
+        app.db.session.add(User(email="primary@gmail.com", fs_uniquifier="primary"))
+        app.db.session.commit()
+        app.db.session.remove()
+
+        yield replica_service
+
+        app.db.session.remove()
+        replica_engine.dispose()
+
+    def test_use_replica(self, app, replica_service):
+        with use_replica():
+            assert User.query.one().email == "replica@gmail.com"
+
+        assert User.query.one().email == "primary@gmail.com"
+
+    def test_use_replica_after_write(self, app, replica_service):
+        with use_replica():
+            app.db.session.add(User(email="test@gmail.com", fs_uniquifier="test_user"))
+            app.db.session.commit()
+
+            assert User.query.filter_by(fs_uniquifier="primary").first() is not None
+
+    def test_use_replica_lagging(self, app, replica_service, monkeypatch):
+        monkeypatch.setitem(app.config, "REPLICA_SERVICE_LAG_QUERY", "SELECT 60")
+        monkeypatch.setitem(app.config, "REPLICA_SERVICE_CHECK_INTERVAL", 0)
+
+        with use_replica():
+            assert User.query.one().email == "primary@gmail.com"
+
+    def test_load_user_from_primary(self, app, replica_service):
         # Arrange
-        app.limiter_service._ratelimit_groups = {
-            "group1": {
-                "counts": 1,
-                "per_second": 3600 * 10,
-                "patterns": ["/example/.*"],
-            }
-        }
-        app.limiter_service._symbolic_ratelimits = {}
+        with replica_service.get_engine().begin() as connection:
+            connection.execute(
+                User.__table__.insert().values(email="stale@gmail.com", fs_uniquifier="primary")
+            )
 
         # Act
-        app.limiter_service.group_endpoint("/example/test", 300, 86400)
+        with use_replica():
+            user = app.security_service.load_user("primary")
 
         # Assert
-        assert app.limiter_service._symbolic_ratelimits["group1"] == {
-            "name": "group1",
-            "counts": 1,
-            "per_second": 3600 * 10,
-        }
+        assert user.email == "primary@gmail.com"
 
-    def test_shared_limit_with_limit_value(self, app):
+    def test_introspect_token_missing_on_replica(self, app, replica_service):
         # Arrange
-        app.limiter_service.clear_limits("*", None)
+        app.auth_service._introspection_cache.clear()
+        client = OAuth2Client(client_id="test_client")
+        app.db.session.add(client)
+        app.db.session.flush()
+        app.db.session.add(
+            OAuth2Token(
+                client_id=client.id,
+                access_token="test_token",
+                issued_at=int(time.time()),
+                expires_in=3600,
+            )
+        )
+        app.db.session.commit()
+        app.db.session.remove()
 
-        limit_value = "5/minute"
-        decorator = app.limiter_service.shared_limit(limit_value=limit_value)
-        counter = 0
+        # Act
+        with use_replica():
+            response, _ = app.auth_service.introspect_token("test_token")
 
-        @decorator
-        def increment_counter():
-            nonlocal counter
-            counter += 1
+        # Assert
+        assert response["active"] is True
 
-        app.add_url_rule(
-            "/test1",
-            endpoint="/test1",
-            view_func=increment_counter,
-            methods=["GET", "POST"],
+    def test_authenticate_token_missing_on_replica(self, app, replica_service):
+        # Arrange
+        client = OAuth2Client(client_id="test_client")
+        app.db.session.add(client)
+        app.db.session.flush()
+        app.db.session.add(
+            OAuth2Token(
+                client_id=client.id,
+                access_token="test_token",
+                issued_at=int(time.time()),
+                expires_in=3600,
+            )
         )
+        app.db.session.commit()
+        app.db.session.remove()
+        validator = GatewayBearerTokenValidator(app.db.session, OAuth2Token)
 
         # Act
-        with app.test_request_context("/test1"):
-            for _ in range(10):
-                try:
-                    increment_counter()
-                except Exception:
-                    break
+        token = validator.authenticate_token("test_token")
+
         # Assert
-        assert counter == 5
+        assert token is not None
+        assert token.access_token == "test_token"
 
-    def test_shared_limit_with_counts_and_per_second(self, app, mock_current_token):
+
+class TestDatabaseSession:
+    def test_release_db_session_read_only(self, app, monkeypatch):
         # Arrange
+        app.db.session.remove()
+        commit = MagicMock()
+        monkeypatch.setattr(app.db.session, "commit", commit)
+        User.query.all()
 
-        counts, per_second = 3, 60
-        decorator = app.limiter_service.shared_limit(counts=counts, per_second=per_second)
-        counter2 = 0
+        # Act
+        release_db_session()
 
-        @decorator
-        def increment_counter2():
-            nonlocal counter2
-            counter2 += 1
+        # Assert
+        commit.assert_not_called()
+        assert not app.db.session().in_transaction()
 
-        app.add_url_rule(
-            "/test2",
-            endpoint="/test2",
-            view_func=increment_counter2,
-            methods=["GET", "POST"],
-        )
+    def test_release_db_session_after_write(self, app):
+        # Arrange
+        app.db.session.remove()
+        app.db.session.add(User(email="test@gmail.com", fs_uniquifier="test_user"))
+        app.db.session.flush()
 
         # Act
-        with app.test_request_context("/test2"):
-            for _ in range(10):
-                try:
-                    increment_counter2()
-                except Exception:
-                    break
+        release_db_session()
+        app.db.session.remove()
+
         # Assert
-        assert counter2 == 9  # 9 because of rate limit multiplier of 3 for current user
+        assert User.query.filter_by(fs_uniquifier="test_user").first() is not None
 
+    def test_release_db_session_dirty(self, app):
+        # Arrange
+        app.db.session.add(User(email="test@gmail.com", fs_uniquifier="test_user"))
+        app.db.session.commit()
+        User.query.one().email = "changed@gmail.com"
 
-class TestSecurityService:
-    def test_create_user(self, app):
-        email = "test@gmail.com"
-        password = "test_password"
-        user = app.security_service.create_user(email, password)
-        assert user.email == email
-        assert user.password is not None
+        # Act
+        release_db_session()
 
-    def test_create_role(self, app):
-        name = "test_role"
-        description = "This is a test role"
-        role = app.security_service.create_role(name, description)
-        assert role.name == name
-        assert role.description == description
+        # Assert
+        assert User.query.one().email == "test@gmail.com"
 
-    def test_add_role_to_user(self, app):
-        email = "test@gmail.com"
-        password = "test_password"
+    def test_record_connection_hold_time(self, app, monkeypatch):
+        # Arrange
+        histogram = MagicMock()
+        monkeypatch.setattr(utils, "_connection_hold_time", histogram)
+        app.db.session.remove()
+        User.query.all()
+
+        # Act
+        with app.test_request_context("/test"):
+            release_db_session()
+            record_connection_hold_time()
+
+        # Assert
+        histogram.record.assert_called_once()
+        assert histogram.record.call_args.args[0] > 0
+        assert "connection_hold_time" not in app.db.session.info
+
+
+class TestMaintenanceService:
+    @pytest.fixture
+    def maintenance_service(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, "MAINTENANCE_SERVICE_BATCH_SIZE", 4)
+        monkeypatch.setitem(app.config, "MAINTENANCE_SERVICE_MIN_BATCH_SIZE", 1)
+        maintenance_service = MaintenanceService()
+        maintenance_service.init_app(app)
+        return maintenance_service
+
+    def _add_tokens(self, app, count: int, expires_in: int):
+        for _ in range(count):
+            client = OAuth2Client(user_id="test_user")
+            app.db.session.add(client)
+            app.db.session.flush()
+            app.db.session.add(
+                OAuth2Token(
+                    client_id=client.id,
+                    access_token="token_{}".format(client.id),
+                    issued_at=int(time.time()) - 3600,
+                    expires_in=expires_in,
+                )
+            )
+        app.db.session.commit()
+
+    def test_run_once(self, app, maintenance_service):
+        # Arrange
+        self._add_tokens(app, 2, 60)
+        self._add_tokens(app, 1, 7200)
+        stale = datetime.now() - timedelta(days=2)
+        app.db.session.add(PasswordChangeRequest(token="stale", user_id=1, created_at=stale))
+        app.db.session.add(PasswordChangeRequest(token="recent", user_id=1))
+        app.db.session.add(EmailChangeRequest(token="stale", user_id=1, created_at=stale))
+        app.db.session.commit()
+
+        # Act
+        maintenance_service.run_once()
+
+        # Assert
+        assert OAuth2Token.query.one().expires_in == 7200
+        assert OAuth2Client.query.count() == 1
+        assert PasswordChangeRequest.query.one().token == "recent"
+        assert EmailChangeRequest.query.count() == 0
+
+    def test_run_once_invalidates_bootstrap_cache(self, app, maintenance_service):
+        # Arrange
+        client = OAuth2Client(user_id="test_user")
+        app.db.session.add(client)
+        app.db.session.flush()
+        app.db.session.add(
+            OAuth2Token(
+                client_id=client.id,
+                user_id="test_user",
+                access_token="expired",
+                issued_at=int(time.time()) - 3600,
+                expires_in=60,
+            )
+        )
+        app.db.session.commit()
+        _, version = app.auth_service.get_cached_bootstrap_response("test_user", "BB client")
+        app.auth_service.cache_bootstrap_response("test_user", "BB client", {"a": 1}, version)
+
+        # Act
+        maintenance_service.run_once()
+
+        # Assert
+        assert OAuth2Token.query.count() == 0
+        assert app.auth_service.get_cached_bootstrap_response("test_user", "BB client")[0] is None
+
+    def test_expired_tokens_condition_integer_time(self, app):
+        # Act
+        params = MaintenanceService.expired_tokens_condition().compile().params
+
+        # Assert
+        assert all(isinstance(value, int) for value in params.values())
+
+    def test_run_once_slow_database(self, app, maintenance_service, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "MAINTENANCE_SERVICE_TARGET_LATENCY", 0)
+        self._add_tokens(app, 10, 60)
+        start = time.monotonic()
+
+        # Act
+        maintenance_service.run_once()
+
+        # Assert
+        state = maintenance_service._state["expired_tokens"]
+        assert OAuth2Token.query.count() == 6
+        assert state["batch_size"] == 2
+        assert state["last_id"] == 4
+        assert state["due"] > start
+
+    def test_run_once_orphaned_anonymous_clients(self, app, maintenance_service, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(
+            extensions.auth_service, "_anonymous_user", ((1, "anonymous"), time.monotonic() + 60)
+        )
+        last_activity = datetime.now() - timedelta(days=2)
+        orphaned = OAuth2Client(user_id="anonymous", last_activity=last_activity)
+        active = OAuth2Client(user_id="anonymous", last_activity=last_activity)
+        regular = OAuth2Client(user_id="test_user", last_activity=last_activity)
+        app.db.session.add_all([orphaned, active, regular])
+        app.db.session.flush()
+        app.db.session.add(
+            OAuth2Token(client_id=active.id, access_token="active", expires_in=7200)
+        )
+        app.db.session.commit()
+        remaining = {active.id, regular.id}
+
+        # Act
+        maintenance_service.run_once()
+
+        # Assert
+        assert {client.id for client in OAuth2Client.query} == remaining
+
+    def test_run(self, app, maintenance_service, mock_redis_service):
+        # Arrange
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, False, True, True]
+        maintenance_service.run_once = MagicMock(return_value=0)
+        lock = mock_redis_service.lock.return_value
+        lock.acquire.return_value = True
+
+        # Act
+        maintenance_service.run(stop)
+
+        # Assert
+        lock.reacquire.assert_called_once()
+        maintenance_service.run_once.assert_called_once()
+        lock.release.assert_called_once()
+
+    def test_run_idle_renews_lock(self, app, maintenance_service, mock_redis_service):
+        # Arrange
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, False, False, True, True]
+        maintenance_service.run_once = MagicMock(return_value=time.monotonic() + 3600)
+        lock = mock_redis_service.lock.return_value
+        lock.acquire.return_value = True
+
+        # Act
+        maintenance_service.run(stop)
+
+        # Assert
+        assert lock.reacquire.call_count == 2
+        stop.wait.assert_called_with(30)
+
+    def test_run_locked(self, app, maintenance_service, mock_redis_service):
+        # Arrange
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, True]
+        maintenance_service.run_once = MagicMock()
+        mock_redis_service.lock.return_value.acquire.return_value = False
+
+        # Act
+        maintenance_service.run(stop)
+
+        # Assert
+        maintenance_service.run_once.assert_not_called()
+        stop.wait.assert_called_once_with(30)
+
+    def test_execute_ddl_retries_lock_timeout(self, app, maintenance_service, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(time, "sleep", MagicMock())
+        lock_timeout = OperationalError("ALTER TABLE", {}, MagicMock(pgcode="55P03"))
+        connection = MagicMock()
+        connection.execute.side_effect = [lock_timeout, lock_timeout, None]
+
+        # Act
+        maintenance_service._execute_ddl(connection, "ALTER TABLE oauth2token")
+
+        # Assert
+        assert connection.execute.call_count == 3
+
+    def test_execute_ddl_gives_up(self, app, maintenance_service, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(time, "sleep", MagicMock())
+        monkeypatch.setitem(app.config, "MAINTENANCE_SERVICE_PARTITION_RETRIES", 1)
+        lock_timeout = OperationalError("ALTER TABLE", {}, MagicMock(pgcode="55P03"))
+        connection = MagicMock()
+        connection.execute.side_effect = lock_timeout
+
+        # Act
+        with pytest.raises(OperationalError):
+            maintenance_service._execute_ddl(connection, "ALTER TABLE oauth2token")
+
+        # Assert
+        assert connection.execute.call_count == 2
+
+    def test_execute_ddl_other_error(self, app, maintenance_service):
+        # Arrange
+        connection = MagicMock()
+        connection.execute.side_effect = OperationalError(
+            "ALTER TABLE", {}, MagicMock(pgcode="42P01")
+        )
+
+        # Act
+        with pytest.raises(OperationalError):
+            maintenance_service._execute_ddl(connection, "ALTER TABLE oauth2token")
+
+        # Assert
+        assert connection.execute.call_count == 1
+
+
+class TestLimiterService:
+    def test_redis_signals(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(app.limiter_service, "_storage_dead", False)
+        monkeypatch.setattr(extensions.redis_service, "report_failure", MagicMock())
+        storage_url = app.limiter_service._storage_url
+
+        # Act
+        redis_down.send(object(), url=storage_url)
+        other_sender_dead = app.limiter_service._storage_dead
+        redis_down.send(extensions.redis_service, url="redis://other:6379/0")
+        other_url_dead = app.limiter_service._storage_dead
+        redis_down.send(extensions.redis_service, url=storage_url)
+
+        # Assert
+        assert not other_sender_dead
+        assert not other_url_dead
+        assert app.limiter_service._storage_dead
+
+    def test_group_endpoint(self, app):
+        # Arrange
+        app.limiter_service._ratelimit_groups = {
+            "group1": {
+                "counts": 1,
+                "per_second": 3600 * 10,
+                "patterns": ["/example/.*"],
+            }
+        }
+        app.limiter_service._symbolic_ratelimits = {}
+
+        # Act
+        app.limiter_service.group_endpoint("/example/test", 300, 86400)
+
+        # Assert
+        assert app.limiter_service._symbolic_ratelimits["group1"] == {
+            "name": "group1",
+            "counts": 1,
+            "per_second": 3600 * 10,
+        }
+
+    def test_calc_new_mean_time(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(time, "time", lambda: 100.0)
+
+        # Act
+        with app.test_request_context("/mean"):
+            key = app.limiter_service._baseline_key()
+            extensions.storage_service.delete_many([f"{key}/total", f"{key}/requests"])
+            g.request_start_time = 99.0
+            first = app.limiter_service._calc_new_mean_time()
+            g.request_start_time = 98.0
+            second = app.limiter_service._calc_new_mean_time()
+            total = extensions.storage_service.get(f"{key}/total")
+
+        # Assert
+        assert first == (1, 1.0)
+        assert second == (2, 1.5)
+        assert float(total) == 3.0
+
+    def test_shared_limit_with_limit_value(self, app):
+        # Arrange
+        app.limiter_service.clear_limits("*", None)
+
+        limit_value = "5/minute"
+        decorator = app.limiter_service.shared_limit(limit_value=limit_value)
+        counter = 0
+
+        @decorator
+        def increment_counter():
+            nonlocal counter
+            counter += 1
+
+        app.add_url_rule(
+            "/test1",
+            endpoint="/test1",
+            view_func=increment_counter,
+            methods=["GET", "POST"],
+        )
+
+        # Act
+        with app.test_request_context("/test1"):
+            for _ in range(10):
+                try:
+                    increment_counter()
+                except Exception:
+                    break
+        # Assert
+        assert counter == 5
+
+    def test_shared_limit_with_counts_and_per_second(self, app, mock_current_token):
+        # Arrange
+
+        counts, per_second = 3, 60
+        decorator = app.limiter_service.shared_limit(counts=counts, per_second=per_second)
+        counter2 = 0
+
+        @decorator
+        def increment_counter2():
+            nonlocal counter2
+            counter2 += 1
+
+        app.add_url_rule(
+            "/test2",
+            endpoint="/test2",
+            view_func=increment_counter2,
+            methods=["GET", "POST"],
+        )
+
+        # Act
+        with app.test_request_context("/test2"):
+            for _ in range(10):
+                try:
+                    increment_counter2()
+                except Exception:
+                    break
+        # Assert
+        assert counter2 == 9  # 9 because of rate limit multiplier of 3 for current user
+
+    def test_scope_stateless_token(self, app, mock_anon_user, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "BOOTSTRAP_STATELESS_TOKENS", True)
+        client, token = app.auth_service.bootstrap_user()
+
+        # Act
+        with app.test_request_context("/"):
+            g.authlib_server_oauth2_token = token
+            scope = app.limiter_service._scope_func("endpoint")
+
+        # Assert
+        assert scope == "{}:{}".format(token.user.email, client.client_id)
+
+
+class TestSecurityService:
+    def test_create_user(self, app):
+        email = "test@gmail.com"
+        password = "test_password"
+        user = app.security_service.create_user(email, password)
+        assert user.email == email
+        assert user.password is not None
+
+    def test_create_role(self, app):
+        name = "test_role"
+        description = "This is a test role"
+        role = app.security_service.create_role(name, description)
+        assert role.name == name
+        assert role.description == description
+
+    def test_add_role_to_user(self, app):
+        email = "test@gmail.com"
+        password = "test_password"
         user = app.security_service.create_user(email, password)
         name = "test_role"
         description = "This is a test role"
@@ -383,6 +1192,109 @@ class TestSecurityService:
         updated_user = app.security_service.change_email(user, new_email)
         assert updated_user.email == new_email
 
+    def test_load_user_cached(self, app):
+        # Arrange
+        user = app.security_service.create_user("test@gmail.com", "test_password")
+        fs_uniquifier = user.fs_uniquifier
+        statements = []
+
+        def count_statements(*args):
+            statements.append(args)
+
+        # Act
+        event.listen(app.db.engine, "before_cursor_execute", count_statements)
+        try:
+            first = app.security_service.load_user(fs_uniquifier)
+            first_statements = len(statements)
+            second = app.security_service.load_user(fs_uniquifier)
+        finally:
+            event.remove(app.db.engine, "before_cursor_execute", count_statements)
+
+        # Assert
+        assert first.email == second.email == "test@gmail.com"
+        assert first_statements > 0
+        assert len(statements) == first_statements
+
+    def test_load_user_unknown(self, app):
+        assert app.security_service.load_user("unknown") is None
+
+    def test_load_user_invalidated_on_change(self, app):
+        # Arrange
+        user = app.security_service.create_user("test@gmail.com", "test_password")
+        fs_uniquifier = user.fs_uniquifier
+        cached_user = app.security_service.load_user(fs_uniquifier)
+
+        # Act
+        app.security_service.change_email(cached_user, "new_test@gmail.com")
+        loaded_user = app.security_service.load_user(fs_uniquifier)
+
+        # Assert
+        assert loaded_user.email == "new_test@gmail.com"
+
+    def test_validate_password_rehash(self, app, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(
+            app.config, "SECURITY_PASSWORD_HASH_OPTIONS", {"pbkdf2_sha512": {"rounds": 1000}}
+        )
+        user = User(email="test@gmail.com", fs_uniquifier="test_user", password="test_password")
+        old_hash = user.password
+
+        # Act
+        monkeypatch.setitem(
+            app.config, "SECURITY_PASSWORD_HASH_OPTIONS", {"pbkdf2_sha512": {"rounds": 2000}}
+        )
+        valid = user.validate_password("test_password")
+
+        # Assert
+        assert valid
+        assert user.password != old_hash
+        assert "$2000$" in user.password
+        assert user.validate_password("test_password")
+        assert not user.validate_password("wrong_password")
+
+    def test_password_hasher_over_limit(self, app):
+        hasher = PasswordHasher(app.security_service.pwd_context, max_workers=1, max_pending=0)
+
+        with pytest.raises(ServiceUnavailableError):
+            hasher.hash("test_password")
+
+    def test_password_hasher_timeout(self, app, monkeypatch):
+        # Arrange
+        hasher = PasswordHasher(app.security_service.pwd_context, max_workers=1, timeout=0.01)
+        executor = MagicMock()
+        executor.submit.return_value = Future()
+        monkeypatch.setattr(hasher, "_get_executor", lambda: executor)
+
+        # Act & Assert
+        with pytest.raises(ServiceUnavailableError):
+            hasher.hash("test_password")
+        assert executor.submit.return_value.cancelled()
+
+    def test_password_hasher_broken_pool(self, app):
+        # Arrange
+        hasher = PasswordHasher(app.security_service.pwd_context, max_workers=1)
+        executor = MagicMock()
+        executor.submit.side_effect = BrokenProcessPool()
+        hasher._executor = executor
+        hasher._pid = os.getpid()
+
+        # Act & Assert
+        with pytest.raises(ServiceUnavailableError):
+            hasher.hash("test_password")
+        executor.shutdown.assert_called_once()
+        assert hasher._executor is None
+
+    def test_password_hasher_forkserver(self, app):
+        # Arrange
+        hasher = PasswordHasher(app.security_service.pwd_context, max_workers=1)
+
+        # Act
+        hashed = hasher.hash("test_password", rounds=1000)
+        hasher.shutdown()
+
+        # Assert
+        assert app.security_service.pwd_context.verify("test_password", hashed)
+
     def test_generate_email_token(self, app, mock_regular_user):
         token = app.security_service.generate_email_token()
         assert isinstance(token, str)
@@ -394,3 +1306,972 @@ class TestSecurityService:
         token = app.security_service.generate_email_token()
         user = app.security_service.verify_email_token(token)
         assert isinstance(user, User)
+
+
+@pytest.fixture
+def redis_service(app, monkeypatch):
+    redis_service = RedisService()
+    redis_service.init_app(app)
+    monkeypatch.setattr(redis_service, "_probe_min_interval", 0.001)
+    monkeypatch.setattr(redis_service, "_probe_max_interval", 0.001)
+    yield redis_service
+
+    # Stops the prober of tests that leave Redis down
+    monkeypatch.setattr(redis_service, "alive", MagicMock(return_value=True))
+    for prober in list(redis_service._probers.values()):
+        prober.join(timeout=5)
+
+
+class TestRedisService:
+    def test_report_failure(self, app, redis_service, monkeypatch):
+        # Arrange
+        alive = MagicMock(side_effect=[False, False, True])
+        monkeypatch.setattr(redis_service, "alive", alive)
+        events = []
+
+        def on_down(sender, **kwargs):
+            events.append("down")
+
+        def on_up(sender, **kwargs):
+            events.append("up")
+
+        # Act
+        with redis_down.connected_to(on_down, redis_service), redis_up.connected_to(
+            on_up, redis_service
+        ):
+            redis_service.report_failure(ConnectionError())
+            redis_service.report_failure(ConnectionError())
+            available = redis_service.available
+            redis_service._probers[redis_service.url].join(timeout=5)
+
+        # Assert
+        assert not available
+        assert redis_service.available
+        assert alive.call_count == 3
+        assert events == ["down", "up"]
+
+    def test_report_failure_per_deployment(self, app, redis_service, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(redis_service, "alive", MagicMock(return_value=False))
+        cache_url = "redis://redis:6379/1"
+        urls = []
+
+        def on_down(sender, url=None, **kwargs):
+            urls.append(url)
+
+        # Act
+        with redis_down.connected_to(on_down, redis_service):
+            redis_service.report_failure(ConnectionError(), cache_url)
+
+        # Assert
+        assert urls == [cache_url]
+        assert redis_service.available
+        assert not redis_service.is_available(cache_url)
+        assert list(redis_service._probers) == [cache_url]
+
+    def test_limiter_reports_failures_of_its_storage(self, app, monkeypatch):
+        # Arrange
+        limiter_app = Flask("limiter_failures")
+        limiter_app.config["LIMITER_SERVICE_STORAGE_URI"] = "redis://redis:6379/3"
+        limiter_app.config["LIMITER_SERVICE_STRATEGY"] = app.config["LIMITER_SERVICE_STRATEGY"]
+        monkeypatch.setattr(LimiterService, "_register_hooks", lambda self, app: None)
+        redis_service = RedisService()
+        redis_service.init_app(limiter_app)
+        monkeypatch.setattr(redis_service, "alive", MagicMock(return_value=False))
+        limiter_service = LimiterService()
+        limiter_service.init_app(limiter_app, redis_service)
+
+        # Act
+        redis_service.report_failure(ConnectionError())
+        default_down = limiter_service._storage_dead
+        limiter_service._storage_dead = True
+
+        # Assert
+        assert not default_down
+        assert not redis_service.is_available("redis://redis:6379/3")
+        monkeypatch.setattr(redis_service, "alive", MagicMock(return_value=True))
+        for prober in list(redis_service._probers.values()):
+            prober.join(timeout=5)
+        assert not limiter_service._storage_dead
+
+    def test_failure_reporting_cache(self, app, redis_service, monkeypatch):
+        # Arrange
+        report_failure = MagicMock()
+        monkeypatch.setattr(redis_service, "report_failure", report_failure)
+        error = ConnectionError()
+        backend = MagicMock()
+        backend.get.side_effect = error
+        backend.default_timeout = 300
+        cache = FailureReportingCache(backend, redis_service, "redis://redis:6379/1")
+
+        # Act
+        with pytest.raises(ConnectionError):
+            cache.get("key")
+
+        # Assert
+        report_failure.assert_called_once_with(error, "redis://redis:6379/1")
+        assert cache.default_timeout == 300
+
+    def test_connection_pools(self, app, redis_service):
+        # Act
+        pool = redis_service.get_connection_pool()
+        cache_pool = redis_service.get_connection_pool("redis://redis:6379/1")
+
+        # Assert
+        assert redis_service.get_connection_pool(app.config["REDIS_SERVICE_URL"]) is pool
+        assert redis_service._redis_client.connection_pool is pool
+        assert cache_pool is not pool
+        assert cache_pool.connection_kwargs["db"] == 1
+        assert pool.max_connections == 50
+        assert pool.connection_kwargs["socket_connect_timeout"] == 2
+        assert pool.connection_kwargs["health_check_interval"] == 30
+
+    def test_shared_connection_pools(self, app, monkeypatch):
+        # Arrange
+        # Other tests initialize services of their own on the shared app, which replaces
+        # app.redis_service, so the services are set up on an app of this test
+        shared_app = Flask("shared_connection_pools")
+        shared_app.config["LIMITER_SERVICE_STORAGE_URI"] = "redis://redis:6379/0"
+        shared_app.config["LIMITER_SERVICE_STRATEGY"] = app.config["LIMITER_SERVICE_STRATEGY"]
+        shared_app.config["CACHE_SERVICE_REDIS_URI"] = "redis://redis:6379/1"
+        # The hooks of the limiter would stay connected to global signals
+        monkeypatch.setattr(LimiterService, "_register_hooks", lambda self, app: None)
+        redis_service = RedisService()
+        redis_service.init_app(shared_app)
+        limiter_service = LimiterService()
+        limiter_service.init_app(shared_app, redis_service)
+        cache_service = CacheService()
+        cache_service.init_app(shared_app, redis_service)
+
+        # Act
+        limiter_pool = limiter_service._storage.storage.connection_pool
+        cache_pool = shared_app.extensions["cache"][cache_service]._write_client.connection_pool
+
+        # Assert
+        assert limiter_pool is redis_service.get_connection_pool("redis://redis:6379/0")
+        assert cache_pool is redis_service.get_connection_pool("redis://redis:6379/1")
+
+    def test_after_fork(self, app, redis_service, monkeypatch):
+        # Arrange
+        pool = redis_service.get_connection_pool()
+        pool.pid = 0
+        monkeypatch.setattr(redis_service, "alive", MagicMock(return_value=True))
+        monkeypatch.setattr(redis_service, "_down_since", {redis_service.url: time.monotonic()})
+
+        # Act
+        redis_service._after_fork()
+        redis_service._probers[redis_service.url].join(timeout=5)
+
+        # Assert
+        assert pool.pid == os.getpid()
+        assert redis_service.available
+
+
+class TestStorageService:
+    def test_fallback(self, app, redis_service, monkeypatch):
+        # Arrange
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        client = MagicMock()
+        client.set.side_effect = ConnectionError()
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+        monkeypatch.setattr(redis_service, "alive", MagicMock(return_value=False))
+
+        # Act
+        storage_service.set("key_1", "value_1")
+        storage_service.set("key_2", "value_2")
+
+        # Assert
+        assert not redis_service.available
+        assert client.set.call_count == 1
+        assert storage_service.get("key_1") == "value_1"
+        assert client.get.call_count == 0
+
+    def test_transfer_on_recovery(self, app, redis_service, monkeypatch):
+        # Arrange
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        client = MagicMock()
+        client.set.side_effect = ConnectionError()
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+        monkeypatch.setattr(redis_service, "alive", MagicMock(return_value=True))
+
+        # Act
+        storage_service.set("key", "value")
+        redis_service._probers[redis_service.url].join(timeout=5)
+        for thread in threading.enumerate():
+            if thread.name == "storage-resync":
+                thread.join(timeout=5)
+
+        # Assert
+        pipeline = client.pipeline.return_value
+        assert redis_service.available
+        client.pipeline.assert_called_once_with(transaction=False)
+        pipeline.set.assert_called_once_with("key", "value", px=None)
+        pipeline.execute.assert_called_once()
+        assert len(storage_service._fallback_storage) == 0
+
+    def test_transfer_merges_counters(self, app, redis_service, monkeypatch):
+        # Arrange
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        client = MagicMock()
+        pipeline = client.pipeline.return_value
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+        monkeypatch.setitem(redis_service._down_since, redis_service.url, time.monotonic())
+        storage_service.set("key", {"a": 1}, timeout=60)
+        storage_service.set("written", "old")
+        storage_service.incr("counter")
+        storage_service.incrby("counter", 2)
+        storage_service.incrbyfloat("float_counter", 0.5)
+        storage_service.set("set_counter", 5)
+        storage_service.incr("set_counter")
+        monkeypatch.delitem(redis_service._down_since, redis_service.url)
+
+        def write_during_transfer(**kwargs):
+            storage_service.set("written", "new")
+            return pipeline
+
+        client.pipeline.side_effect = write_during_transfer
+
+        # Act
+        storage_service._transfer_to_redis()
+
+        # Assert
+        sets = {c.args[0]: c for c in pipeline.set.call_args_list}
+        assert sets["key"].args[1] == storage_service._serialize({"a": 1})
+        assert 59000 < sets["key"].kwargs["px"] <= 60000
+        assert sets["set_counter"] == call("set_counter", "6", px=None)
+        assert "written" not in sets
+        client.set.assert_called_once_with("written", "new")
+        pipeline.incrby.assert_called_once_with("counter", 3)
+        pipeline.incrbyfloat.assert_called_once_with("float_counter", 0.5)
+        pipeline.pexpire.assert_not_called()
+        assert storage_service._resync_storage is None
+
+    def test_transfer_failure_restores_entries(self, app, redis_service, monkeypatch):
+        # Arrange
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        client = MagicMock()
+        client.pipeline.return_value.execute.side_effect = ConnectionError()
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+        monkeypatch.setitem(redis_service._down_since, redis_service.url, time.monotonic())
+        monkeypatch.setattr(
+            redis_service,
+            "report_failure",
+            lambda ex=None: redis_service._down_since.setdefault(redis_service.url, 0),
+        )
+        storage_service.set("key", "value")
+        storage_service.incr("counter")
+        monkeypatch.delitem(redis_service._down_since, redis_service.url)
+
+        # Act
+        storage_service._transfer_to_redis()
+        storage_service.incr("counter")
+
+        # Assert
+        assert not redis_service.available
+        assert storage_service.get("key") == "value"
+        assert storage_service.get("counter") == 2
+
+    def test_batch_operations(self, app, redis_service, monkeypatch):
+        # Arrange
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        client = MagicMock()
+        pipeline = client.pipeline.return_value
+        pipeline.execute.return_value = [b"5", None, 1, 0]
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+
+        # Act
+        with storage_service.pipeline() as storage_pipeline:
+            storage_pipeline.get("count").get("missing").has("count").has("missing")
+
+        # Assert
+        assert storage_pipeline.results == [5, None, True, False]
+        client.pipeline.assert_called_once_with(transaction=False)
+        pipeline.execute.assert_called_once()
+
+    def test_batch_operations_fallback(self, app, redis_service, monkeypatch):
+        # Arrange
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        client = MagicMock()
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+        monkeypatch.setitem(redis_service._down_since, redis_service.url, time.monotonic())
+
+        # Act
+        storage_service.set_many({"a": "value", "b": {"key": "value"}}, timeout=60)
+        counts = storage_service.incr_many({"count": 2, "time": 0.5})
+        deleted = storage_service.delete_many(["a", "missing"])
+
+        # Assert
+        assert counts == [2, 0.5]
+        assert deleted == 1
+        assert storage_service.get_many(["a", "b", "count"]) == [None, {"key": "value"}, 2]
+        client.pipeline.assert_not_called()
+
+    def test_pipeline_connection_error(self, app, redis_service, monkeypatch):
+        # Arrange
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        client = MagicMock()
+        client.pipeline.return_value.execute.side_effect = ConnectionError()
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+        monkeypatch.setattr(
+            redis_service,
+            "report_failure",
+            lambda ex=None: redis_service._down_since.setdefault(redis_service.url, 0),
+        )
+
+        # Act
+        with storage_service.pipeline() as storage_pipeline:
+            storage_pipeline.set("key", "value").incr("count").get("key")
+
+        # Assert
+        assert not redis_service.available
+        assert storage_pipeline.results == [True, 1, "value"]
+
+    def test_near_cache(self, app, redis_service, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "STORAGE_SERVICE_NEAR_CACHE_ENABLED", True)
+        monkeypatch.setitem(app.config, "STORAGE_SERVICE_NEAR_CACHE_PREFIXES", ["near/"])
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        monkeypatch.setattr(storage_service, "_start_near_cache_listener", MagicMock())
+        monkeypatch.setattr(storage_service, "_near_cache_pid", os.getpid())
+        monkeypatch.setattr(storage_service, "_near_cache_listener", threading.current_thread())
+        storage_service._near_cache_ready.set()
+        client = MagicMock()
+        client.get.side_effect = lambda key: storage_service._serialize({"key": key})
+        pipeline = client.pipeline.return_value
+        pipeline.execute.side_effect = lambda: [storage_service._serialize("far/value")]
+        monkeypatch.setattr(redis_service, "_redis_client", client)
+
+        # Act
+        first = storage_service.get("near/key")
+        second = storage_service.get("near/key")
+        storage_service.get("far/key")
+        storage_service.get("far/key")
+        many = storage_service.get_many(["near/key", "far/key"])
+        storage_service._on_invalidation(
+            [b"message", b"__redis__:invalidate", [b"near/key", b"near/other"]]
+        )
+        storage_service.get("near/key")
+        storage_service.set("near/key", "value")
+        storage_service.get("near/key")
+
+        # Assert
+        assert first == second == {"key": "near/key"}
+        assert first is not second
+        assert many == [{"key": "near/key"}, "far/value"]
+        pipeline.get.assert_called_once_with("far/key")
+        assert [c.args[0] for c in client.get.call_args_list] == [
+            "near/key",
+            "far/key",
+            "far/key",
+            "near/key",
+            "near/key",
+        ]
+        stats = storage_service.near_cache_stats()
+        assert (stats["hits"], stats["misses"]) == (2, 3)
+        assert stats["hit_rate"] == 0.4
+        assert stats["entries"] == 1
+
+    def test_near_cache_listener(self, app, redis_service, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "STORAGE_SERVICE_NEAR_CACHE_ENABLED", True)
+        monkeypatch.setitem(app.config, "STORAGE_SERVICE_NEAR_CACHE_PREFIXES", ["a/", "b/"])
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        invalidate = MagicMock()
+        monkeypatch.setattr(storage_service._near_cache, "invalidate", invalidate)
+        listener, tracker = MagicMock(), MagicMock()
+        listener.read_response.side_effect = [
+            7,
+            [b"subscribe", b"__redis__:invalidate", 1],
+            [b"message", b"__redis__:invalidate", [b"a/key"]],
+        ]
+        ready = []
+
+        def can_read(timeout):
+            if listener.read_response.call_count < 3:
+                return True
+            ready.append(storage_service._near_cache_ready.is_set())
+            storage_service._near_cache_stop.set()
+            return False
+
+        listener.can_read.side_effect = can_read
+        pool = MagicMock(connection_kwargs={})
+        pool.connection_class.side_effect = [listener, tracker]
+        monkeypatch.setattr(redis_service, "get_connection_pool", lambda: pool)
+
+        # Act
+        storage_service._listen_for_invalidations()
+
+        # Assert
+        tracker.send_command.assert_any_call(
+            "CLIENT", "TRACKING", "ON", "REDIRECT", 7, "BCAST", "PREFIX", "a/", "PREFIX", "b/"
+        )
+        listener.send_command.assert_called_with("SUBSCRIBE", "__redis__:invalidate")
+        invalidate.assert_called_once_with("a/key")
+        assert ready == [True]
+        assert not storage_service._near_cache_ready.is_set()
+        listener.disconnect.assert_called_once()
+        tracker.disconnect.assert_called_once()
+
+
+def _free_port() -> int:
+    # Cluster nodes also listen on their port + 10000
+    while True:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        if port < 55535:
+            return port
+
+
+def _wait_for(condition: callable, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Redis did not start")
+        time.sleep(0.05)
+
+
+def _ping(port: int) -> bool:
+    try:
+        return Redis(port=port).ping()
+    except ConnectionError:
+        return False
+
+
+@pytest.fixture(scope="module")
+def redis_deployments(tmp_path_factory):
+    """Starts a primary monitored by a sentinel and a cluster of three primaries.
+
+    Yields:
+        dict: The URLs of the deployments by mode.
+    """
+    redis_server = shutil.which("redis-server")
+    if redis_server is None:
+        pytest.skip("redis-server is not installed")
+
+    directory = tmp_path_factory.mktemp("redis")
+    processes = []
+
+    def start(*args: str) -> int:
+        port = _free_port()
+        processes.append(
+            subprocess.Popen(
+                [redis_server, *args, "--port", str(port)],
+                cwd=directory,
+                stdout=subprocess.DEVNULL,
+            )
+        )
+        _wait_for(lambda: _ping(port))
+        return port
+
+    try:
+        primary = start("--save", "", "--appendonly", "no")
+        sentinel_conf = directory / "sentinel.conf"
+        sentinel_conf.write_text(f"sentinel monitor gateway 127.0.0.1 {primary} 1\n")
+        sentinel = start(str(sentinel_conf), "--sentinel")
+
+        nodes = [
+            start(
+                "--save",
+                "",
+                "--cluster-enabled",
+                "yes",
+                "--cluster-config-file",
+                f"nodes-{i}.conf",
+            )
+            for i in range(3)
+        ]
+        for i, port in enumerate(nodes):
+            client = Redis(port=port)
+            slots = range(i * 16384 // 3, (i + 1) * 16384 // 3)
+            client.execute_command("CLUSTER ADDSLOTS", *slots)
+            client.execute_command("CLUSTER MEET", "127.0.0.1", nodes[0])
+        _wait_for(
+            lambda: all(
+                Redis(port=port).cluster("INFO")["cluster_state"] == "ok" for port in nodes
+            )
+        )
+
+        yield {
+            "sentinel": f"redis+sentinel://127.0.0.1:{sentinel}/gateway/2",
+            "cluster": "redis+cluster://" + ",".join(f"127.0.0.1:{port}" for port in nodes),
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+
+class TestRedisDeployments:
+    def test_sentinel(self, app, redis_deployments, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "REDIS_SERVICE_URL", redis_deployments["sentinel"])
+        redis_service = RedisService()
+        redis_service.init_app(app)
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+
+        # Act
+        storage_service.set("key", {"a": 1})
+        counts = storage_service.incr_many({"count": 2, "time": 0.5})
+
+        # Assert
+        assert storage_service.get_many(["key", "count"]) == [{"a": 1}, 2]
+        assert isinstance(redis_service.get_connection_pool(), SentinelConnectionPool)
+        assert redis_service.get_connection_pool().connection_kwargs["db"] == 2
+        assert counts == [2, 0.5]
+
+    def test_cluster(self, app, redis_deployments, monkeypatch):
+        # Arrange
+        monkeypatch.setitem(app.config, "REDIS_SERVICE_URL", redis_deployments["cluster"])
+        redis_service = RedisService()
+        redis_service.init_app(app)
+        storage_service = StorageService()
+        storage_service.init_app(app, redis_service)
+        keys = ["LIMITER_SERVICE//{endpoint}/time", "LIMITER_SERVICE//{endpoint}/count"]
+        cache_app = Flask("cache")
+        cache_app.config["CACHE_SERVICE_REDIS_URI"] = redis_deployments["cluster"]
+        cache_service = CacheService()
+        cache_service.init_app(cache_app, redis_service)
+
+        # Act
+        storage_service.set_many({f"key_{i}": i for i in range(20)})
+        with storage_service.pipeline() as pipeline:
+            pipeline.set(keys[0], {"mean": 0.5}).incr(keys[1]).get(keys[0])
+        with cache_app.app_context():
+            cache_service.set("view/{/a}/1", (b"a", 200))
+            cache_service.set("view/{/b}/1", (b"b", 200))
+            cached = [cache_service.get("view/{/a}/1"), cache_service.get("view/{/b}/1")]
+            cleared = cache_service.clear_cache("*", {})
+            remaining = cache_service.get("view/{/a}/1")
+
+        # Assert
+        assert isinstance(redis_service.get_client(), RedisCluster)
+        assert redis_service.get_connection_pool() is None
+        assert storage_service.get_many([f"key_{i}" for i in range(20)]) == list(range(20))
+        assert pipeline.results == [True, 1, {"mean": 0.5}]
+        assert key_slot(keys[0].encode()) == key_slot(keys[1].encode())
+        assert cached == [(b"a", 200), (b"b", 200)]
+        assert cleared
+        assert remaining is None
+
+    def test_hash_tags(self, app):
+        # Act
+        cache_keys = [
+            app.cache_service._make_cache_key("/search/query", [("q", query)])
+            for query in ("star", "galaxy")
+        ]
+        with app.test_request_context():
+            baseline_key = app.limiter_service._baseline_key("endpoint")
+
+        # Assert
+        assert cache_keys[0].startswith("view/{/search/query}/")
+        assert key_slot(cache_keys[0].encode()) == key_slot(cache_keys[1].encode())
+        assert app.auth_service._bootstrap_cache_key("user") == "AUTH_SERVICE//bootstrap/{user}"
+        assert app.auth_service._bootstrap_cache_key("user", "client") == (
+            "AUTH_SERVICE//bootstrap/{user}/client"
+        )
+        assert baseline_key == "LIMITER_SERVICE//{endpoint}"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestNearCache:
+    def test_fill_after_invalidation(self):
+        # Arrange
+        near_cache = NearCache(shards=1)
+        generation = near_cache.generation("key")
+
+        # Act
+        near_cache.invalidate("other")
+        stale = near_cache.fill("key", b"stale", generation)
+        fresh = near_cache.fill("key", b"fresh", near_cache.generation("key"))
+
+        # Assert
+        assert not stale
+        assert fresh
+        assert near_cache.get("key") == b"fresh"
+
+    def test_ttl_and_clear(self):
+        # Arrange
+        clock = FakeClock()
+        near_cache = NearCache(ttl=10, timer=clock)
+        near_cache.fill("key", b"value", near_cache.generation("key"))
+        near_cache.fill("other", b"value", near_cache.generation("other"))
+
+        # Act
+        clock.now = 10
+        expired = near_cache.get("key")
+        generation = near_cache.generation("other")
+        near_cache.clear()
+
+        # Assert
+        assert expired is None
+        assert len(near_cache) == 0
+        assert near_cache.generation("other") == generation + 1
+
+
+class TestMemoryStore:
+    def test_ttl(self):
+        # Arrange
+        clock = FakeClock()
+        store = MemoryStore(timer=clock)
+        store.set("key", "value", timeout=10)
+        store.set("permanent", "value")
+
+        # Act
+        clock.now = 9
+        before = store.get("key")
+        clock.now = 10
+        after = store.get("key")
+
+        # Assert
+        assert before == "value"
+        assert after is None
+        assert store.get("permanent") == "value"
+        assert store.ttl("permanent") is None
+
+    def test_counters(self):
+        # Arrange
+        clock = FakeClock()
+        store = MemoryStore(timer=clock)
+        store.set("counter", 5, timeout=10)
+        store.set("text", "value")
+
+        # Act
+        clock.now = 4
+        value = store.incrby("counter", 2)
+
+        # Assert
+        assert value == 7
+        assert store.ttl("counter") == 6
+        assert store.incrby("new") == 1
+        assert store.incrbyfloat("new", 0.5) == 1.5
+        with pytest.raises(ValueError):
+            store.incrby("text")
+        with pytest.raises(ValueError):
+            store.incrby("new")
+
+    def test_lru_eviction(self):
+        # Arrange
+        store = MemoryStore(max_entries=3, shards=1)
+        for key in ("a", "b", "c"):
+            store.set(key, key)
+
+        # Act
+        store.get("a")
+        store.set("d", "d")
+
+        # Assert
+        assert not store.has("b")
+        assert [store.get(key) for key in ("a", "c", "d")] == ["a", "c", "d"]
+        assert store.stats()["evictions"] == 1
+
+    def test_max_bytes(self):
+        # Arrange
+        store = MemoryStore(max_bytes=10000, shards=1)
+
+        # Act
+        for i in range(100):
+            store.set("key_{}".format(i), "x" * 1000)
+
+        # Assert
+        assert store.stats()["bytes"] <= 10000
+        assert 0 < len(store) < 10
+        assert store.has("key_99")
+
+    def test_long_outage(self):
+        # Arrange
+        clock = FakeClock()
+        store = MemoryStore(max_entries=1000, max_bytes=1024 * 1024, shards=4, timer=clock)
+
+        # Act - six hours of per-minute limiter counters that expire after a minute, and of
+        # more documents than fit into the store
+        for second in range(6 * 3600):
+            clock.now = second
+            key = "count/user_{}/{}".format(second % 50, second // 60)
+            if not store.has(key):
+                store.set(key, 0, timeout=60)
+            store.incrby(key)
+            store.set("resource_{}".format(second % 2000), {"endpoint": "/" * 100})
+
+        # Assert
+        stats = store.stats()
+        assert len(store) <= 1000
+        assert stats["bytes"] <= 1024 * 1024
+        assert stats["evictions"] > 0
+        assert stats["expirations"] > 0
+        assert store.get("count/user_0/0") is None
+        assert store.get("count/user_49/359") == 2
+        assert store.get("resource_{}".format((6 * 3600 - 1) % 2000)) is not None
+
+    def test_concurrent_increments(self):
+        # Arrange
+        store = MemoryStore()
+
+        def increment():
+            for i in range(1000):
+                store.incrby("counter_{}".format(i % 10), 1)
+
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+
+        # Act
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Assert
+        assert [store.get("counter_{}".format(i)) for i in range(10)] == [800] * 10
+
+
+@pytest.fixture
+def kafka_app(monkeypatch, tmp_path):
+    producer = MagicMock()
+    monkeypatch.setattr("apigateway.services.KafkaProducer", MagicMock(return_value=producer))
+    monkeypatch.setattr("apigateway.services.atexit", MagicMock())
+
+    kafka_app = Flask("kafka")
+    kafka_app.config.update(
+        KAFKA_PRODUCER_SERVICE_REQUEST_TOPIC="requests",
+        KAFKA_PRODUCER_SERVICE_QUEUE_SIZE=2,
+        KAFKA_PRODUCER_SERVICE_LINGER_MS=1,
+        KAFKA_PRODUCER_SERVICE_SPOOL_PATH=str(tmp_path / "spool"),
+    )
+    kafka_app.add_url_rule("/search", "search", lambda: "ok")
+    kafka_app.producer = producer
+    return kafka_app
+
+
+class TestKafkaProducerService:
+    def test_request_events(self, kafka_app, mock_regular_user, monkeypatch):
+        # Arrange
+        kafka_producer_service = KafkaProducerService()
+        kafka_producer_service.init_app(kafka_app)
+        monkeypatch.setattr(kafka_producer_service, "_start_sender", MagicMock())
+
+        # Act
+        for _ in range(3):
+            kafka_app.test_client().get("/search")
+        queued = len(kafka_producer_service._events)
+        kafka_producer_service._connect()
+        kafka_producer_service.flush(1)
+
+        # Assert
+        assert queued == 2
+        assert kafka_producer_service.dropped_events == 1
+        assert kafka_app.producer.send.call_count == 2
+        topic, value = kafka_app.producer.send.call_args.args
+        event = json.loads(value)
+        assert topic == "requests"
+        assert event["user_id"] == "test_user"
+        assert event["endpoint"] == "search"
+        assert event["method"] == "GET"
+        assert event["status_code"] == 200
+        assert datetime.fromisoformat(event["timestamp"]) <= datetime.now()
+        kafka_app.producer.flush.assert_called_once_with(1)
+
+    def test_sender_thread(self, kafka_app):
+        # Arrange
+        kafka_producer_service = KafkaProducerService()
+        kafka_producer_service.init_app(kafka_app)
+        threads = []
+        kafka_app.producer.send.side_effect = (
+            lambda *args: threads.append(threading.current_thread().name) or MagicMock()
+        )
+
+        # Act
+        kafka_producer_service.enqueue(("user", "", "search", "GET", time.time(), 200))
+        deadline = time.time() + 5
+        while not threads and time.time() < deadline:
+            time.sleep(0.01)
+        kafka_producer_service.close(1)
+
+        # Assert
+        assert threads == ["kafka-request-events"]
+        assert kafka_producer_service._sender_pid == os.getpid()
+        assert not kafka_producer_service._events
+
+    def test_spool_while_unavailable(self, kafka_app, tmp_path, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(
+            "apigateway.services.KafkaProducer",
+            MagicMock(side_effect=[NoBrokersAvailable(), kafka_app.producer]),
+        )
+        kafka_producer_service = KafkaProducerService()
+        kafka_producer_service.init_app(kafka_app)
+        kafka_producer_service._sender_pid = os.getpid()
+        kafka_producer_service._spool = Spool(str(tmp_path / "spool" / "0"))
+
+        def send_events(*user_ids):
+            for user_id in user_ids:
+                kafka_producer_service.enqueue((user_id, "", "search", "GET", time.time(), 200))
+            kafka_producer_service._send_events()
+
+        def sent_user_ids():
+            return [
+                json.loads(c.args[1])["user_id"] for c in kafka_app.producer.send.call_args_list
+            ]
+
+        # Act
+        connected = kafka_producer_service._connect()
+        send_events("a", "b")
+        spooled = len(kafka_producer_service._spool)
+        reconnected = kafka_producer_service._connect()
+        send_events("c")
+        kafka_app.producer.send.side_effect = KafkaTimeoutError()
+        send_events("d", "e")
+        kafka_producer_service._send_events()
+        spooled_user_ids = [
+            json.loads(kafka_producer_service._spool.pop())["user_id"] for _ in range(2)
+        ]
+
+        # Assert
+        assert not connected
+        assert spooled == 2
+        assert reconnected
+        assert sent_user_ids() == ["a", "b", "c", "d"]
+        assert not kafka_producer_service.connected
+        assert spooled_user_ids == ["d", "e"]
+        assert kafka_producer_service.dropped_events == 0
+
+    def test_failed_batches(self, kafka_app, tmp_path):
+        # Arrange
+        kafka_producer_service = KafkaProducerService()
+        kafka_producer_service.init_app(kafka_app)
+        kafka_producer_service._spool = Spool(str(tmp_path / "spool" / "0"))
+        kafka_producer_service._connect()
+        future = kafka_app.producer.send.return_value
+
+        # Act
+        kafka_producer_service._send(kafka_app.producer, b"event")
+        errback, *args = future.add_errback.call_args.args
+        errback(*args, KafkaTimeoutError())
+
+        # Assert
+        assert not kafka_producer_service.connected
+        assert kafka_producer_service._spool.pop() == b"event"
+
+
+class TestSpool:
+    def test_append_and_pop(self, tmp_path):
+        # Arrange
+        spool = Spool(str(tmp_path), segment_size=64, max_bytes=192)
+        records = [b"record-%02d" % i for i in range(20)]
+
+        # Act
+        appended = [spool.append(record) for record in records]
+        segments = sorted(os.listdir(tmp_path))
+        popped = [spool.pop() for _ in range(13)]
+
+        # Assert
+        assert appended == [True] * 12 + [False] * 8
+        assert segments == ["000000000000.seg", "000000000001.seg", "000000000002.seg", "lock"]
+        assert popped == records[:12] + [None]
+        assert sorted(os.listdir(tmp_path)) == ["000000000002.seg", "lock"]
+        assert spool.append(b"x" * 60) is True
+        assert spool.append(b"x" * 61) is False
+
+    def test_reopen(self, tmp_path):
+        # Arrange
+        spool = Spool(str(tmp_path), segment_size=64)
+        for i in range(8):
+            spool.append(b"record-%02d" % i)
+        spool.pop()
+        spool.pop()
+
+        # Act
+        with pytest.raises(BlockingIOError):
+            Spool(str(tmp_path))
+        spool.close()
+        reopened = Spool(str(tmp_path), segment_size=64)
+        reopened.append(b"record-08")
+
+        # Assert
+        assert len(reopened) == 7
+        assert [reopened.pop() for _ in range(7)] == [b"record-%02d" % i for i in range(2, 9)]
+
+
+class TestCodec:
+    def test_round_trip(self):
+        # Arrange
+        codec = Codec()
+        values = [
+            "value",
+            b"raw",
+            1.5,
+            True,
+            None,
+            {"/endpoint": {"methods": ["GET"], "rate_limit": [300, 86400]}},
+            ("body", 200),
+            {1: datetime(2024, 1, 1)},
+        ]
+
+        # Act
+        decoded = [codec.loads(codec.dumps(value)) for value in values]
+
+        # Assert
+        assert decoded == values
+        assert type(decoded[6]) is tuple
+
+    def test_integers_as_text(self):
+        # Arrange
+        codec = Codec()
+
+        # Act
+        encoded = codec.dumps(42)
+
+        # Assert
+        assert encoded == b"42"
+        assert codec.loads(encoded) == 42
+        assert codec.loads(b"-3") == -3
+
+    def test_read_other_formats(self):
+        # Arrange
+        legacy = PICKLE + pickle.dumps({"key": "value"})
+        msgpack_codec = Codec("msgpack")
+        pickle_codec = Codec("pickle")
+
+        # Act
+        pickled = pickle_codec.dumps(["value"])
+
+        # Assert
+        assert pickled.startswith(PICKLE)
+        assert msgpack_codec.loads(legacy) == {"key": "value"}
+        assert msgpack_codec.loads(pickled) == ["value"]
+        assert pickle_codec.loads(msgpack_codec.dumps(["value"])) == ["value"]
+        with pytest.raises(ValueError):
+            Codec("json")
+
+    def test_response_layout(self):
+        # Arrange
+        codec = CacheCodec(allowed_headers=["Content-Type"])
+        body = b'{"response": {"docs": []}}'
+        headers = {"content-type": "application/json", "Server": "gunicorn", "Date": "today"}
+
+        # Act
+        encoded = codec.dumps((body, 200, headers))
+        decoded = codec.loads(encoded)
+
+        # Assert
+        assert encoded.endswith(body)
+        assert b"gunicorn" not in encoded
+        assert decoded == (body, 200, {"content-type": "application/json"})
+        assert codec.loads(codec.dumps((body, 504))) == (body, 504)
+        assert codec.loads(codec.dumps((body, 200, {}))) == (body, 200, {})
+        assert codec.loads(codec.dumps({"key": "value"})) == {"key": "value"}
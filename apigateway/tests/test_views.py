@@ -1,18 +1,20 @@
+import time
 from datetime import datetime
 from unittest import mock
 from unittest.mock import MagicMock, patch
 
 import pytest
 import requests
+from flask.sessions import SecureCookieSessionInterface
 from flask_login import current_user, login_user
 from marshmallow import ValidationError
 from werkzeug.exceptions import Unauthorized
 
 from apigateway import views
 from apigateway.email_templates import EmailChangedNotification, VerificationEmail
-from apigateway.models import AnonymousUser, EmailChangeRequest, User
+from apigateway.models import AnonymousUser, EmailChangeRequest, OAuth2Client, OAuth2Token, User
 from apigateway.schemas import bootstrap_response
-from apigateway.utils import ProxyView
+from apigateway.utils import ProxyView, hash_id
 
 
 class TestBootstrapView:
@@ -61,6 +63,38 @@ class TestBootstrapView:
             assert not bootstrap_response.validate(response)
             assert parsed_response.scopes == req_json["scope"].split(" ")
 
+    def test_get_authenticated_user_cached(
+        self, app, bootstrap, mock_regular_user, authenticated_user
+    ):
+        app.auth_service.invalidate_bootstrap_cache(mock_regular_user.get_id())
+        with app.test_request_context(json={}):
+            response, _ = bootstrap.get()
+
+        with patch.object(app.auth_service, "bootstrap_user") as mock_bootstrap_user:
+            with app.test_request_context(json={}):
+                cached_response, status_code = bootstrap.get()
+
+        assert status_code == 200
+        assert cached_response == response
+        mock_bootstrap_user.assert_not_called()
+
+    def test_get_authenticated_user_cache_invalidated(
+        self, app, bootstrap, mock_regular_user, authenticated_user
+    ):
+        with app.test_request_context(json={}):
+            bootstrap.get()
+
+        app.auth_service.invalidate_bootstrap_cache(mock_regular_user.get_id())
+
+        with patch.object(
+            app.auth_service, "bootstrap_user", wraps=app.auth_service.bootstrap_user
+        ) as mock_bootstrap_user:
+            with app.test_request_context(json={}):
+                _, status_code = bootstrap.get()
+
+        assert status_code == 200
+        mock_bootstrap_user.assert_called_once()
+
     def test_get_anonymous_user_with_params(self, app, bootstrap, mock_anon_user):
         json = {"scope": "test_scope", "client_name": "test_client", "redirect_uri": "test_uri"}
         with app.test_request_context(json=json):
@@ -188,6 +222,40 @@ class TestProxyView:
         response = client.get("/proxy")
         assert "test_disallowed_header" not in list(response.headers.keys())
 
+    def test_proxy_request_with_token(self, app, client, mock_session, mock_requests, monkeypatch):
+        # The module's app already served requests, routes can still be added for this test
+        monkeypatch.setattr(app, "_got_first_request", False)
+        monkeypatch.setitem(
+            app.config, "PROXY_SERVICE_WEBSERVICES", {"http://remote.com": "/token_proxy"}
+        )
+        mock_requests("get").return_value.json.return_value = {
+            "/search": {"methods": ["GET"], "scopes": ["api"], "rate_limit": [300, 86400]}
+        }
+        app.proxy_service.register_services()
+
+        user = User(email="test@gmail.com", fs_uniquifier="test_user", ratelimit_quota=-1)
+        oauth_client = OAuth2Client(user_id="test_user", client_id="test_client")
+        app.db.session.add_all([user, oauth_client])
+        app.db.session.flush()
+        app.db.session.add(
+            OAuth2Token(
+                user_id="test_user",
+                client_id=oauth_client.id,
+                access_token="test_token",
+                scope="api",
+                issued_at=int(datetime.now().timestamp()),
+                expires_in=3600,
+            )
+        )
+        app.db.session.commit()
+
+        response = client.get(
+            "/token_proxy/search", headers={"Authorization": "Bearer test_token"}
+        )
+
+        assert response.status_code == 200
+        assert mock_session.return_value.get.call_count == 1
+
 
 class TestCSRFView:
     @pytest.fixture
@@ -279,6 +347,36 @@ class TestUserManagementView:
             assert status_code == 200
             assert response["message"] == "success"
 
+    def test_delete_user_invalidates_introspection(
+        self, app, user_management_view, authenticated_user
+    ):
+        # Arrange
+        client = OAuth2Client(user_id="unique_id", client_id="test_client")
+        app.db.session.add(client)
+        app.db.session.flush()
+        app.db.session.add(
+            OAuth2Token(
+                client_id=client.id,
+                user_id="unique_id",
+                access_token="test_token",
+                issued_at=int(time.time()),
+                expires_in=3600,
+            )
+        )
+        app.db.session.commit()
+        app.auth_service._introspection_cache.clear()
+        app.auth_service.introspect_token("test_token")
+        cached = app.auth_service._introspection_cache.get("test_token")
+
+        # Act
+        with app.test_request_context():
+            login_user(authenticated_user)
+            user_management_view.delete()
+
+        # Assert
+        assert cached is not None
+        assert app.auth_service._introspection_cache.get("test_token") is None
+
 
 class TestLogoutView:
     @pytest.fixture
@@ -523,3 +621,139 @@ class TestVerifyEmailView:
             login_user(authenticated_user)
             with pytest.raises(ValueError, match="unknown verification token"):
                 verify_email_view.get("invalid_token")
+
+
+class TestIntrospectView:
+    def test_post(self, app):
+        with patch.object(
+            app.auth_service, "introspect_token", return_value=({"active": False}, 30)
+        ) as mock_introspect_token:
+            with app.test_request_context(method="POST", data={"token": "test_token"}):
+                response, status_code, headers = views.IntrospectView().post()
+
+        assert status_code == 200
+        assert response == {"active": False}
+        assert headers["Cache-Control"] == "private, max-age=30"
+        mock_introspect_token.assert_called_once_with("test_token")
+
+    def test_post_batch(self, app):
+        with patch.object(
+            app.auth_service, "introspect_tokens", return_value=([{"active": False}] * 2, 10)
+        ):
+            with app.test_request_context(json={"tokens": ["test_token", "other_token"]}):
+                response, status_code, headers = views.IntrospectBatchView().post()
+
+        assert status_code == 200
+        assert response == {"results": [{"active": False}, {"active": False}]}
+        assert headers["Cache-Control"] == "private, max-age=10"
+
+
+class TestUserInfoBatchView:
+    @pytest.fixture
+    def user_info_batch_view(self):
+        return views.UserInfoBatchView()
+
+    @pytest.fixture
+    def token(self, app):
+        user = User(email="test@gmail.com", fs_uniquifier="test_user")
+        client = OAuth2Client(user_id="test_user", client_id="test_client")
+        client.set_client_metadata({"client_name": "BB client"})
+        app.db.session.add_all([user, client])
+        app.db.session.flush()
+        token = OAuth2Token(user_id="test_user", client_id=client.id, access_token="test_token")
+        app.db.session.add(token)
+        app.db.session.commit()
+        return token
+
+    def test_post(self, app, user_info_batch_view, token, monkeypatch):
+        monkeypatch.setitem(app.config, "USER_INFO_BATCH_WORKERS", 1)
+        identifiers = ["test_client", "unknown", "test_token"]
+
+        with app.test_request_context(json={"identifiers": identifiers}):
+            response, status_code = user_info_batch_view.post()
+
+        results = response["results"]
+        assert status_code == 200
+        assert results[0]["source"] == "client_id"
+        assert results[1] == {"message": "Identifier not found [ERR 050]", "status": 404}
+        assert results[2]["source"] == "access_token"
+        assert results[0]["hashed_user_id"] == results[2]["hashed_user_id"]
+        assert results[0]["anonymous"] is False
+
+    def test_post_session(self, app, user_info_batch_view, token, monkeypatch):
+        monkeypatch.setitem(app.config, "USER_INFO_BATCH_WORKERS", 1)
+        serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+        identifiers = [
+            serializer.dumps({"_user_id": "test_user"}),
+            serializer.dumps({"_user_id": "unknown_user"}),
+            serializer.dumps({"oauth_client": "test_client"}),
+        ]
+
+        with app.test_request_context(json={"identifiers": identifiers}):
+            response, status_code = user_info_batch_view.post()
+
+        results = response["results"]
+        assert status_code == 200
+        assert results[0]["source"] == "session:user_id"
+        assert results[1]["status"] == 404
+        assert results[2]["source"] == "session:client_id"
+
+    def test_post_lookup_failure(self, app, user_info_batch_view, token, monkeypatch):
+        monkeypatch.setattr(
+            user_info_batch_view, "_tokens_by_access_token", MagicMock(side_effect=Exception)
+        )
+        identifiers = ["test_client", "unknown", "test_token"]
+
+        with app.test_request_context(json={"identifiers": identifiers}):
+            response, status_code = user_info_batch_view.post()
+
+        results = response["results"]
+        assert status_code == 200
+        assert results[0]["source"] == "client_id"
+        assert results[1]["status"] == 503
+        assert results[2]["status"] == 503
+
+    def test_shared_executor(self, app, user_info_batch_view):
+        executor = user_info_batch_view._get_executor(1)
+
+        assert views.UserInfoBatchView()._get_executor(1) is executor
+
+    def test_post_empty(self, app, user_info_batch_view):
+        with app.test_request_context(json={"identifiers": []}):
+            with pytest.raises(ValidationError):
+                user_info_batch_view.post()
+
+
+class TestUserResolverBatchView:
+    @pytest.fixture
+    def user_resolver_batch_view(self):
+        return views.UserResolverBatchView()
+
+    def test_post(self, app, user_resolver_batch_view):
+        user = User(email="test@gmail.com", fs_uniquifier="test_user")
+        app.db.session.add(user)
+        app.db.session.commit()
+        identifiers = [str(user.id), "unknown@gmail.com", "test_user", "test@gmail.com"]
+
+        with app.test_request_context(json={"identifiers": identifiers}):
+            response, status_code = user_resolver_batch_view.post()
+
+        expected = {"id": user.id, "email": "test@gmail.com"}
+        assert status_code == 200
+        assert response["results"] == [
+            expected,
+            {"message": "User not found", "status": 404},
+            expected,
+            expected,
+        ]
+
+    def test_post_hashed_id(self, app, user_resolver_batch_view, monkeypatch):
+        monkeypatch.setitem(app.config, "PERSIST_HASHED_IDS", True)
+        user = User(email="test@gmail.com", fs_uniquifier="test_user")
+        app.db.session.add(user)
+        app.db.session.commit()
+
+        with app.test_request_context(json={"identifiers": [hash_id("test_user")]}):
+            response, _ = user_resolver_batch_view.post()
+
+        assert response["results"] == [{"id": user.id, "email": "test@gmail.com"}]
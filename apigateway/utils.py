@@ -1,8 +1,22 @@
+import binascii
+import fcntl
+import hashlib
 import json
+import mmap
+import multiprocessing
 import smtplib
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from email.message import EmailMessage
-from functools import wraps
-from typing import Tuple
+from functools import lru_cache, wraps
+from typing import Callable, Tuple
 from urllib.parse import urljoin
 import re
 import os
@@ -11,9 +25,16 @@ import jsondiff as jd
 import requests
 from authlib.oauth2.rfc6749.errors import UnsupportedTokenTypeError
 from authlib.integrations.flask_oauth2 import ResourceProtector
+from authlib.oauth2.rfc6750 import BearerTokenValidator
 from flask import Request, current_app, request
 from flask.views import View
 from flask_login import current_user
+from flask_sqlalchemy.session import Session
+from opentelemetry import metrics
+from passlib.context import CryptContext
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import Select
 
 from apigateway import extensions
 from apigateway.email_templates import (
@@ -22,7 +43,7 @@ from apigateway.email_templates import (
     PasswordResetEmail,
     WelcomeVerificationEmail,
 )
-from apigateway.exceptions import Oauth2HttpError
+from apigateway.exceptions import Oauth2HttpError, ServiceUnavailableError
 
 
 def require_non_anonymous_bootstrap_user(func):
@@ -217,7 +238,7 @@ class ProxyView(View):
 
         # flask_principal holds an active DB session.
         # Release the session early to avoid blocking during long running requests to external endpoints.
-        extensions.db.session.remove()
+        release_db_session()
 
         return self._proxy_request()
 
@@ -281,6 +302,954 @@ class GatewayResourceProtector(ResourceProtector):
         raise Oauth2HttpError(error.status_code, error.description, body, error.get_headers())
 
 
+def hash_id(id) -> str:
+    """Hashes a user or client id into the identifier that is shared with other services.
+
+    The result only depends on the id and the app's secret key, so recently used ids
+    are memoized and cost no key derivation.
+
+    Args:
+        id (any): The id to hash.
+
+    Returns:
+        str: The hex encoded hash, or None if `id` is None.
+    """
+    if id is None:
+        return None
+
+    return _derive_hashed_id(str(id), str(current_app.secret_key))
+
+
+@lru_cache(maxsize=100000)
+def _derive_hashed_id(id: str, secret_key: str) -> str:
+    # 10 rounds of SHA-256 hash digest algorithm for HMAC (pseudorandom function)
+    # with a length of 2x32
+    # NOTE: 100,000 rounds is recommended but it is too slow and security is not
+    # that important here, thus we just do 10 rounds
+    return binascii.hexlify(
+        hashlib.pbkdf2_hmac("sha256", id.encode(), secret_key.encode(), 10, dklen=32)
+    ).decode()
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a bounded pool of worker processes.
+
+    Key derivation is CPU bound and holds the GIL, running it in separate processes
+    keeps login bursts from starving the threads that proxy requests. The pool is
+    created lazily in every process that uses it, so it survives forking web servers. Its
+    workers are started by a fork server, as forking a multithreaded web server worker can
+    copy locks that are held by other threads.
+
+    Args:
+        context (CryptContext): The passlib context that defines the hashing schemes.
+        max_workers (int, optional): The number of worker processes, 0 hashes on the calling
+            thread. Defaults to 2.
+        max_pending (int, optional): The maximum number of queued and running operations.
+            Defaults to 32.
+        timeout (float, optional): Seconds to wait for a single operation. Defaults to 10.
+    """
+
+    def __init__(
+        self,
+        context: CryptContext,
+        max_workers: int = 2,
+        max_pending: int = 32,
+        timeout: float = 10,
+    ):
+        self._context = context
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def hash(self, secret: str, **options) -> str:
+        """Hashes a secret with the default scheme of the context.
+
+        Args:
+            secret (str): The secret to hash.
+            **options: Options passed to the hash function, e.g. `rounds`.
+
+        Raises:
+            ServiceUnavailableError: If too many operations are pending, the operation timed
+                out or a worker process died.
+
+        Returns:
+            str: The hash.
+        """
+        return self._run(_hash_password, secret, options)
+
+    def verify_and_update(self, secret: str, hash: str, **options) -> Tuple[bool, str]:
+        """Verifies a secret and rehashes it if the hash does not use the current parameters.
+
+        Args:
+            secret (str): The secret to verify.
+            hash (str): The stored hash.
+            **options: The options new hashes are created with, e.g. `rounds`.
+
+        Raises:
+            ServiceUnavailableError: If too many operations are pending, the operation timed
+                out or a worker process died.
+
+        Returns:
+            Tuple[bool, str]: Whether the secret matches and the new hash, or None if the
+                hash is up to date or the secret does not match.
+        """
+        return self._run(_verify_and_update_password, secret, hash, options)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _run(self, func, *args):
+        if self._max_workers <= 0:
+            return func(*args, context=self._context)
+
+        if not self._pending.acquire(blocking=False):
+            raise ServiceUnavailableError("Too many concurrent requests, please try again later")
+
+        executor = future = None
+        try:
+            executor = self._get_executor()
+            future = executor.submit(func, *args)
+            return future.result(timeout=self._timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise ServiceUnavailableError("Password operation timed out, please try again later")
+        except BrokenProcessPool:
+            # A pool whose worker died rejects all further operations, replace it
+            self._discard_executor(executor)
+            raise ServiceUnavailableError("Password operation failed, please try again later")
+        finally:
+            self._pending.release()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                mp_context = multiprocessing.get_context("forkserver")
+                # Workers unpickle functions of this module, which can only be imported after
+                # the extensions because of their circular imports
+                mp_context.set_forkserver_preload(["apigateway.extensions"])
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._max_workers,
+                    mp_context=mp_context,
+                    initializer=_init_password_worker,
+                    initargs=(self._context.to_string(),),
+                )
+                self._pid = os.getpid()
+
+            return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+_password_context: CryptContext = None
+
+
+def _init_password_worker(context_config: str):
+    global _password_context
+    _password_context = CryptContext.from_string(context_config)
+
+
+def _hash_password(secret: str, options: dict, context: CryptContext = None) -> str:
+    return (context or _password_context).hash(secret, **options)
+
+
+def _verify_and_update_password(
+    secret: str, hash: str, options: dict, context: CryptContext = None
+) -> Tuple[bool, str]:
+    context = context or _password_context
+    if not context.verify(secret, hash):
+        return False, None
+
+    # The context only knows about deprecated schemes, the configured cost is passed
+    # in with every hash and has to be compared explicitly
+    rounds = options.get("rounds")
+    record = context.handler(context.identify(hash)).from_string(hash)
+    if context.needs_update(hash) or (rounds and getattr(record, "rounds", rounds) != rounds):
+        return True, context.hash(secret, **options)
+
+    return True, None
+
+
+class TTLCache:
+    """A thread-safe, size-bounded LRU cache whose entries expire after a fixed time.
+
+    Args:
+        maxsize (int, optional): The maximum number of entries. Defaults to 1024.
+        ttl (float, optional): The lifetime of an entry in seconds. Defaults to 60.
+        timer (Callable[[], float], optional): The clock used for expiry. Defaults to time.monotonic.
+    """
+
+    def __init__(
+        self, maxsize: int = 1024, ttl: float = 60, timer: Callable[[], float] = time.monotonic
+    ):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            value, expires_at = item
+            if expires_at <= self._timer():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self._timer() + self._ttl)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def estimate_size(value) -> int:
+    """Estimates the memory used by a value, including the items of containers.
+
+    Args:
+        value: The value.
+
+    Returns:
+        int: The estimated size in bytes.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+class MemoryStore:
+    """A thread-safe key-value store with per-key expiry, bounded by entries and bytes.
+
+    Keys are spread over shards that each have their own lock, so threads working on
+    different keys rarely wait for each other. Each shard holds an equal part of the
+    limits and evicts its least recently used entries when it exceeds them. Expired
+    entries are removed when they are accessed and by a periodic sweep of each shard.
+
+    Counters behave like their Redis counterparts: they start at 0, keep the expiry of
+    the key and fail on values that are not numbers. The store remembers which counters
+    were only ever incremented, so that they can be merged into another store.
+
+    Args:
+        max_entries (int, optional): The maximum number of entries. Defaults to 100000.
+        max_bytes (int, optional): The maximum estimated size of keys and values. Defaults to 64 MiB.
+        shards (int, optional): The number of shards. Defaults to 16.
+        timer (Callable[[], float], optional): The clock used for expiry. Defaults to time.monotonic.
+    """
+
+    SWEEP_INTERVAL = 60
+
+    class _Shard:
+        def __init__(self, now: float):
+            self.data = OrderedDict()
+            self.lock = threading.Lock()
+            self.nbytes = 0
+            self.next_sweep = now
+
+    def __init__(
+        self,
+        max_entries: int = 100000,
+        max_bytes: int = 64 * 1024 * 1024,
+        shards: int = 16,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self._timer = timer
+        self._shards = [self._Shard(timer()) for _ in range(shards)]
+        self._max_entries = max(1, max_entries // shards)
+        self._max_bytes = max(1, max_bytes // shards)
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _shard(self, key) -> "_Shard":
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _lookup(self, shard: "_Shard", key, now: float):
+        """Returns the entry of a key, removing it if it has expired. Call with the lock held."""
+        entry = shard.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            self._remove(shard, key)
+            self._expirations += 1
+            return None
+        return entry
+
+    def _remove(self, shard: "_Shard", key):
+        size = shard.data.pop(key)[2]
+        shard.nbytes -= size
+
+    def _store(
+        self,
+        shard: "_Shard",
+        key,
+        value,
+        expires_at: float | None,
+        now: float,
+        incremented: bool = False,
+    ):
+        """Stores an entry and evicts entries over the limits. Call with the lock held."""
+        if key in shard.data:
+            self._remove(shard, key)
+        size = estimate_size(key) + estimate_size(value)
+        shard.data[key] = (value, expires_at, size, incremented)
+        shard.nbytes += size
+
+        if now >= shard.next_sweep:
+            shard.next_sweep = now + self.SWEEP_INTERVAL
+            expired = [
+                k for k, entry in shard.data.items() if entry[1] is not None and entry[1] <= now
+            ]
+            for k in expired:
+                self._remove(shard, k)
+            self._expirations += len(expired)
+
+        while len(shard.data) > self._max_entries or (
+            shard.nbytes > self._max_bytes and len(shard.data) > 1
+        ):
+            self._remove(shard, next(iter(shard.data)))
+            self._evictions += 1
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._lookup(shard, key, self._timer())
+            if entry is None:
+                self._misses += 1
+                return default
+
+            self._hits += 1
+            shard.data.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, timeout: float = None) -> bool:
+        """Stores a value, which expires after `timeout` seconds unless it is None or 0."""
+        shard = self._shard(key)
+        with shard.lock:
+            now = self._timer()
+            self._store(shard, key, value, now + timeout if timeout else None, now)
+        return True
+
+    def delete(self, key) -> bool:
+        shard = self._shard(key)
+        with shard.lock:
+            if self._lookup(shard, key, self._timer()) is None:
+                return False
+            self._remove(shard, key)
+            return True
+
+    def has(self, key) -> bool:
+        shard = self._shard(key)
+        with shard.lock:
+            return self._lookup(shard, key, self._timer()) is not None
+
+    def ttl(self, key) -> float | None:
+        """Returns the seconds until a key expires, None if it does not exist or expire."""
+        shard = self._shard(key)
+        with shard.lock:
+            now = self._timer()
+            entry = self._lookup(shard, key, now)
+            if entry is None or entry[1] is None:
+                return None
+            return entry[1] - now
+
+    def incrby(self, key, amount: int = 1) -> int:
+        """Increments an integer counter and returns its new value.
+
+        Raises:
+            ValueError: If the key holds a value that is not an integer.
+        """
+        return self._increment(key, amount, int)
+
+    def incrbyfloat(self, key, amount: float) -> float:
+        """Increments a float counter and returns its new value.
+
+        Raises:
+            ValueError: If the key holds a value that is not a number.
+        """
+        return self._increment(key, amount, float)
+
+    def _increment(self, key, amount, number_type):
+        shard = self._shard(key)
+        with shard.lock:
+            now = self._timer()
+            entry = self._lookup(shard, key, now)
+            value, expires_at, _, incremented = (0, None, 0, True) if entry is None else entry
+            if isinstance(value, bool) or (number_type is int and isinstance(value, float)):
+                raise ValueError("value is not an integer or out of range")
+            try:
+                value = number_type(value) + amount
+            except (TypeError, ValueError):
+                raise ValueError("value is not a valid number")
+
+            self._store(shard, key, value, expires_at, now, incremented)
+            return value
+
+    def items(self) -> list:
+        """Returns the live entries.
+
+        Returns:
+            list: Tuples of the key, the value, the seconds until the key expires or None,
+                and whether the value is a counter that was created by an increment and
+                never set since.
+        """
+        items = []
+        for shard in self._shards:
+            with shard.lock:
+                now = self._timer()
+                items.extend(
+                    (key, value, None if expires_at is None else expires_at - now, incremented)
+                    for key, (value, expires_at, _, incremented) in shard.data.items()
+                    if expires_at is None or expires_at > now
+                )
+        return items
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.data.clear()
+                shard.nbytes = 0
+
+    def stats(self) -> dict:
+        """Returns the number of entries, their estimated size and the approximate hit,
+        miss, eviction and expiration counts."""
+        return {
+            "entries": len(self),
+            "bytes": sum(shard.nbytes for shard in self._shards),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self._shards)
+
+
+class NearCache(MemoryStore):
+    """A bounded store of copies of Redis values, which are dropped when Redis reports writes.
+
+    A value read from Redis is only stored if no invalidation reached its shard since the
+    read was sent, otherwise an invalidation that arrives between the read and the store
+    would be lost. Every copy also expires after `ttl` seconds.
+
+    Args:
+        ttl (float, optional): The lifetime of a copy in seconds. Defaults to 300.
+        **kwargs: The limits of the store, see `MemoryStore`.
+    """
+
+    def __init__(self, ttl: float = 300, **kwargs):
+        super().__init__(**kwargs)
+        self._ttl = ttl
+        for shard in self._shards:
+            shard.generation = 0
+
+    def generation(self, key) -> int:
+        """Returns the number of invalidations of the shard of a key, read before Redis."""
+        return self._shard(key).generation
+
+    def fill(self, key, value, generation: int) -> bool:
+        """Stores a value read from Redis, unless the key was invalidated since `generation`.
+
+        Returns:
+            bool: True if the value was stored.
+        """
+        shard = self._shard(key)
+        with shard.lock:
+            if shard.generation != generation:
+                return False
+            now = self._timer()
+            self._store(shard, key, value, now + self._ttl, now)
+        return True
+
+    def invalidate(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            shard.generation += 1
+            if key in shard.data:
+                self._remove(shard, key)
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.generation += 1
+                shard.data.clear()
+                shard.nbytes = 0
+
+
+class Spool:
+    """A bounded, append-only queue of records in memory-mapped segment files.
+
+    Records are written through a memory map into the newest segment of the directory and
+    read in the order they were written. Each segment is a preallocated file of
+    `segment_size` bytes, a new one is started once a record does not fit. A record is
+    preceded by its length, which is negated when the record is read, and a segment is
+    deleted once all its records are read. The records that were not read are returned
+    again when the spool is opened after a restart.
+
+    The directory is locked while the spool is open, a second spool on the same directory
+    raises `BlockingIOError`.
+
+    Args:
+        path (str): The directory of the segment files, which is created if necessary.
+        segment_size (int, optional): The size of a segment in bytes. Defaults to 4 MiB.
+        max_bytes (int, optional): The maximum size of all segments, records are rejected
+            once it is reached. Defaults to 64 MiB.
+    """
+
+    SUFFIX = ".seg"
+    _LENGTH = struct.Struct("<i")
+
+    class _Segment:
+        def __init__(self, path: str, size: int):
+            self.path = path
+            with open(path, "a+b") as file:
+                # Segments written with a larger segment size are read as they are
+                self.size = max(size, os.fstat(file.fileno()).st_size)
+                file.truncate(self.size)
+                self.map = mmap.mmap(file.fileno(), self.size)
+            self.read_offset = 0
+            self.write_offset = 0
+
+        def close(self):
+            self.map.flush()
+            self.map.close()
+
+    def __init__(
+        self, path: str, segment_size: int = 4 * 1024 * 1024, max_bytes: int = 64 * 1024 * 1024
+    ):
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, "lock"), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise
+
+        self._path = path
+        self._segment_size = segment_size
+        self._max_segments = max(1, max_bytes // segment_size)
+        self._lock = threading.Lock()
+        self._records = 0
+        self._segments = deque()
+
+        sequences = sorted(
+            int(name[: -len(self.SUFFIX)])
+            for name in os.listdir(path)
+            if name.endswith(self.SUFFIX) and name[: -len(self.SUFFIX)].isdigit()
+        )
+        for sequence in sequences:
+            segment = self._Segment(self._segment_path(sequence), segment_size)
+            segment.sequence = sequence
+            self._scan(segment)
+            self._segments.append(segment)
+        self._drop_read_segments()
+
+    def __len__(self) -> int:
+        return self._records
+
+    def append(self, record: bytes) -> bool:
+        """Appends a record.
+
+        Returns:
+            bool: False if the spool is full or the record is larger than a segment.
+        """
+        size = self._LENGTH.size + len(record)
+        # A zero length marks the end of the records in a segment
+        if not record or size > self._segment_size:
+            return False
+
+        with self._lock:
+            segment = self._segments[-1] if self._segments else None
+            if segment is None or segment.write_offset + size > segment.size:
+                if len(self._segments) >= self._max_segments:
+                    return False
+                segment = self._add_segment()
+                self._drop_read_segments()
+
+            offset = segment.write_offset
+            # The length is written last, so that a record is complete once it is visible
+            segment.map[offset + self._LENGTH.size : offset + size] = record
+            self._LENGTH.pack_into(segment.map, offset, len(record))
+            segment.write_offset += size
+            self._records += 1
+        return True
+
+    def pop(self) -> bytes | None:
+        """Removes and returns the oldest record, None if the spool is empty."""
+        with self._lock:
+            if not self._records:
+                return None
+
+            segment = self._segments[0]
+            offset = segment.read_offset
+            length = self._LENGTH.unpack_from(segment.map, offset)[0]
+            start = offset + self._LENGTH.size
+            record = segment.map[start : start + length]
+            self._LENGTH.pack_into(segment.map, offset, -length)
+            segment.read_offset = start + length
+            self._records -= 1
+            self._drop_read_segments()
+        return record
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments.clear()
+            self._records = 0
+        self._lock_file.close()
+
+    def _segment_path(self, sequence: int) -> str:
+        return os.path.join(self._path, "{0:012d}{1}".format(sequence, self.SUFFIX))
+
+    def _add_segment(self) -> "_Segment":
+        sequence = self._segments[-1].sequence + 1 if self._segments else 0
+        segment = self._Segment(self._segment_path(sequence), self._segment_size)
+        segment.sequence = sequence
+        self._segments.append(segment)
+        return segment
+
+    def _scan(self, segment: "_Segment"):
+        """Finds the first unread record and the end of the records of an existing segment."""
+        offset = 0
+        read_offset = None
+        while offset + self._LENGTH.size <= segment.size:
+            length = self._LENGTH.unpack_from(segment.map, offset)[0]
+            if length == 0 or offset + self._LENGTH.size + abs(length) > segment.size:
+                break
+            if length > 0:
+                if read_offset is None:
+                    read_offset = offset
+                self._records += 1
+            offset += self._LENGTH.size + abs(length)
+
+        segment.write_offset = offset
+        segment.read_offset = offset if read_offset is None else read_offset
+
+    def _drop_read_segments(self):
+        """Deletes the segments whose records were all read, except the one written to."""
+        while len(self._segments) > 1:
+            segment = self._segments[0]
+            if segment.read_offset < segment.write_offset:
+                break
+            self._segments.popleft()
+            segment.close()
+            os.remove(segment.path)
+
+
+class RoutingSession(Session):
+    """A database session that can send read-only queries to a read replica.
+
+    Reads only go to a replica inside `use_replica` and only until the session has
+    written anything, after that every query goes to the primary so that the session
+    reads its own writes. If no healthy replica is available the primary is used.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and self.info.get("use_replica")
+            and not self.info.get("wrote")
+            and isinstance(clause, Select)
+            and clause._for_update_arg is None
+        ):
+            engine = extensions.replica_service.get_engine()
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+_deleted_rows = metrics.get_meter(__name__).create_counter(
+    "gateway.db.deleted_rows",
+    unit="rows",
+    description="Rows removed by batched deletes",
+)
+_connection_hold_time = metrics.get_meter(__name__).create_histogram(
+    "gateway.db.connection.hold_time",
+    unit="s",
+    description="Time a request held a database connection",
+)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _stick_to_primary(session, flush_context):
+    session.info["wrote"] = True
+    session.info["uncommitted"] = True
+
+
+@event.listens_for(RoutingSession, "after_begin")
+def _track_connection_checkout(session, transaction, connection):
+    session.info.setdefault("connection_acquired_at", time.perf_counter())
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _track_connection_release(session, transaction):
+    if transaction.parent is not None:
+        return
+
+    session.info.pop("uncommitted", None)
+    acquired_at = session.info.pop("connection_acquired_at", None)
+    if acquired_at is not None:
+        session.info["connection_hold_time"] = (
+            session.info.get("connection_hold_time", 0) + time.perf_counter() - acquired_at
+        )
+
+
+def release_db_session():
+    """Ends the transaction of the current database session and returns its connection
+    to the pool.
+
+    The transaction is only committed if it wrote something, read-only transactions are
+    closed without a COMMIT round-trip. Sessions with unflushed modifications or a failed
+    transaction are rolled back, changes have to be committed explicitly. The session can
+    still be used afterwards and will check out a new connection if it needs one.
+    """
+    session = extensions.db.session
+    if session.dirty or not session.is_active:
+        session.close()  # db server will do rollback
+    elif session.info.get("uncommitted") or session.new or session.deleted:
+        session.commit()
+    else:
+        session.close()
+
+
+def record_connection_hold_time():
+    """Reports how long the current request held database connections."""
+    hold_time = extensions.db.session.info.pop("connection_hold_time", None)
+    if hold_time is not None:
+        _connection_hold_time.record(hold_time, {"endpoint": str(request.endpoint)})
+
+
+@contextmanager
+def use_replica():
+    """Lets read-only queries of the current database session go to a read replica.
+
+    Can be used as a context manager or as a decorator.
+    """
+    info = extensions.db.session.info
+    previous = info.get("use_replica", False)
+    info["use_replica"] = True
+    try:
+        yield
+    finally:
+        info["use_replica"] = previous
+
+
+@contextmanager
+def use_primary():
+    """Sends the queries of the current database session to the primary, also inside
+    `use_replica`.
+
+    Can be used as a context manager or as a decorator.
+    """
+    info = extensions.db.session.info
+    previous = info.get("use_replica", False)
+    info["use_replica"] = False
+    try:
+        yield
+    finally:
+        info["use_replica"] = previous
+
+
+def count_rows(table, condition) -> int:
+    """Counts the rows of `table` that match `condition`.
+
+    Args:
+        table (Table): The table to count rows of.
+        condition (ColumnElement): The filter rows have to match.
+
+    Returns:
+        int: The number of matching rows.
+    """
+    return extensions.db.session.execute(
+        select(func.count()).select_from(table).where(condition)
+    ).scalar()
+
+
+def delete_batch(table, condition, after_id: int, batch_size: int, returning=(), dependents=()):
+    """Deletes the next batch of rows that match `condition` in a single statement.
+
+    Rows are selected by increasing primary key starting after `after_id`, so that
+    consecutive batches never scan the rows that were looked at before. The caller is
+    responsible for committing the transaction.
+
+    Args:
+        table (Table): The table to delete rows from, must have an `id` primary key.
+        condition (ColumnElement): The filter rows have to match.
+        after_id (int): Only rows with a greater id are deleted.
+        batch_size (int): The maximum number of rows to delete.
+        returning (tuple, optional): Additional columns to return for deleted rows.
+        dependents (tuple, optional): Foreign key columns of other tables whose rows
+            reference the deleted rows and have to be deleted first.
+
+    Returns:
+        list: The id and the `returning` columns of every deleted row.
+    """
+    session = extensions.db.session
+    supports_returning = session.get_bind().dialect.full_returning
+    ids = (
+        select(table.c.id)
+        .where(condition, table.c.id > after_id)
+        .order_by(table.c.id)
+        .limit(batch_size)
+    )
+
+    if supports_returning:
+        ids = ids.scalar_subquery()
+    else:
+        # DELETE ... RETURNING is not supported, select the rows first
+        rows = session.execute(ids.with_only_columns(table.c.id, *returning)).all()
+        ids = [row[0] for row in rows]
+        if not ids:
+            return []
+
+    for column in dependents:
+        session.execute(column.table.delete().where(column.in_(ids)))
+
+    statement = table.delete().where(table.c.id.in_(ids))
+    if supports_returning:
+        return session.execute(statement.returning(table.c.id, *returning)).all()
+
+    session.execute(statement)
+    return rows
+
+
+def delete_in_batches(
+    table,
+    condition,
+    batch_size: int = 1000,
+    sleep: float = 0,
+    max_rate: float = None,
+    returning=(),
+    dependents=(),
+    on_batch: Callable = None,
+    logger=None,
+) -> int:
+    """Deletes all rows of `table` that match `condition` in batches.
+
+    Every batch is deleted with `delete_batch` and committed separately, so that locks
+    are held briefly and the write-ahead log is written in small pieces. Between batches
+    the deletion pauses for `sleep` seconds and, if `max_rate` is set, for as long as it
+    takes to stay below that many rows per second.
+
+    Args:
+        table (Table): The table to delete rows from.
+        condition (ColumnElement): The filter rows have to match.
+        batch_size (int, optional): The maximum number of rows per batch. Defaults to 1000.
+        sleep (float, optional): Seconds to wait between batches. Defaults to 0.
+        max_rate (float, optional): Maximum rows deleted per second. Defaults to None.
+        returning (tuple, optional): Additional columns to return for deleted rows.
+        dependents (tuple, optional): Foreign key columns of rows to delete first.
+        on_batch (Callable, optional): Called with the deleted rows of every batch before
+            it is committed.
+        logger (Logger, optional): Logger that receives progress messages.
+
+    Returns:
+        int: The number of deleted rows. Deleting stops at the first database error.
+    """
+    session = extensions.db.session
+    logger = logger or current_app.logger
+    total = 0
+    last_id = 0
+    start = time.monotonic()
+
+    while True:
+        batch_start = time.monotonic()
+        try:
+            rows = delete_batch(table, condition, last_id, batch_size, returning, dependents)
+            if rows and on_batch is not None:
+                on_batch(rows)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error(
+                "Could not delete {0} rows. Database error; rolled back: {1}".format(table.name, e)
+            )
+            break
+
+        if not rows:
+            break
+
+        total += len(rows)
+        last_id = max(row[0] for row in rows)
+        _deleted_rows.add(len(rows), {"table": table.name})
+        logger.info(
+            "Deleted {0} {1} rows ({2} total, {3:.1f} rows/s)".format(
+                len(rows), table.name, total, total / max(time.monotonic() - start, 1e-6)
+            )
+        )
+
+        if len(rows) < batch_size:
+            break
+
+        pause = sleep
+        if max_rate:
+            pause = max(pause, len(rows) / max_rate - (time.monotonic() - batch_start))
+        if pause > 0:
+            time.sleep(pause)
+
+    return total
+
+
+class GatewayBearerTokenValidator(BearerTokenValidator):
+    """Bearer token validator that accepts stateless anonymous bootstrap tokens
+    before falling back to a database lookup."""
+
+    def __init__(self, session, token_model, realm=None, **extra_attributes):
+        super().__init__(realm, **extra_attributes)
+        self._session = session
+        self._token_model = token_model
+
+    def authenticate_token(self, token_string: str):
+        token = extensions.auth_service.load_stateless_token(token_string)
+        if token is not None:
+            return token
+
+        query = self._session.query(self._token_model).filter(
+            self._token_model.access_token_filter([token_string])
+        )
+        with use_replica():
+            token = query.first()
+
+        # Tokens that were just created may not have reached the replica yet
+        if token is None:
+            with use_primary():
+                token = query.first()
+        return token
+
+
 def _format_changes(field, changes, updated):
     formatted_changes = []
     if isinstance(changes, dict):
@@ -1,6 +1,7 @@
-import binascii
-import hashlib
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from datetime import datetime
 from urllib.parse import unquote
@@ -13,6 +14,7 @@ from flask_login import current_user, login_required, login_user, logout_user
 from flask_restful import Resource, abort
 from flask_wtf.csrf import generate_csrf
 from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager, joinedload
 from werkzeug.security import gen_salt
 
 from apigateway import email_templates as templates
@@ -26,6 +28,7 @@ from apigateway.models import (
 )
 from apigateway.utils import (
     get_json_body,
+    hash_id,
     make_json_diff,
     require_non_anonymous_bootstrap_user,
     send_account_registration_attempt_email,
@@ -33,6 +36,7 @@ from apigateway.utils import (
     send_feedback_email,
     send_password_reset_email,
     send_welcome_email,
+    use_replica,
     verify_recaptcha,
 )
 
@@ -45,7 +49,7 @@ class BootstrapView(Resource):
         params = schemas.bootstrap_request.load(get_json_body(request))
 
         if not current_user.is_authenticated:
-            bootstrap_user: User = User.query.filter_by(is_anonymous_bootstrap_user=True).first()
+            bootstrap_user: User = extensions.auth_service.load_anonymous_user()
             if not bootstrap_user or not login_user(bootstrap_user):
                 abort(500, message="Could not login as bootstrap user")
 
@@ -64,21 +68,36 @@ class BootstrapView(Resource):
             elif current_token:
                 client_id = current_token.client.client_id
 
-            if client_id:
-                try:
-                    client, token = extensions.auth_service.load_client(client_id)
-                except exceptions.NoClientError:
+            if extensions.auth_service.stateless_tokens_enabled:
+                # Stateless clients only exist inside the signed token, so just issue a
+                # fresh token for the same client id
+                client, token = extensions.auth_service.bootstrap_anonymous_user(client_id)
+                session["oauth_client"] = client.client_id
+            else:
+                if client_id:
+                    try:
+                        client, token = extensions.auth_service.load_client(client_id)
+                    except exceptions.NoClientError:
+                        client, token = extensions.auth_service.bootstrap_anonymous_user()
+                        session["oauth_client"] = client.client_id
+                # Check if the client_id is valid and that there is no client/user mismatch
+                if not client_id or (
+                    client.user_id != current_user.get_id()
+                    and not current_user.is_anonymous_bootstrap_user
+                ):
                     client, token = extensions.auth_service.bootstrap_anonymous_user()
                     session["oauth_client"] = client.client_id
-            # Check if the client_id is valid and that there is no client/user mismatch
-            if not client_id or (
-                client.user_id != current_user.get_id()
-                and not current_user.is_anonymous_bootstrap_user
-            ):
-                client, token = extensions.auth_service.bootstrap_anonymous_user()
-                session["oauth_client"] = client.client_id
 
         else:
+            client_name = params.client_name or current_app.config.get(
+                "BOOTSTRAP_CLIENT_NAME", "BB client"
+            )
+            cached_response, cache_version = extensions.auth_service.get_cached_bootstrap_response(
+                current_user.get_id(), client_name
+            )
+            if cached_response is not None and not params.create_new:
+                return cached_response, 200
+
             client, token = extensions.auth_service.bootstrap_user(
                 client_name=params.client_name,
                 scope=params.scope,
@@ -104,7 +123,18 @@ class BootstrapView(Resource):
             "given_name": token.user.given_name,
             "family_name": token.user.family_name,
         }
-        return schemas.bootstrap_response.dump(response), 200
+        response = schemas.bootstrap_response.dump(response)
+
+        if not current_user.is_anonymous_bootstrap_user:
+            extensions.auth_service.cache_bootstrap_response(
+                current_user.get_id(),
+                client.client_name,
+                response,
+                cache_version,
+                token.expires_at(),
+            )
+
+        return response, 200
 
 
 class UserAuthView(Resource):
@@ -152,6 +182,7 @@ class UserAuthView(Resource):
             user.login_count = user.login_count + 1 if user.login_count else 1
 
             session.commit()
+            extensions.security_service.invalidate_user(user.fs_uniquifier)
 
         return {"message": "Successfully logged in"}, 200
 
@@ -239,12 +270,26 @@ class UserManagementView(Resource):
     @login_required
     @require_non_anonymous_bootstrap_user
     def delete(self):
+        user_id = current_user.get_id()
+
         with current_app.session_scope() as session:
-            user: User = session.query(User).filter_by(fs_uniquifier=current_user.get_id()).first()
+            user: User = session.query(User).filter_by(fs_uniquifier=user_id).first()
+            # The tokens are deleted with the user
+            access_tokens = [
+                access_token
+                for access_token, in session.query(OAuth2Token.access_token).filter_by(
+                    user_id=user_id
+                )
+            ]
             logout_user()
             session.delete(user)
             session.commit()
 
+        extensions.security_service.invalidate_user(user_id)
+        extensions.auth_service.invalidate_bootstrap_cache(user_id)
+        for access_token in access_tokens:
+            extensions.auth_service.invalidate_introspection(access_token)
+
         return {"message": "success"}, 200
 
     @login_required
@@ -258,6 +303,9 @@ class UserManagementView(Resource):
             user.family_name = params.family_name or user.family_name
             session.commit()
 
+        extensions.security_service.invalidate_user(current_user.get_id())
+        extensions.auth_service.invalidate_bootstrap_cache(current_user.get_id())
+
         return {"message": "success"}, 200
 
 
@@ -432,6 +480,7 @@ class VerifyEmailView(Resource):
 
             session.query(User).filter_by(id=user.id).update({"confirmed_at": datetime.utcnow()})
             session.commit()
+            extensions.security_service.invalidate_user(user.fs_uniquifier)
             login_user(user)
 
             return {"message": "success"}, 200
@@ -518,6 +567,7 @@ class UserInfoView(Resource):
     """
 
     decorators = [
+        use_replica(),
         # extensions.limiter_service.shared_limit("500/43200 second"),
         extensions.auth_service.require_oauth("adsws:internal"),
     ]
@@ -548,6 +598,12 @@ class UserInfoView(Resource):
                 )
                 if token:
                     return self._translate(token, source="session:client_id")
+                elif extensions.auth_service.stateless_tokens_enabled:
+                    # Stateless anonymous clients are never stored in the database
+                    hashed_client_id = self._hash_id(session_data["oauth_client"])
+                    return self._translation(
+                        hashed_client_id, hashed_client_id, True, source="session:client_id"
+                    )
                 else:
                     # Token not found in database
                     return {"message": "Identifier not found [ERR 010]"}, 404
@@ -559,7 +615,8 @@ class UserInfoView(Resource):
                 # just the first in the database that corresponds to BBB since
                 # sessions are used by BBB and not API requests
                 client = OAuth2Client.query.filter_by(
-                    user_id=session_data["user_id"], name="BB client"
+                    user_id=session_data["user_id"],
+                    client_name=current_app.config.get("BOOTSTRAP_CLIENT_NAME", "BB client"),
                 ).first()
 
                 if client:
@@ -582,7 +639,8 @@ class UserInfoView(Resource):
                 # just the first in the database that corresponds to BBB since
                 # sessions are used by BBB and not API requests
                 client = OAuth2Client.query.filter_by(
-                    user_id=session_data["_user_id"], name="BB client"
+                    user_id=session_data["_user_id"],
+                    client_name=current_app.config.get("BOOTSTRAP_CLIENT_NAME", "BB client"),
                 ).first()
 
                 if client:
@@ -606,7 +664,7 @@ class UserInfoView(Resource):
             pass
 
         # 2) Try to treat input data as access token
-        token = OAuth2Token.query.filter_by(access_token=account_data).first()
+        token = extensions.auth_service.load_token(account_data)
         if token:
             return self._translate(token, source="access_token")
 
@@ -626,9 +684,12 @@ class UserInfoView(Resource):
         user: User = token.user
         anonymous = user.is_anonymous_bootstrap_user
 
-        hashed_client_id = self._hash_id(token.client_id)
+        hashed_client_id = self._hash_id(token.get_client_key())
         hashed_user_id = hashed_client_id if anonymous else self._hash_id(token.user_id)
 
+        return self._translation(hashed_user_id, hashed_client_id, anonymous, source=source)
+
+    def _translation(self, hashed_user_id, hashed_client_id, anonymous, source=None):
         return {
             "hashed_user_id": hashed_user_id,  # Permanent, all the anonymous users will have hashed_client_id instead
             "hashed_client_id": hashed_client_id,  # A single user has a client ID for the BB token and another for the API, anonymous users have a unique client ID linked to the anonymous user id (id 1)
@@ -642,23 +703,248 @@ class UserInfoView(Resource):
         return signingSerializer.loads(cookie_value)
 
     def _hash_id(self, id):
-        # 10 rounds of SHA-256 hash digest algorithm for HMAC (pseudorandom function)
-        # with a length of 2x32
-        # NOTE: 100,000 rounds is recommended but it is too slow and security is not
-        # that important here, thus we just do 10 rounds
-
-        if id is None:
-            return None
-
-        return binascii.hexlify(
-            hashlib.pbkdf2_hmac(
-                "sha256",
-                str(id).encode(),
-                str(current_app.secret_key).encode(),
-                10,
-                dklen=32,
+        return hash_id(id)
+
+
+class IntrospectView(Resource):
+    """
+    RFC 7662 style token introspection for internal services. It should be
+    limited to internal use only.
+    """
+
+    decorators = [use_replica(), extensions.auth_service.require_oauth("adsws:internal")]
+
+    def post(self):
+        """
+        Describes an access token: whether it is active, its scopes, client, user
+        and whether it belongs to the anonymous user. Example:
+
+        curl -X POST -H 'authorization: Bearer:xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+            -d 'token=yyyy' 'https://dev.adsabs.harvard.edu/v1/accounts/introspect'
+
+        The Cache-Control header tells callers how long they may reuse the response.
+        """
+        params = schemas.introspect_request.load(get_json_body(request))
+        response, max_age = extensions.auth_service.introspect_token(params.token)
+
+        return response, 200, {"Cache-Control": "private, max-age={}".format(max_age)}
+
+
+class IntrospectBatchView(Resource):
+    """Batched variant of IntrospectView"""
+
+    decorators = [use_replica(), extensions.auth_service.require_oauth("adsws:internal")]
+
+    def post(self):
+        """
+        Describes a list of access tokens, results are returned in input order. Example:
+
+        curl -X POST -H 'authorization: Bearer:xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+            -H 'Content-Type: application/json' -d '{"tokens": ["yyyy", "zzzz"]}'
+            'https://dev.adsabs.harvard.edu/v1/accounts/introspect/batch'
+        """
+        params = schemas.introspect_batch_request.load(get_json_body(request))
+        results, max_age = extensions.auth_service.introspect_tokens(params.tokens)
+
+        return (
+            {"results": results},
+            200,
+            {"Cache-Control": "private, max-age={}".format(max_age)},
+        )
+
+
+class UserInfoBatchView(UserInfoView):
+    """
+    Batched variant of UserInfoView for internal services that need to resolve
+    many identifiers at once. It should be limited to internal use only.
+    """
+
+    methods = ["POST"]
+
+    _executor = None
+    _executor_pid = None
+    _executor_lock = threading.Lock()
+
+    def post(self):
+        """
+        Resolves a list of sessions, access tokens or client ids. Example:
+
+        curl -X POST -H 'authorization: Bearer:xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+            -H 'Content-Type: application/json' -d '{"identifiers": ["yyyy", "zzzz"]}'
+            'https://dev.adsabs.harvard.edu/v1/accounts/info'
+
+        Identifiers are grouped by type and each group is resolved with a single
+        set based query, the groups concurrently. Results are returned in input
+        order, identifiers that could not be resolved get a message and a status,
+        also when the query of their group failed.
+        """
+        params = schemas.batch_identifiers_request.load(get_json_body(request))
+        results = [None] * len(params.identifiers)
+
+        session_clients, session_users, candidates = {}, {}, {}
+        for index, identifier in enumerate(params.identifiers):
+            try:
+                session_data = self._decodeFlaskCookie(identifier)
+            except Exception:
+                token = extensions.auth_service.load_stateless_token(identifier)
+                if token is not None:
+                    results[index] = self._translate(token, source="access_token")[0]
+                else:
+                    candidates.setdefault(identifier, []).append(index)
+                continue
+
+            if "oauth_client" in session_data:
+                session_clients.setdefault(session_data["oauth_client"], []).append(index)
+            elif "user_id" in session_data or "_user_id" in session_data:
+                user_id = session_data.get("user_id", session_data.get("_user_id"))
+                session_users.setdefault(user_id, []).append(index)
+            else:
+                results[index] = self._error(
+                    "Missing oauth_client/user_id parameter in session", 500
+                )
+
+        tokens_by_client_id, tokens_by_access_token, tokens_by_user_id = self._run_concurrently(
+            (self._tokens_by_client_id, list(session_clients.keys() | candidates.keys())),
+            (self._tokens_by_access_token, list(candidates)),
+            (self._tokens_by_session_user, list(session_users)),
+        )
+
+        for client_id, indexes in session_clients.items():
+            if tokens_by_client_id is None:
+                self._fill(results, indexes, self._lookup_error())
+                continue
+
+            token = tokens_by_client_id.get(client_id)
+            if token:
+                result = self._translate(token, source="session:client_id")[0]
+            elif extensions.auth_service.stateless_tokens_enabled:
+                hashed_client_id = self._hash_id(client_id)
+                result = self._translation(
+                    hashed_client_id, hashed_client_id, True, source="session:client_id"
+                )[0]
+            else:
+                result = self._error("Identifier not found [ERR 010]", 404)
+            self._fill(results, indexes, result)
+
+        for user_id, indexes in session_users.items():
+            if tokens_by_user_id is None:
+                result = self._lookup_error()
+            elif user_id not in tokens_by_user_id:
+                result = self._error("Identifier not found [ERR 030]", 404)
+            elif tokens_by_user_id[user_id] is None:
+                result = self._error("Identifier not found [ERR 020]", 404)
+            else:
+                result = self._translate(tokens_by_user_id[user_id], source="session:user_id")[0]
+            self._fill(results, indexes, result)
+
+        for identifier, indexes in candidates.items():
+            if tokens_by_access_token and identifier in tokens_by_access_token:
+                result = self._translate(
+                    tokens_by_access_token[identifier], source="access_token"
+                )[0]
+            elif tokens_by_client_id and identifier in tokens_by_client_id:
+                result = self._translate(tokens_by_client_id[identifier], source="client_id")[0]
+            elif tokens_by_access_token is None or tokens_by_client_id is None:
+                result = self._lookup_error()
+            else:
+                result = self._error("Identifier not found [ERR 050]", 404)
+            self._fill(results, indexes, result)
+
+        return {"results": results}, 200
+
+    def _run_concurrently(self, *lookups):
+        """Runs the lookups on the executor that all batches of the process share.
+
+        Returns:
+            list: The result of every lookup, None for the lookups that failed.
+        """
+        # Every thread gets its own app context and thus its own database session,
+        # the returned objects are detached but have everything _translate needs loaded
+        app = current_app._get_current_object()
+
+        def run(lookup, keys):
+            if not keys:
+                return {}
+            with app.app_context(), use_replica():
+                return lookup(keys)
+
+        executor = self._get_executor(app.config.get("USER_INFO_BATCH_WORKERS", 3))
+        futures = [executor.submit(run, lookup, keys) for lookup, keys in lookups]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception:
+                current_app.logger.exception("Could not resolve a group of identifiers")
+                results.append(None)
+        return results
+
+    @classmethod
+    def _get_executor(cls, max_workers: int) -> ThreadPoolExecutor:
+        # Concurrent batches share the workers, so that their lookups never hold more than
+        # max_workers database connections. Created lazily in every process, as the threads
+        # of a pool do not survive forking web servers
+        with cls._executor_lock:
+            if cls._executor is None or cls._executor_pid != os.getpid():
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=max_workers, thread_name_prefix="user-info-batch"
+                )
+                cls._executor_pid = os.getpid()
+            return cls._executor
+
+    def _tokens_by_client_id(self, client_ids):
+        tokens = (
+            OAuth2Token.query.join(OAuth2Client)
+            .options(contains_eager(OAuth2Token.client), joinedload(OAuth2Token.user))
+            .filter(OAuth2Client.client_id.in_(client_ids))
+            .order_by(OAuth2Token.id)
+        )
+
+        found = {}
+        for token in tokens:
+            found.setdefault(token.client.client_id, token)
+        return found
+
+    def _tokens_by_access_token(self, access_tokens):
+        tokens = OAuth2Token.query.options(joinedload(OAuth2Token.user)).filter(
+            OAuth2Token.access_token_filter(access_tokens)
+        )
+        return {token.access_token: token for token in tokens}
+
+    def _tokens_by_session_user(self, user_ids):
+        # Maps every user with a BBB client to the first token of that client, or None
+        clients = {}
+        for client in OAuth2Client.query.filter(
+            OAuth2Client.user_id.in_(user_ids),
+            OAuth2Client.client_name
+            == current_app.config.get("BOOTSTRAP_CLIENT_NAME", "BB client"),
+        ).order_by(OAuth2Client.id):
+            clients.setdefault(client.user_id, client.id)
+
+        found = dict.fromkeys(clients)
+        if clients:
+            tokens = (
+                OAuth2Token.query.options(joinedload(OAuth2Token.user))
+                .filter(
+                    OAuth2Token.client_id.in_(clients.values()),
+                    OAuth2Token.user_id.in_(clients.keys()),
+                )
+                .order_by(OAuth2Token.id)
             )
-        ).decode()
+            for token in tokens:
+                if clients[token.user_id] == token.client_id and found[token.user_id] is None:
+                    found[token.user_id] = token
+        return found
+
+    def _error(self, message, status):
+        return {"message": message, "status": status}
+
+    def _lookup_error(self):
+        return self._error("Identifier lookup failed, please try again [ERR 060]", 503)
+
+    def _fill(self, results, indexes, result):
+        for index in indexes:
+            results[index] = result
 
 
 class UserFeedbackView(Resource):
@@ -869,14 +1155,14 @@ class PersonalTokenView(Resource):
     ]
 
     def get(self):
-        clients = (
-            OAuth2Client.query.filter_by(user_id=current_user.get_id())
+        client = (
+            OAuth2Client.query.filter_by(
+                user_id=current_user.get_id(), client_name="ADS API client"
+            )
             .order_by(OAuth2Client.client_id_issued_at.desc())
-            .all()
+            .first()
         )
 
-        client = next((c for c in clients if c.client_name == "ADS API client"), None)
-
         if not client:
             return {"message": "No ADS API client found"}, 200
 
@@ -910,14 +1196,14 @@ class PersonalTokenView(Resource):
     def put(self):
         salt_length = current_app.config.get("OAUTH2_CLIENT_ID_SALT_LEN", 40)
 
-        clients = (
-            OAuth2Client.query.filter_by(user_id=current_user.get_id())
+        client = (
+            OAuth2Client.query.filter_by(
+                user_id=current_user.get_id(), client_name="ADS API client"
+            )
             .order_by(OAuth2Client.client_id_issued_at.desc())
-            .all()
+            .first()
         )
 
-        client = next((c for c in clients if c.client_name == "ADS API client"), None)
-
         with current_app.session_scope() as session:
             if not client:
                 client = OAuth2Client(
@@ -966,9 +1252,11 @@ class PersonalTokenView(Resource):
                     )
                     return {"message": "No token found for the ADS API client"}, 500
 
+                extensions.auth_service.invalidate_introspection(token.access_token)
                 token.access_token = gen_salt(salt_length)
 
             session.commit()
+            extensions.auth_service.invalidate_bootstrap_cache(current_user.get_id())
 
             response = {
                 "access_token": token.access_token,
@@ -986,13 +1274,13 @@ class PersonalTokenView(Resource):
 
 
 class UserResolverView(Resource):
-    """Resolves an email or uid into a string formatted user object"""
+    """Resolves an email, uid or hashed user id into a string formatted user object"""
 
-    decorators = [extensions.auth_service.require_oauth("adsws:internal")]
+    decorators = [use_replica(), extensions.auth_service.require_oauth("adsws:internal")]
 
     def get(self, id):
         """
-        :param identifier: email address or uid
+        :param identifier: email address, uid or hashed user id
         :return: json containing user info or 404
         """
 
@@ -1006,6 +1294,7 @@ class UserResolverView(Resource):
                 User.id == user_id,
                 User.email == id,
                 User.fs_uniquifier == id,
+                User.hashed_id == id,
             )
         ).first()
 
@@ -1018,6 +1307,61 @@ class UserResolverView(Resource):
         }
 
 
+class UserResolverBatchView(Resource):
+    """Resolves a list of emails or uids into user objects"""
+
+    decorators = [use_replica(), extensions.auth_service.require_oauth("adsws:internal")]
+
+    def post(self):
+        """
+        :param identifiers: list of email addresses, uids or hashed user ids
+        :return: json containing a user object or an error for every identifier, in input order
+        """
+        params = schemas.batch_identifiers_request.load(get_json_body(request))
+
+        user_ids = set()
+        for identifier in params.identifiers:
+            try:
+                user_ids.add(int(identifier))
+            except ValueError:
+                pass
+
+        users = User.query.filter(
+            or_(
+                User.id.in_(user_ids),
+                User.email.in_(params.identifiers),
+                User.fs_uniquifier.in_(params.identifiers),
+                User.hashed_id.in_(params.identifiers),
+            )
+        ).all()
+
+        by_id = {u.id: u for u in users}
+        # Emails are case insensitive in the database
+        by_email = {u.email.lower(): u for u in users}
+        by_uniquifier = {u.fs_uniquifier: u for u in users}
+        by_hashed_id = {u.hashed_id: u for u in users if u.hashed_id}
+
+        results = []
+        for identifier in params.identifiers:
+            try:
+                u = by_id.get(int(identifier))
+            except ValueError:
+                u = None
+            u = (
+                u
+                or by_email.get(identifier.lower())
+                or by_uniquifier.get(identifier)
+                or by_hashed_id.get(identifier)
+            )
+
+            if u is None:
+                results.append({"message": "User not found", "status": 404})
+            else:
+                results.append({"id": u.id, "email": u.email})
+
+        return {"results": results}, 200
+
+
 class Resources(Resource):
     """Overview of available resources"""
 
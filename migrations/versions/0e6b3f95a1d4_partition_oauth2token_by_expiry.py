@@ -0,0 +1,146 @@
+"""Partition oauth2token by the expiry day of short-lived tokens
+
+Revision ID: 0e6b3f95a1d4
+Revises: 5d2f8a61c3e7
+Create Date: 2026-10-19 16:48:12.603945
+
+"""
+
+import time
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0e6b3f95a1d4"
+down_revision: Union[str, None] = "5d2f8a61c3e7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PARTITIONS_AHEAD = 3
+
+# Indexes of the existing table that are recreated on the partitioned table
+INDEXES = {
+    "ix_oauth2token_client_id": "client_id",
+    "ix_oauth2token_user_id": "user_id",
+    "ix_oauth2token_is_personal": "is_personal",
+    "ix_oauth2token_expires_at": "(issued_at + expires_in)",
+}
+
+
+def upgrade() -> None:
+    # The existing table becomes the permanent partition, holding every token with
+    # partition_day 0. The validated check constraint proves that, so attaching the table
+    # as a partition does not have to scan it
+    op.add_column(
+        "oauth2token",
+        sa.Column("partition_day", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.execute(
+        "ALTER TABLE oauth2token ADD CONSTRAINT oauth2token_permanent_check "
+        "CHECK (partition_day < 1) NOT VALID"
+    )
+
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TABLE oauth2token VALIDATE CONSTRAINT oauth2token_permanent_check")
+
+        # Unique indexes of a partitioned table have to include the partition key
+        op.create_index(
+            "oauth2token_permanent_id_partition_day_idx",
+            "oauth2token",
+            ["id", "partition_day"],
+            unique=True,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "oauth2token_permanent_access_token_partition_day_idx",
+            "oauth2token",
+            ["access_token", "partition_day"],
+            unique=True,
+            postgresql_concurrently=True,
+        )
+
+    op.rename_table("oauth2token", "oauth2token_permanent")
+    op.execute(
+        "ALTER INDEX ix_oauth2token_access_token RENAME TO oauth2token_permanent_access_token_idx"
+    )
+    for name in INDEXES:
+        op.execute(
+            "ALTER INDEX {0} RENAME TO {1}".format(
+                name, name.replace("ix_oauth2token", "oauth2token_permanent")
+            )
+        )
+
+    op.execute(
+        "CREATE TABLE oauth2token (LIKE oauth2token_permanent INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (partition_day)"
+    )
+    op.execute("ALTER SEQUENCE oauth2token_id_seq OWNED BY oauth2token.id")
+
+    # Matching indexes and foreign keys of the permanent partition are reused when it is
+    # attached, nothing is rebuilt
+    op.execute(
+        "CREATE UNIQUE INDEX oauth2token_id_partition_day_idx ON oauth2token (id, partition_day)"
+    )
+    op.execute(
+        "CREATE UNIQUE INDEX ix_oauth2token_access_token ON oauth2token (access_token, partition_day)"
+    )
+    for name, columns in INDEXES.items():
+        op.execute("CREATE INDEX {0} ON oauth2token ({1})".format(name, columns))
+    op.create_foreign_key(
+        "fk_oauth2token_client_id",
+        "oauth2token",
+        "oauth2client",
+        ["client_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.create_foreign_key(
+        "fk_oauth2token_user_id",
+        "oauth2token",
+        "user",
+        ["user_id"],
+        ["fs_uniquifier"],
+        ondelete="CASCADE",
+    )
+
+    op.execute(
+        "ALTER TABLE oauth2token ATTACH PARTITION oauth2token_permanent "
+        "FOR VALUES FROM (MINVALUE) TO (1)"
+    )
+    op.drop_constraint("oauth2token_permanent_check", "oauth2token_permanent", type_="check")
+
+    # Later partitions are created by the maintenance worker
+    today = int(time.time()) // 86400
+    for day in range(today, today + PARTITIONS_AHEAD + 1):
+        op.execute(
+            "CREATE TABLE oauth2token_d{0} PARTITION OF oauth2token "
+            "FOR VALUES FROM ({0}) TO ({1})".format(day, day + 1)
+        )
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE oauth2token DETACH PARTITION oauth2token_permanent")
+
+    # Tokens that have not expired yet are moved back, their access tokens stay valid
+    op.execute(
+        "INSERT INTO oauth2token_permanent SELECT * FROM oauth2token "
+        "WHERE issued_at + expires_in >= EXTRACT(EPOCH FROM now())"
+    )
+    op.execute("ALTER SEQUENCE oauth2token_id_seq OWNED BY oauth2token_permanent.id")
+    op.drop_table("oauth2token")
+
+    op.rename_table("oauth2token_permanent", "oauth2token")
+    for name in INDEXES:
+        op.execute(
+            "ALTER INDEX {0} RENAME TO {1}".format(
+                name.replace("ix_oauth2token", "oauth2token_permanent"), name
+            )
+        )
+    op.execute(
+        "ALTER INDEX oauth2token_permanent_access_token_idx RENAME TO ix_oauth2token_access_token"
+    )
+    op.drop_index("oauth2token_permanent_access_token_partition_day_idx", table_name="oauth2token")
+    op.drop_index("oauth2token_permanent_id_partition_day_idx", table_name="oauth2token")
+    op.drop_column("oauth2token", "partition_day")
@@ -0,0 +1,48 @@
+"""Add user.hashed_id and oauth2client.hashed_id
+
+Revision ID: 3c1e7b92d0af
+Revises: 9f57cdb418b8
+Create Date: 2026-10-19 11:03:27.562901
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3c1e7b92d0af"
+down_revision: Union[str, None] = "9f57cdb418b8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing rows are filled in with `apigateway backfill hashed-ids`, the hash depends
+    # on the application's secret key which is not available to migrations
+    op.add_column("user", sa.Column("hashed_id", sa.String(length=64), nullable=True))
+    op.add_column("oauth2client", sa.Column("hashed_id", sa.String(length=64), nullable=True))
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_user_hashed_id"),
+            "user",
+            ["hashed_id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            op.f("ix_oauth2client_hashed_id"),
+            "oauth2client",
+            ["hashed_id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_oauth2client_hashed_id"), table_name="oauth2client")
+    op.drop_index(op.f("ix_user_hashed_id"), table_name="user")
+    op.drop_column("oauth2client", "hashed_id")
+    op.drop_column("user", "hashed_id")
@@ -0,0 +1,33 @@
+"""Add created_at to email_change_request and password_change_request
+
+Revision ID: 5d2f8a61c3e7
+Revises: b7d41e2a9c65
+Create Date: 2026-10-19 15:22:51.830417
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5d2f8a61c3e7"
+down_revision: Union[str, None] = "b7d41e2a9c65"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing requests get the time of the migration, so that the maintenance worker
+    # removes them once they are older than MAINTENANCE_SERVICE_CHANGE_REQUEST_MAX_AGE
+    for table in ("email_change_request", "password_change_request"):
+        op.add_column(
+            table,
+            sa.Column("created_at", sa.DateTime(), server_default=sa.func.now(), nullable=True),
+        )
+
+
+def downgrade() -> None:
+    op.drop_column("password_change_request", "created_at")
+    op.drop_column("email_change_request", "created_at")
@@ -0,0 +1,53 @@
+"""Add oauth2client.client_name
+
+Revision ID: 9f57cdb418b8
+Revises: f2f57cb2a5b0
+Create Date: 2026-10-19 09:12:40.118374
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9f57cdb418b8"
+down_revision: Union[str, None] = "f2f57cb2a5b0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 10000
+
+
+def upgrade() -> None:
+    op.add_column("oauth2client", sa.Column("client_name", sa.Text(), nullable=True))
+
+    # Backfill from the JSON metadata in id ranges, committing each batch so that the
+    # table is never locked or rewritten as a whole
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        max_id = connection.execute(sa.text("SELECT MAX(id) FROM oauth2client")).scalar() or 0
+
+        for start in range(0, max_id, BATCH_SIZE):
+            connection.execute(
+                sa.text(
+                    """UPDATE oauth2client
+                    SET client_name = client_metadata::json->>'client_name'
+                    WHERE id > :start AND id <= :end AND client_metadata IS NOT NULL"""
+                ),
+                {"start": start, "end": start + BATCH_SIZE},
+            )
+
+        op.create_index(
+            "ix_oauth2client_user_id_client_name",
+            "oauth2client",
+            ["user_id", "client_name"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_oauth2client_user_id_client_name", table_name="oauth2client")
+    op.drop_column("oauth2client", "client_name")
@@ -0,0 +1,69 @@
+"""Add oauth2token.access_token_digest
+
+Revision ID: a4c7d2e918b3
+Revises: 0e6b3f95a1d4
+Create Date: 2026-10-19 18:05:31.482210
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a4c7d2e918b3"
+down_revision: Union[str, None] = "0e6b3f95a1d4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 10000
+
+
+def upgrade() -> None:
+    op.add_column(
+        "oauth2token", sa.Column("access_token_digest", sa.LargeBinary(16), nullable=True)
+    )
+
+    # Backfill in id ranges, committing each batch so that the table is never locked or
+    # rewritten as a whole. The digest matches OAuth2Token.get_access_token_digest
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        max_id = connection.execute(sa.text("SELECT MAX(id) FROM oauth2token")).scalar() or 0
+
+        for start in range(0, max_id, BATCH_SIZE):
+            connection.execute(
+                sa.text("""UPDATE oauth2token
+                    SET access_token_digest =
+                        substring(sha256(convert_to(access_token, 'UTF8')) FROM 1 FOR 16)
+                    WHERE id > :start AND id <= :end AND access_token_digest IS NULL"""),
+                {"start": start, "end": start + BATCH_SIZE},
+            )
+
+        # Indexes of a partitioned table cannot be built concurrently. The index is created
+        # on the parent only and the concurrently built index of every partition is attached
+        # to it, it becomes valid once all partitions are attached
+        op.execute(
+            "CREATE UNIQUE INDEX ix_oauth2token_access_token_digest "
+            "ON ONLY oauth2token (access_token_digest, partition_day)"
+        )
+        partitions = connection.execute(
+            sa.text(
+                "SELECT inhrelid::regclass::text FROM pg_inherits "
+                "WHERE inhparent = 'oauth2token'::regclass"
+            )
+        ).scalars()
+        for partition in partitions.all():
+            op.execute(
+                "CREATE UNIQUE INDEX CONCURRENTLY {0}_access_token_digest_idx "
+                "ON {0} (access_token_digest, partition_day)".format(partition)
+            )
+            op.execute(
+                "ALTER INDEX ix_oauth2token_access_token_digest "
+                "ATTACH PARTITION {0}_access_token_digest_idx".format(partition)
+            )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_oauth2token_access_token_digest", table_name="oauth2token")
+    op.drop_column("oauth2token", "access_token_digest")
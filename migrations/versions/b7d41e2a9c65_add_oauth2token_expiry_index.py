@@ -0,0 +1,34 @@
+"""Add an expression index on the expiry of oauth2token
+
+Revision ID: b7d41e2a9c65
+Revises: 3c1e7b92d0af
+Create Date: 2026-10-19 13:41:08.274519
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b7d41e2a9c65"
+down_revision: Union[str, None] = "3c1e7b92d0af"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Used by `apigateway cleanup tokens` to find expired tokens without a sequential scan
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_oauth2token_expires_at",
+            "oauth2token",
+            [sa.text("(issued_at + expires_in)")],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_oauth2token_expires_at", table_name="oauth2token")
@@ -0,0 +1,46 @@
+"""Drop the indexes on oauth2token.access_token
+
+Tokens are looked up by oauth2token.access_token_digest. Apply after the gateway
+has been deployed with the digest lookup.
+
+Revision ID: d81f5c0b7e26
+Revises: e3b9a6f1c274
+Create Date: 2026-10-19 18:22:07.915463
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d81f5c0b7e26"
+down_revision: Union[str, None] = "e3b9a6f1c274"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "oauth2token_permanent_access_token_idx",
+            table_name="oauth2token_permanent",
+            postgresql_concurrently=True,
+        )
+
+    # Drops the indexes of the partitions as well
+    op.drop_index("ix_oauth2token_access_token", table_name="oauth2token")
+
+
+def downgrade() -> None:
+    op.execute(
+        "CREATE UNIQUE INDEX ix_oauth2token_access_token ON oauth2token (access_token, partition_day)"
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "oauth2token_permanent_access_token_idx",
+            "oauth2token_permanent",
+            ["access_token"],
+            unique=True,
+            postgresql_concurrently=True,
+        )
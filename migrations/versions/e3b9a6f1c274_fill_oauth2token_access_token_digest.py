@@ -0,0 +1,58 @@
+"""Fill oauth2token.access_token_digest in the database
+
+Tokens inserted without a digest, such as those of gateway instances that predate the
+digest lookup during a rolling deploy, would never be found. A trigger computes the
+digest of every inserted or updated token, and the digests of tokens inserted since the
+column was added are filled in. Triggers on partitioned tables require PostgreSQL 13.
+
+Revision ID: e3b9a6f1c274
+Revises: a4c7d2e918b3
+Create Date: 2026-10-19 20:41:53.208117
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e3b9a6f1c274"
+down_revision: Union[str, None] = "a4c7d2e918b3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 10000
+
+
+def upgrade() -> None:
+    # The digest matches OAuth2Token.get_access_token_digest
+    op.execute("""CREATE FUNCTION oauth2token_set_access_token_digest() RETURNS trigger AS $$
+        BEGIN
+            NEW.access_token_digest :=
+                substring(sha256(convert_to(NEW.access_token, 'UTF8')) FROM 1 FOR 16);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql""")
+    # Created on the partitions as well, including those created later
+    op.execute("""CREATE TRIGGER oauth2token_access_token_digest
+        BEFORE INSERT OR UPDATE OF access_token ON oauth2token
+        FOR EACH ROW EXECUTE FUNCTION oauth2token_set_access_token_digest()""")
+
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        max_id = connection.execute(sa.text("SELECT MAX(id) FROM oauth2token")).scalar() or 0
+
+        for start in range(0, max_id, BATCH_SIZE):
+            connection.execute(
+                sa.text("""UPDATE oauth2token
+                    SET access_token_digest =
+                        substring(sha256(convert_to(access_token, 'UTF8')) FROM 1 FOR 16)
+                    WHERE id > :start AND id <= :end AND access_token_digest IS NULL"""),
+                {"start": start, "end": start + BATCH_SIZE},
+            )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER oauth2token_access_token_digest ON oauth2token")
+    op.execute("DROP FUNCTION oauth2token_set_access_token_digest()")
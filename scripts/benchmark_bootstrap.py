@@ -0,0 +1,85 @@
+"""Load test for the bootstrap endpoint.
+
+Logs in once, then hammers /accounts/bootstrap with the resulting session cookie
+and reports the achieved requests per second.
+
+To compare the cached and uncached paths, run it once against a gateway started with
+BOOTSTRAP_CACHE_TIMEOUT=0 and once against one using the default configuration:
+
+    python scripts/benchmark_bootstrap.py --url http://localhost:5000 \\
+        --email user@example.com --password Password1 --requests 5000 --concurrency 16
+"""
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def add_arguments(parser):
+    parser.add_argument("--url", default="http://localhost:5000", help="Gateway base URL")
+    parser.add_argument("--email", required=True, help="Email of a verified user")
+    parser.add_argument("--password", required=True, help="Password of the user")
+    parser.add_argument("--requests", type=int, default=2000, help="Total number of requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of client threads")
+    parser.add_argument("--warmup", type=int, default=50, help="Requests sent before measuring")
+
+
+def login(base_url: str, email: str, password: str) -> requests.Session:
+    session = requests.Session()
+
+    csrf = session.get(f"{base_url}/accounts/csrf").json()["csrf"]
+    response = session.post(
+        f"{base_url}/accounts/user/login",
+        json={"email": email, "password": password},
+        headers={"X-CSRFToken": csrf},
+    )
+    response.raise_for_status()
+
+    return session
+
+
+def run(args):
+    session = login(args.url, args.email, args.password)
+    cookies = session.cookies.get_dict()
+    bootstrap_url = f"{args.url}/accounts/bootstrap"
+
+    local = threading.local()
+
+    def bootstrap(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.cookies.update(cookies)
+
+        start = time.perf_counter()
+        response = local.session.get(bootstrap_url)
+        return response.status_code, time.perf_counter() - start
+
+    for i in range(args.warmup):
+        bootstrap(i)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(bootstrap, range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    errors = sum(1 for status, _ in results if status != 200)
+
+    print(f"requests:    {len(results)} ({errors} errors)")
+    print(f"concurrency: {args.concurrency}")
+    print(f"throughput:  {len(results) / elapsed:.1f} req/s")
+    print(f"latency p50: {statistics.median(latencies) * 1000:.2f} ms")
+    print(f"latency p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args()))
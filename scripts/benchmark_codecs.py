@@ -0,0 +1,118 @@
+"""Benchmark of the codecs used for values stored in Redis.
+
+Encodes and decodes payloads of the sizes the gateway stores - a resource document, the
+cached bootstrap responses of a user and a cached proxy response - with cachelib's pickle
+serializer and with the gateway's codecs, and reports the time per operation and the
+number of stored bytes:
+
+    python scripts/benchmark_codecs.py --iterations 20000
+"""
+
+import argparse
+import json
+import secrets
+import sys
+import timeit
+
+from cachelib.serializers import RedisSerializer
+
+from apigateway.serializers import CacheCodec, Codec
+
+ALLOWED_HEADERS = ["Content-Type", "Content-Disposition"]
+
+
+def add_arguments(parser):
+    parser.add_argument("--iterations", type=int, default=10000, help="Operations per case")
+    parser.add_argument(
+        "--endpoints", type=int, default=60, help="Endpoints per resource document"
+    )
+    parser.add_argument("--body-size", type=int, default=20000, help="Proxy response body bytes")
+
+
+def resource_document(endpoints: int) -> dict:
+    # Resource documents are parsed from the JSON responses of the services
+    document = {
+        "/endpoint/{0}/<path:identifier>".format(i): {
+            "description": "Returns the records of endpoint {0} for an identifier".format(i),
+            "methods": ["OPTIONS", "GET", "HEAD", "POST"],
+            "scopes": ["api", "user"],
+            "rate_limit": [300, 86400],
+            "cache": {"timeout": 600, "query_parameters": True, "excluded_parameters": []},
+            "authorization": True,
+        }
+        for i in range(endpoints)
+    }
+    return json.loads(json.dumps(document))
+
+
+def bootstrap_responses() -> dict:
+    return {
+        "BBB client {0}".format(i): {
+            "access_token": secrets.token_hex(20),
+            "refresh_token": secrets.token_hex(20),
+            "username": "user@example.com",
+            "scopes": ["api", "user"],
+            "client_id": secrets.token_hex(20),
+            "client_secret": secrets.token_hex(30),
+            "client_name": "BBB client {0}".format(i),
+            "expires_at": "1893456000",
+            "ratelimit": 1.0,
+            "anonymous": False,
+            "given_name": "Jane",
+            "family_name": "Doe",
+        }
+        for i in range(3)
+    }
+
+
+def proxy_response(body_size: int) -> tuple:
+    docs = []
+    while len(json.dumps(docs)) < body_size:
+        docs.append({"bibcode": "2024ApJ...000..000X", "title": ["A title " * 8], "year": "2024"})
+    headers = {
+        "Content-Type": "application/json",
+        "Content-Length": "0",
+        "Date": "Mon, 19 Oct 2026 12:00:00 GMT",
+        "Server": "gunicorn",
+        "Connection": "keep-alive",
+        "Vary": "Accept-Encoding",
+        "X-Ratelimit-Limit": "5000",
+        "X-Ratelimit-Remaining": "4999",
+        "X-Ratelimit-Reset": "1893456000",
+        "Access-Control-Allow-Origin": "*",
+        "Cache-Control": "no-cache",
+        "Strict-Transport-Security": "max-age=31536000",
+    }
+    return json.dumps({"response": {"docs": docs}}).encode(), 200, headers
+
+
+def measure(codec, value, iterations: int) -> tuple:
+    encoded = codec.dumps(value)
+    encode = timeit.timeit(lambda: codec.dumps(value), number=iterations) / iterations
+    decode = timeit.timeit(lambda: codec.loads(encoded), number=iterations) / iterations
+    return encode, decode, len(encoded)
+
+
+def run(args):
+    cases = {
+        "resource document": (resource_document(args.endpoints), Codec()),
+        "bootstrap responses": (bootstrap_responses(), Codec()),
+        "proxy response": (proxy_response(args.body_size), CacheCodec(ALLOWED_HEADERS)),
+    }
+
+    print(f"{'payload':<20} {'codec':<8} {'encode':>10} {'decode':>10} {'bytes':>8}")
+    for name, (value, codec) in cases.items():
+        for codec_name, candidate in (("pickle", RedisSerializer()), ("gateway", codec)):
+            encode, decode, size = measure(candidate, value, args.iterations)
+            print(
+                f"{name:<20} {codec_name:<8} {encode * 1e6:>8.2f}us {decode * 1e6:>8.2f}us "
+                f"{size:>8}"
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""Load test for logins under mixed load.
+
+Runs a number of threads that log in repeatedly next to a number of threads that
+send proxied API requests, and reports logins per second next to the achieved proxy
+throughput and latency.
+
+To compare inline and pooled password hashing, run it once against a gateway started
+with SECURITY_SERVICE_PASSWORD_WORKERS=0 and once against one using the default
+configuration:
+
+    python scripts/benchmark_login.py --url http://localhost:5000 \\
+        --email user@example.com --password Password1 --token xxxx \\
+        --proxy-path /v1/search/query?q=star --duration 30
+"""
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+def add_arguments(parser):
+    parser.add_argument("--url", default="http://localhost:5000", help="Gateway base URL")
+    parser.add_argument("--email", required=True, help="Email of a verified user")
+    parser.add_argument("--password", required=True, help="Password of the user")
+    parser.add_argument("--token", required=True, help="API token used for proxied requests")
+    parser.add_argument("--proxy-path", required=True, help="Path of a proxied endpoint")
+    parser.add_argument("--login-threads", type=int, default=8, help="Threads logging in")
+    parser.add_argument("--proxy-threads", type=int, default=8, help="Threads sending API requests")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run the test")
+
+
+def login_worker(args, stop: threading.Event, results: list):
+    session = requests.Session()
+    csrf = session.get(f"{args.url}/accounts/csrf").json()["csrf"]
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = session.post(
+            f"{args.url}/accounts/user/login",
+            json={"email": args.email, "password": args.password},
+            headers={"X-CSRFToken": csrf},
+        )
+        results.append((response.status_code, time.perf_counter() - start))
+
+
+def proxy_worker(args, stop: threading.Event, results: list):
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {args.token}"
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = session.get(f"{args.url}{args.proxy_path}")
+        results.append((response.status_code, time.perf_counter() - start))
+
+
+def report(name: str, results: list, elapsed: float):
+    if not results:
+        print(f"{name}: no requests completed")
+        return
+
+    latencies = sorted(latency for _, latency in results)
+    statuses = Counter(status for status, _ in results)
+
+    print(f"{name}:")
+    print(f"  requests:    {len(results)} {dict(statuses)}")
+    print(f"  throughput:  {len(results) / elapsed:.1f} req/s")
+    print(f"  latency p50: {statistics.median(latencies) * 1000:.2f} ms")
+    print(f"  latency p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+
+
+def run(args):
+    stop = threading.Event()
+    logins, proxied = [], []
+
+    threads = [
+        threading.Thread(target=login_worker, args=(args, stop, logins))
+        for _ in range(args.login_threads)
+    ] + [
+        threading.Thread(target=proxy_worker, args=(args, stop, proxied))
+        for _ in range(args.proxy_threads)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.duration)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    report("logins", logins, elapsed)
+    report("proxied requests", proxied, elapsed)
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args()))
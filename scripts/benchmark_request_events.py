@@ -0,0 +1,185 @@
+"""Benchmark of the overhead that request events add to the requests of the gateway.
+
+Serves requests of a minimal Flask app through its test client, once without the Kafka
+producer service and once with it, and reports the time per request. The events are sent
+to a stand-in broker on localhost, which answers the version and metadata requests of the
+producer and counts the produced batches. Events are produced without acknowledgements,
+as by the gateway, so the broker does not need to answer them:
+
+    python scripts/benchmark_request_events.py --requests 20000
+"""
+
+import argparse
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from flask import Flask
+from flask_login import LoginManager
+from kafka.protocol.admin import ApiVersionResponse
+from kafka.protocol.metadata import MetadataResponse
+
+from apigateway import extensions
+
+TOPIC = "gatewayRequests"
+PRODUCE, METADATA, API_VERSIONS = 0, 3, 18
+
+# The producer infers the version of the broker from the supported requests
+SUPPORTED_VERSIONS = [(PRODUCE, 0, 2), (METADATA, 0, 1), (API_VERSIONS, 0, 0)]
+
+
+def add_arguments(parser):
+    parser.add_argument("--requests", type=int, default=10000, help="Requests per case")
+    parser.add_argument("--warmup", type=int, default=500, help="Requests sent before measuring")
+    parser.add_argument(
+        "--linger-ms", type=int, default=50, help="KAFKA_PRODUCER_SERVICE_LINGER_MS"
+    )
+    parser.add_argument(
+        "--compression", default="gzip", help="KAFKA_PRODUCER_SERVICE_COMPRESSION_TYPE"
+    )
+    parser.add_argument(
+        "--spool-path", help="KAFKA_PRODUCER_SERVICE_SPOOL_PATH, defaults to a temporary directory"
+    )
+
+
+class StandInBroker(socketserver.ThreadingTCPServer):
+    """A single-node broker that accepts the batches of a producer without storing them."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), BrokerHandler)
+        self.produce_requests = 0
+        self.produced_bytes = 0
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            header = self._read(4)
+            if header is None:
+                return
+            payload = self._read(struct.unpack("!i", header)[0])
+            if payload is None:
+                return
+
+            api_key, api_version, correlation_id = struct.unpack_from("!hhi", payload)
+            if api_key == PRODUCE:
+                self.server.produce_requests += 1
+                self.server.produced_bytes += len(payload)
+                continue
+            if api_key == API_VERSIONS:
+                response = ApiVersionResponse[0](error_code=0, api_versions=SUPPORTED_VERSIONS)
+            elif api_key == METADATA:
+                response = self._metadata(api_version)
+            else:
+                # Like Kafka, close the connection on requests that are not supported
+                return
+
+            body = struct.pack("!i", correlation_id) + response.encode()
+            self.request.sendall(struct.pack("!i", len(body)) + body)
+
+    def _metadata(self, api_version: int):
+        host, port = self.server.server_address
+        partitions = [(0, 0, 0, [0], [0])]
+        if api_version == 0:
+            return MetadataResponse[0](brokers=[(0, host, port)], topics=[(0, TOPIC, partitions)])
+        return MetadataResponse[1](
+            brokers=[(0, host, port, None)],
+            controller_id=0,
+            topics=[(0, TOPIC, False, partitions)],
+        )
+
+    def _read(self, size: int) -> bytes | None:
+        data = b""
+        while len(data) < size:
+            try:
+                chunk = self.request.recv(size - len(data))
+            except OSError:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+def create_app(broker: StandInBroker | None, args) -> tuple:
+    app = Flask("benchmark")
+    app.config.update(
+        SECRET_KEY="benchmark",
+        KAFKA_PRODUCER_SERVICE_REQUEST_TOPIC=TOPIC,
+        KAFKA_PRODUCER_SERVICE_LINGER_MS=args.linger_ms,
+        KAFKA_PRODUCER_SERVICE_COMPRESSION_TYPE=args.compression,
+        KAFKA_PRODUCER_SERVICE_SPOOL_PATH=args.spool_path,
+    )
+    # Requests are anonymous, as no session is sent
+    LoginManager(app).user_loader(lambda user_id: None)
+    app.add_url_rule("/search/query", "search", lambda: {"response": {"docs": []}})
+
+    kafka_producer_service = None
+    if broker is not None:
+        host, port = broker.server_address
+        app.config["KAFKA_PRODUCER_SERVICE_BOOTSTRAP_SERVERS"] = ["{0}:{1}".format(host, port)]
+        kafka_producer_service = extensions.kakfa_producer_service
+        kafka_producer_service.init_app(app)
+
+    return app, kafka_producer_service
+
+
+def measure(app: Flask, requests: int, warmup: int) -> float:
+    client = app.test_client()
+    for _ in range(warmup):
+        client.get("/search/query")
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get("/search/query")
+    return (time.perf_counter() - start) / requests
+
+
+def run(args):
+    if args.spool_path is None:
+        with tempfile.TemporaryDirectory() as spool_path:
+            args.spool_path = spool_path
+            return run(args)
+
+    broker = StandInBroker()
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+
+    disabled_app, _ = create_app(None, args)
+    disabled = measure(disabled_app, args.requests, args.warmup)
+
+    enabled_app, kafka_producer_service = create_app(broker, args)
+    # The first request starts the sender, which connects in the background
+    enabled_app.test_client().get("/search/query")
+    deadline = time.monotonic() + 10
+    while not kafka_producer_service.connected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not kafka_producer_service.connected:
+        print("The producer could not connect to the stand-in broker", file=sys.stderr)
+        return 1
+    enabled = measure(enabled_app, args.requests, args.warmup)
+    kafka_producer_service.flush(10)
+
+    print(f"{'producer':<10} {'per request':>12}")
+    print(f"{'disabled':<10} {disabled * 1e6:>10.1f}us")
+    print(f"{'enabled':<10} {enabled * 1e6:>10.1f}us")
+    print(f"overhead   {(enabled - disabled) * 1e6:>10.1f}us")
+    print(
+        f"events dropped: {kafka_producer_service.dropped_events}, produce requests: "
+        f"{broker.produce_requests}, bytes: {broker.produced_bytes}"
+    )
+
+    kafka_producer_service.close(1)
+    broker.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args()))
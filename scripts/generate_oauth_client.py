@@ -102,7 +102,7 @@ def get_token():
         
         
         try:
-            client = db.session.query(OAuth2Client).filter_by(user_id=u.get_id(), name=args.name).one()
+            client = db.session.query(OAuth2Client).filter_by(user_id=u.get_id(), client_name=args.name).one()
         except MultipleResultsFound:
             raise DatabaseIntegrityError("Multiple oauthclients found for that user and name.")
         except NoResultFound: